@@ -0,0 +1,29 @@
+from pathlib import Path
+
+import pytest
+from typer.testing import CliRunner
+
+from tests.helpers import make_video
+from video_search.cli.main import app
+
+
+@pytest.fixture
+def videos(tmp_path: Path) -> list[Path]:
+    directory = tmp_path / "videos"
+    directory.mkdir()
+    paths = []
+    for i in range(3):
+        path = directory / f"v{i}.mp4"
+        make_video(path, seed=i)
+        paths.append(path.resolve())
+    return paths
+
+
+@pytest.fixture
+def cli():
+    runner = CliRunner()
+
+    def invoke(db: Path, *args: str):
+        return runner.invoke(app, ["--db-path", str(db), *args])
+
+    return invoke
@@ -0,0 +1,70 @@
+from pathlib import Path
+
+import av
+import numpy as np
+from imagehash import ImageHash
+
+from video_search.storage import (
+    HashStorage,
+    LegacyHashStorage,
+    ManifestEntry,
+    VideoStatus,
+)
+
+
+def random_hashes(n: int, seed: int = 0) -> list[ImageHash]:
+    rng = np.random.default_rng(seed)
+    return [ImageHash(bits) for bits in rng.random((n, 8, 8)) > 0.5]
+
+
+def fill(
+    storage: HashStorage,
+    n: int,
+    per_video: int = 100,
+    seed: int = 0,
+    prefix: str = "/videos/",
+    frame_data: bytes = b"",
+) -> list[ImageHash]:
+    # n records of videos with `per_video` frames a second apart, each video
+    # committed once its last record is written
+    hashes = random_hashes(n, seed)
+    for i, h in enumerate(hashes):
+        path = Path(f"{prefix}{i // per_video}.mp4")
+        storage.append_record(frame_data, h, path, float(i % per_video))
+        if i % per_video == per_video - 1 or i == n - 1:
+            frames = i % per_video + 1
+            storage.commit_video(
+                ManifestEntry.for_file(
+                    path, float(frames), frames, VideoStatus.COMPLETE
+                )
+            )
+    return hashes
+
+
+def make_legacy(path: Path, n: int, seed: int = 0) -> list[ImageHash]:
+    # open_storage creates new databases in the current format
+    with open(path, "ab+") as f:
+        storage = LegacyHashStorage(f)
+        hashes = fill(storage, n, seed=seed)
+        storage.flush()
+    return hashes
+
+
+def make_video(path: Path, scenes: int = 4, seed: int = 0, fps: int = 12):
+    # A scene of random blocks every second, sliding a little within it
+    rng = np.random.default_rng(seed)
+    width, height = 160, 120
+    with av.open(str(path), "w") as container:
+        stream = container.add_stream("libx264", rate=fps)
+        stream.width, stream.height, stream.pix_fmt = width, height, "yuv420p"
+        for _ in range(scenes):
+            base = rng.integers(0, 255, (8, 8, 3), dtype=np.uint8)
+            image = np.kron(base, np.ones((height // 8, width // 8, 1), np.uint8))
+            for i in range(fps):
+                frame = av.VideoFrame.from_ndarray(
+                    np.roll(image, i, axis=1), format="rgb24"
+                )
+                for packet in stream.encode(frame):
+                    container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
@@ -0,0 +1,71 @@
+import json
+from pathlib import Path
+
+import av
+import pytest
+
+from video_search.benchmark import (
+    RESULTS_FORMAT,
+    SyntheticVideo,
+    build_database,
+    compare_results,
+    generate_video,
+    load_results,
+)
+from video_search.hash import ThumbnailFormat
+from video_search.storage import open_storage
+
+
+def test_build_database(tmp_path: Path):
+    a, b = tmp_path / "a.db", tmp_path / "b.db"
+    build_database(a, 1200, 3, ThumbnailFormat.NONE)
+    build_database(b, 1200, 3, ThumbnailFormat.NONE)
+    with open_storage(a) as first, open_storage(b) as second:
+        assert len(first.videos()) == 3
+        assert (first.hash_table().hashes == second.hash_table().hashes).all()
+
+
+def test_generate_video(tmp_path: Path):
+    video = SyntheticVideo("tiny", 160, 120, "libx264", ".mp4", seconds=2.0, fps=12)
+    generate_video(tmp_path / "tiny.mp4", video)
+    with av.open(str(tmp_path / "tiny.mp4")) as container:
+        stream = container.streams.video[0]
+        assert (stream.width, stream.height) == (160, 120)
+        assert sum(1 for _ in container.decode(stream)) == 24
+
+
+def test_cli(tmp_path: Path, cli):
+    output = tmp_path / "results.json"
+    args = [
+        "benchmark",
+        "--output",
+        str(output),
+        "--work-dir",
+        str(tmp_path / "work"),
+        "--size",
+        "2000",
+        "--queries",
+        "5",
+        "--no-videos",
+        "--no-startup",
+    ]
+    result = cli(tmp_path / "unused.db", *args)
+    assert result.exit_code == 0, result.output
+    results = load_results(output)
+    assert results["format"] == RESULTS_FORMAT
+    [database] = results["databases"]
+    assert database["frames"] == 2000
+    assert database["search"]["queries"] == 5
+
+    # The database is reused, and the results compared to the last ones
+    result = cli(tmp_path / "unused.db", *args, "--compare", str(output))
+    assert result.exit_code == 0, result.output
+    assert "build" not in load_results(output)["databases"][0]
+    assert compare_results(results, load_results(output))
+
+
+def test_load_results(tmp_path: Path):
+    path = tmp_path / "other.json"
+    path.write_text(json.dumps({"format": "something else"}))
+    with pytest.raises(ValueError):
+        load_results(path)
@@ -0,0 +1,85 @@
+from pathlib import Path
+
+import numpy as np
+
+from tests.helpers import fill
+from video_search.cache import IndexCache
+from video_search.profiling import Profiler
+from video_search.shards import Catalog, ShardSplit
+from video_search.storage import open_storage
+
+
+def load(cache: IndexCache, db: Path):
+    profiler = Profiler()
+    with open_storage(db) as storage:
+        table = cache.hash_table(db, storage, profiler=profiler)
+        fresh = storage.hash_table()
+    assert (table.hashes == fresh.hashes).all()
+    assert (table.offsets == fresh.offsets).all()
+    return table, profiler.counters
+
+
+def test_tail_loads(tmp_path: Path):
+    db = tmp_path / "hashes.db"
+    cache = IndexCache()
+    with open_storage(db) as storage:
+        fill(storage, 200)
+
+    first, counters = load(cache, db)
+    assert counters == {"cache_rebuilds": 1}
+    again, counters = load(cache, db)
+    assert again is first
+    assert counters == {"cache_hits": 1}
+
+    with open_storage(db) as storage:
+        fill(storage, 100, prefix="/more/", seed=1)
+    table, counters = load(cache, db)
+    assert len(table) == 300
+    assert counters == {"cache_tail_loads": 1}
+    # The cached table itself is never modified
+    assert len(first) == 200
+
+
+def test_rebuild_on_remove(tmp_path: Path):
+    db = tmp_path / "hashes.db"
+    cache = IndexCache()
+    with open_storage(db) as storage:
+        fill(storage, 200)
+    load(cache, db)
+
+    with open_storage(db) as storage:
+        storage.remove_video("/videos/0.mp4")
+        fill(storage, 100, prefix="/more/", seed=1)
+    table, counters = load(cache, db)
+    assert counters == {"cache_rebuilds": 1}
+    assert len(table) == 200
+
+
+def test_sharded_tail(tmp_path: Path):
+    catalog = tmp_path / "hashes.catalog"
+    Catalog(catalog, ShardSplit.SIZE, 1).save()
+    cache = IndexCache()
+    with open_storage(catalog) as sharded:
+        fill(sharded, 200)
+    load(cache, catalog)
+
+    with open_storage(catalog) as sharded:
+        fill(sharded, 200, prefix="/more/", seed=1)
+    table, counters = load(cache, catalog)
+    assert counters == {"cache_tail_loads": 1}
+    assert len(table) == 400
+    assert (np.diff(table.offsets) > 0).all()
+
+
+def test_eviction(tmp_path: Path):
+    cache = IndexCache(max_entries=2)
+    dbs = [tmp_path / f"{i}.db" for i in range(3)]
+    for i, db in enumerate(dbs):
+        with open_storage(db) as storage:
+            fill(storage, 100, seed=i)
+        load(cache, db)
+
+    # The least recently searched database was dropped
+    assert load(cache, dbs[2])[1] == {"cache_hits": 1}
+    assert load(cache, dbs[0])[1] == {"cache_rebuilds": 1}
+    assert load(cache, dbs[1])[1] == {"cache_rebuilds": 1}
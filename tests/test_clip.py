@@ -0,0 +1,47 @@
+import json
+from pathlib import Path
+
+import numpy as np
+from imagehash import ImageHash
+
+from tests.helpers import fill
+from video_search.clip import ClipQuery, hash_clip, search_clip
+from video_search.hash import pack_hashes
+from video_search.indexer import index_videos
+from video_search.storage import open_storage
+
+
+def clip_of(hashes: list[ImageHash], flips: int = 3) -> ClipQuery:
+    # A second of every hash with a few bits changed
+    bits = np.stack([h.hash for h in hashes])
+    bits.reshape(len(bits), -1)[:, :flips] ^= True
+    return ClipQuery(pack_hashes(bits), np.arange(len(bits), dtype=np.float64), 64)
+
+
+def test_search_clip(tmp_path: Path):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        hashes = fill(storage, 300)
+
+    with open_storage(db) as storage:
+        results = search_clip(clip_of(hashes[120:130]), storage)
+    best = results[0]
+    assert (best.path, best.start) == ("/videos/1.mp4", 20.0)
+    assert best.matched == best.frames == 10
+    assert best.similarity > 0.9
+    assert best.match.time == 20.0
+    assert all(r.similarity < best.similarity for r in results[1:])
+
+
+def test_search_clip_video(tmp_path: Path, videos: list[Path], cli):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        index_videos(videos, storage)
+        [best, *_] = search_clip(hash_clip(videos[1]), storage)
+    assert (best.path, best.start) == (str(videos[1]), 0.0)
+    assert best.similarity == 1.0
+
+    result = cli(db, "search-clip", str(videos[2]), "--json")
+    assert result.exit_code == 0, result.output
+    rows = json.loads(result.output)
+    assert rows[0]["path"] == str(videos[2])
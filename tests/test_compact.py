@@ -0,0 +1,76 @@
+from pathlib import Path
+
+from tests.helpers import fill, make_legacy
+from video_search.storage import VideoStatus, open_storage
+
+
+def live_paths(db: Path) -> list[str]:
+    with open_storage(db) as storage:
+        return sorted({str(record.path) for record in storage})
+
+
+def test_remove_compact(tmp_path: Path, cli):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        hashes = fill(storage, 300)
+    size = db.stat().st_size
+
+    result = cli(db, "remove", "/videos/1.mp4")
+    assert result.exit_code == 0, result.output
+    assert "Removed /videos/1.mp4" in result.output
+    with open_storage(db) as storage:
+        assert storage.videos()["/videos/1.mp4"].status == VideoStatus.REMOVED
+        assert len(storage.hash_table()) == 200
+    assert live_paths(db) == ["/videos/0.mp4", "/videos/2.mp4"]
+
+    result = cli(db, "compact", "--keep-missing")
+    assert result.exit_code == 0, result.output
+    assert db.stat().st_size < size
+    assert live_paths(db) == ["/videos/0.mp4", "/videos/2.mp4"]
+    with open_storage(db) as storage:
+        records = list(storage)
+        assert "/videos/1.mp4" not in storage.videos()
+    kept = hashes[:100] + hashes[200:]
+    assert sorted(str(record.hash) for record in records) == sorted(
+        str(h) for h in kept
+    )
+
+    # Removed videos can be indexed again
+    with open_storage(db) as storage:
+        fill(storage, 100, seed=1, prefix="/again/")
+    assert live_paths(db) == ["/again/0.mp4", "/videos/0.mp4", "/videos/2.mp4"]
+
+
+def test_compact_drops_missing(tmp_path: Path, cli):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        fill(storage, 100, prefix=f"{tmp_path}/")
+    (tmp_path / "0.mp4").touch()
+    with open_storage(db) as storage:
+        fill(storage, 100, prefix=f"{tmp_path}/gone-")
+
+    result = cli(db, "compact")
+    assert result.exit_code == 0, result.output
+    assert live_paths(db) == [f"{tmp_path}/0.mp4"]
+
+
+def test_remove_unknown(tmp_path: Path, cli):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        fill(storage, 100)
+
+    result = cli(db, "remove", "/elsewhere/0.mp4")
+    assert result.exit_code == 0
+    assert "is not in the database" in result.output
+
+
+def test_remove_legacy(tmp_path: Path, cli):
+    db = tmp_path / "hashes.db"
+    make_legacy(db, 200)
+    before = db.read_bytes()
+
+    result = cli(db, "remove", "/videos/0.mp4")
+    assert result.exit_code == 1
+    assert result.exception is None or isinstance(result.exception, SystemExit)
+    assert "migrate first" in " ".join(result.output.split())
+    assert db.read_bytes() == before
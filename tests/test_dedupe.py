@@ -0,0 +1,95 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+from imagehash import ImageHash
+
+from tests.helpers import random_hashes
+from video_search import dedupe
+from video_search.dedupe import (
+    DedupeAction,
+    DedupeOptions,
+    DedupeScope,
+    Deduplicator,
+    NearDuplicates,
+)
+from video_search.hash import pack_hash, pack_hashes
+from video_search.indexer import index_videos
+from video_search.storage import open_storage
+
+
+def flipped(hash: ImageHash, bits: int) -> ImageHash:
+    flat = hash.hash.flatten()
+    flat[:bits] = ~flat[:bits]
+    return ImageHash(flat.reshape(hash.hash.shape))
+
+
+def test_video_scope():
+    deduplicator = Deduplicator(DedupeOptions(DedupeScope.VIDEO, 4))
+    [a, b] = random_hashes(2)
+    assert deduplicator.check(a) is None
+    assert deduplicator.check(flipped(a, 4)) == DedupeAction.REFERENCE
+    assert deduplicator.check(flipped(a, 5)) is None
+    assert deduplicator.check(b) is None
+
+    deduplicator.start_video()
+    assert deduplicator.check(a) is None
+    report = deduplicator.report
+    assert (report.frames, report.skipped, report.referenced) == (5, 0, 1)
+
+
+def test_database_scope():
+    hashes = random_hashes(100)
+    existing = pack_hashes(np.array([h.hash for h in hashes]))
+    deduplicator = Deduplicator(
+        DedupeOptions(DedupeScope.DATABASE, 3, DedupeAction.SKIP), existing
+    )
+    assert deduplicator.check(flipped(hashes[42], 2)) == DedupeAction.SKIP
+    [new] = random_hashes(1, seed=1)
+    assert deduplicator.check(new) is None
+    # Frames indexed before count as well, across videos
+    deduplicator.start_video()
+    assert deduplicator.check_database(new) == DedupeAction.SKIP
+    assert deduplicator.report.skipped == 2
+
+
+@pytest.mark.parametrize("radius", [2, 12])
+def test_near_duplicates(monkeypatch, radius: int):
+    # Past PENDING_SIZE hashes are looked up in the multi-index, or scanned for
+    # radii it can't answer
+    monkeypatch.setattr(dedupe, "PENDING_SIZE", 8)
+    hashes = random_hashes(50)
+    near = NearDuplicates(radius)
+    for h in hashes:
+        near.add(pack_hash(h))
+    for h in hashes:
+        assert near.contains(pack_hash(flipped(h, radius)))
+    far = [h for h in random_hashes(50, seed=1) if min(h - o for o in hashes) > radius]
+    assert far
+    assert not any(near.contains(pack_hash(h)) for h in far)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_index_copies(tmp_path: Path, videos: list[Path], jobs: int):
+    copy = videos[0].with_name("copy.mp4")
+    shutil.copy(videos[0], copy)
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        report = index_videos(
+            [videos[0], copy],
+            storage,
+            jobs=jobs,
+            dedupe=DedupeOptions(DedupeScope.DATABASE, 0),
+        )
+
+    with open_storage(db) as storage:
+        records = list(storage)
+        entries = storage.videos()
+    originals = [r for r in records if Path(r.path) == videos[0]]
+    copies = [r for r in records if Path(r.path) == copy]
+    # Every frame of the copy is stored, without a thumbnail
+    assert len(copies) == len(originals) == entries[str(copy)].frames
+    assert all(len(r.frame_data) == 0 for r in copies)
+    assert all(len(r.frame_data) > 0 for r in originals)
+    assert report.referenced == len(copies)
@@ -0,0 +1,113 @@
+import numpy as np
+
+from tests.helpers import fill, make_legacy
+from video_search.hash import pack_hash
+from video_search.index import build_index, index_path
+from video_search.search import nearest
+from video_search.storage import open_storage
+
+
+def test_index_matches_exhaustive_search(tmp_path):
+    db = tmp_path / "data.db"
+    with open_storage(db) as storage:
+        hashes = fill(storage, 2000)
+    with open_storage(db) as storage:
+        storage.index = build_index(storage)
+    assert index_path(db).exists()
+
+    with open_storage(db) as storage:
+        assert storage.index is not None and len(storage.index) == 2000
+        table = storage.hash_table()
+        for h in hashes[:20]:
+            offsets, distances = storage.index.search(pack_hash(h), 1, 0)
+            assert distances[0] == 0
+            assert storage.read_record(int(offsets[0])).hash == h
+        [(offsets, _)] = nearest(storage, pack_hash(hashes[5])[np.newaxis], 1, 0)
+        assert offsets[0] == table.offsets[5]
+
+
+def test_index_picks_up_appended_records(tmp_path):
+    db = tmp_path / "data.db"
+    with open_storage(db) as storage:
+        fill(storage, 500)
+        storage.index = build_index(storage)
+    with open_storage(db) as storage:
+        added = fill(storage, 10, seed=1, prefix="/new/")
+    with open_storage(db) as storage:
+        assert len(storage.index) == 510
+        offsets, _ = storage.index.search(pack_hash(added[3]), 1, 0)
+        assert str(storage.read_record(int(offsets[0])).path) == "/new/0.mp4"
+
+
+def test_migrate_rebuilds_index(tmp_path, cli):
+    db = tmp_path / "data.db"
+    hashes = make_legacy(db, 3000)
+    assert cli(db, "build-index").exit_code == 0
+    assert cli(db, "migrate").exit_code == 0
+
+    with open_storage(db) as storage:
+        table = storage.hash_table()
+        assert len(storage.index) == len(table) == 3000
+        for i in (0, 1234, 2999):
+            [(offsets, distances)] = nearest(
+                storage, pack_hash(hashes[i])[np.newaxis], 1, 0
+            )
+            assert distances[0] == 0
+            assert storage.read_record(int(offsets[0])).hash == hashes[i]
+
+
+def test_replaced_database_rebuilds_index(tmp_path):
+    # A stale index next to a different, larger database is not reused
+    db = tmp_path / "data.db"
+    other = tmp_path / "other.db"
+    with open_storage(db) as storage:
+        fill(storage, 100)
+        storage.index = build_index(storage)
+    with open_storage(other) as storage:
+        hashes = fill(storage, 300, seed=2, frame_data=b"x" * 100)
+    other.replace(db)
+
+    with open_storage(db) as storage:
+        assert len(storage.index) == 300
+        offsets, _ = storage.index.search(pack_hash(hashes[42]), 1, 0)
+        assert storage.read_record(int(offsets[0])).hash == hashes[42]
+
+
+def dead_hits(db, hashes) -> int:
+    with open_storage(db) as storage:
+        assert storage.index is not None
+        return sum(
+            len(storage.index.search(pack_hash(h), 1, 0)[0]) for h in hashes[:20]
+        )
+
+
+def test_stale_index_drops_superseded_records(tmp_path):
+    # Another writer re-indexed and removed videos after the index was saved
+    db = tmp_path / "data.db"
+    with open_storage(db) as storage:
+        old = fill(storage, 300)
+        storage.index = build_index(storage)
+    saved = index_path(db).read_bytes()
+    with open_storage(db) as storage:
+        fill(storage, 100, seed=1)
+        storage.remove_video("/videos/1.mp4")
+    index_path(db).write_bytes(saved)
+
+    assert dead_hits(db, old[:100]) == dead_hits(db, old[100:200]) == 0
+    assert dead_hits(db, old[200:]) == 20
+
+
+def test_last_writer_keeps_discards(tmp_path):
+    db = tmp_path / "data.db"
+    with open_storage(db) as storage:
+        old = fill(storage, 200)
+        storage.index = build_index(storage)
+
+    with open_storage(db) as first:
+        fill(first, 100, seed=1, prefix="/first/")
+        with open_storage(db) as second:
+            fill(second, 100, seed=2)
+        # The first writer saves its index last
+    assert dead_hits(db, old[:100]) == 0
+    with open_storage(db) as storage:
+        assert len(storage.index) == len(storage.hash_table()) == 300
@@ -0,0 +1,119 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from video_search import indexer
+from video_search.indexer import index_videos, videos_to_index
+from video_search.storage import VideoStatus, open_storage
+
+
+def index(db: Path, paths: list[Path], **kwargs) -> list[tuple]:
+    with open_storage(db) as storage:
+        index_videos(paths, storage, **kwargs)
+    with open_storage(db) as storage:
+        return [
+            (str(record.path), record.time, bytes(record.frame_data), str(record.hash))
+            for record in storage
+        ]
+
+
+def test_index(tmp_path: Path, videos: list[Path]):
+    db = tmp_path / "hashes.db"
+    records = index(db, videos)
+    assert {path for path, *_ in records} == {str(path) for path in videos}
+
+    with open_storage(db) as storage:
+        entries = storage.videos()
+        assert all(entries[str(path)].status == VideoStatus.COMPLETE for path in videos)
+        assert sum(entries[str(path)].frames for path in videos) == len(records)
+        assert videos_to_index(videos, storage) == []
+
+
+def test_jobs(tmp_path: Path, videos: list[Path], monkeypatch):
+    # Records stream back from the worker processes in several batches per
+    # video, the database is the same as when indexing in this process
+    monkeypatch.setattr(indexer, "RESULT_BATCH", 5)
+    monkeypatch.setattr(indexer, "RESULT_QUEUE", 1)
+    expected = index(tmp_path / "sequential.db", videos)
+    assert index(tmp_path / "jobs.db", videos, jobs=2) == expected
+    assert index(tmp_path / "workers.db", videos, jobs=2, workers=2) == expected
+
+
+def test_jobs_failure(tmp_path: Path, videos: list[Path]):
+    broken = tmp_path / "videos" / "broken.mp4"
+    broken.write_bytes(b"not a video")
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage, pytest.raises(ValueError):
+        index_videos([videos[0], broken, videos[1]], storage, jobs=2)
+
+    with open_storage(db) as storage:
+        entries = storage.videos()
+        assert entries[str(videos[0])].status == VideoStatus.COMPLETE
+        assert entries[str(broken)].status == VideoStatus.INCOMPLETE
+        assert str(videos[1]) not in entries
+        assert videos_to_index(videos, storage) == videos[1:]
+
+
+def test_cli_jobs(tmp_path: Path, videos: list[Path], cli):
+    directory = str(videos[0].parent)
+    sequential = tmp_path / "sequential.db"
+    parallel = tmp_path / "parallel.db"
+    assert cli(sequential, "index", directory).exit_code == 0
+    result = cli(parallel, "index", directory, "--jobs", "2")
+    assert result.exit_code == 0, result.output
+
+    with open_storage(sequential) as a, open_storage(parallel) as b:
+        assert sorted(
+            (str(r.path), r.time, str(r.hash), bytes(r.frame_data)) for r in a
+        ) == sorted((str(r.path), r.time, str(r.hash), bytes(r.frame_data)) for r in b)
+        assert a.videos().keys() == b.videos().keys()
+
+
+def test_callbacks(tmp_path: Path, videos: list[Path]):
+    progress: dict[Path, float] = {}
+    files: list[Path] = []
+
+    def cb(path: Path, start: float, end: float):
+        assert start <= end
+        progress[path] = end
+
+    with open_storage(tmp_path / "hashes.db") as storage:
+        index_videos(
+            videos, storage, jobs=2, progress_callback=cb, file_callback=files.append
+        )
+    assert files == videos
+    assert progress.keys() == set(videos)
+    assert all(end > 0 for end in progress.values())
+
+
+def test_incremental(tmp_path: Path, videos: list[Path], cli):
+    db = tmp_path / "hashes.db"
+    directory = str(videos[0].parent)
+    assert cli(db, "index", directory).exit_code == 0
+    with open_storage(db) as storage:
+        before = storage.videos()
+        records = len(storage.hash_table())
+
+    result = cli(db, "index", directory)
+    assert "Skipping 3 already indexed" in result.output
+    with open_storage(db) as storage:
+        assert len(storage.hash_table()) == records
+
+    # A changed video is indexed again and its old records are superseded
+    shutil.copy(videos[1], videos[0])
+    with open_storage(db) as storage:
+        assert videos_to_index(videos, storage) == [videos[0]]
+    assert cli(db, "index", directory).exit_code == 0
+    with open_storage(db) as storage:
+        after = storage.videos()
+        assert len(storage.hash_table()) == records - before[str(videos[0])].frames + (
+            after[str(videos[0])].frames
+        )
+        assert after[str(videos[0])].first > before[str(videos[2])].last
+        assert after[str(videos[1])] == before[str(videos[1])]
+        hashes = {path: [] for path in videos}
+        for record in storage:
+            hashes[Path(record.path)].append(str(record.hash))
+    assert hashes[videos[0]]
+    assert sorted(hashes[videos[0]]) == sorted(hashes[videos[1]])
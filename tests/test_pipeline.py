@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+
+from video_search.pipeline import PIPELINE_DEPTH, FramePool
+
+
+def slow_square(x: int) -> int:
+    # Later items finish first, results still come back in order
+    time.sleep(0.01 * (5 - x % 5))
+    return x * x
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_map_in_order(workers: int):
+    with FramePool(workers) as pool:
+        assert pool.parallel == (workers > 1)
+        assert list(pool.map(slow_square, range(20))) == [x * x for x in range(20)]
+
+
+def test_map_bounded():
+    taken = []
+
+    def items():
+        for i in range(100):
+            taken.append(i)
+            yield i
+
+    with FramePool(2) as pool:
+        results = pool.map(lambda x: x, items())
+        assert next(results) == 0
+        # Items are only taken as results are
+        assert len(taken) <= pool.depth
+        results.close()
+
+
+def test_produce_errors():
+    def items():
+        yield 1
+        yield 2
+        raise ValueError("decode failed")
+
+    with FramePool(2) as pool:
+        produced = []
+        with pytest.raises(ValueError, match="decode failed"):
+            produced.extend(pool.produce(items()))
+        assert produced == [1, 2]
+
+
+def test_produce_stops():
+    taken = []
+
+    def items():
+        for i in range(1000):
+            taken.append(i)
+            yield i
+
+    with FramePool(2) as pool:
+        produced = pool.produce(items())
+        assert next(produced) == 0
+        time.sleep(0.3)
+        # The producer is at most PIPELINE_DEPTH items ahead, and stops when
+        # the iterator is closed
+        assert len(taken) <= PIPELINE_DEPTH + 2
+        produced.close()
+    assert not any(t.name == "decode" for t in threading.enumerate())
+
+
+def test_sequential():
+    thread = threading.current_thread()
+    with FramePool(1) as pool:
+        threads = list(
+            pool.map(lambda _: threading.current_thread(), pool.produce(range(3)))
+        )
+    assert threads == [thread] * 3
@@ -0,0 +1,66 @@
+import json
+from pathlib import Path
+
+from PIL import Image
+
+from tests.helpers import fill
+from video_search.indexer import index_videos
+from video_search.profiling import Profiler
+from video_search.search import search_similar
+from video_search.storage import open_storage
+
+
+def test_stages():
+    profiler = Profiler(trace=True)
+    with profiler.stage("work", items=3, bytes=10):
+        pass
+    assert list(profiler.timed("produce", range(4))) == [0, 1, 2, 3]
+    profiler.count("things", 2)
+
+    other = Profiler()
+    other.add("work", 1.0, 2, 5)
+    other.count("things")
+    profiler.merge(other)
+
+    assert profiler.stages["work"].items == 5
+    assert profiler.stages["work"].bytes == 15
+    assert profiler.stages["work"].seconds >= 1.0
+    assert profiler.stages["produce"].items == 4
+    assert profiler.counters == {"things": 3}
+    # Only spans timed with a start are traced
+    assert [event["name"] for event in profiler.events] == ["work"] + ["produce"] * 5
+
+
+def test_index_and_search(tmp_path: Path, videos: list[Path]):
+    db = tmp_path / "hashes.db"
+    profiler = Profiler()
+    with open_storage(db) as storage:
+        index_videos(videos, storage, jobs=2, profiler=profiler)
+    assert {"decode", "scale", "hash", "thumbnail", "encode", "write", "commit"} <= (
+        profiler.stages.keys()
+    )
+    assert profiler.counters["frames_decoded"] == 3 * 48
+    assert profiler.counters["frames_kept"] == profiler.stages["write"].items
+
+    profiler = Profiler()
+    with open_storage(db) as storage:
+        fill(storage, 100, prefix="/more/")
+        search_similar(Image.new("RGB", (64, 64)), storage, profiler=profiler)
+        assert profiler.counters["records_scanned"] == len(storage.hash_table())
+    assert {"query_hash", "distance", "select", "read_records"} <= (
+        profiler.stages.keys()
+    )
+
+
+def test_cli_trace(tmp_path: Path, videos: list[Path], cli):
+    db = tmp_path / "hashes.db"
+    trace = tmp_path / "trace.json"
+    result = cli(db, "index", str(videos[0].parent), "--stats", "--trace", str(trace))
+    assert result.exit_code == 0, result.output
+    assert "decode" in result.output
+
+    with open(trace) as f:
+        data = json.load(f)
+    names = {event["name"] for event in data["traceEvents"]}
+    assert {"decode", "hash", "write"} <= names
+    assert data["otherData"]["counters"]["frames_decoded"] == 3 * 48
@@ -0,0 +1,217 @@
+import csv
+from pathlib import Path
+
+import numpy as np
+import pytest
+from imagehash import phash
+from PIL import Image
+
+from tests.helpers import fill, make_legacy, random_hashes
+from video_search import search
+from video_search import storage as storage_module
+from video_search.hash import (
+    HashKind,
+    hamming_distances,
+    pack_hash,
+    pack_hashes,
+    unpack_hash,
+)
+from video_search.indexer import index_videos
+from video_search.search import iter_search, search_many, search_similar, top_n_indices
+from video_search.storage import open_storage, throttle
+
+IMAGE = Image.new("RGB", (8, 8))
+
+
+def test_hamming_distances():
+    hashes = random_hashes(200)
+    packed = pack_hashes(np.array([h.hash for h in hashes]))
+    assert packed.dtype == np.uint64
+    assert packed.shape == (200, 1)
+    for query in hashes[:5]:
+        expected = [h - query for h in hashes]
+        assert hamming_distances(packed, pack_hash(query)).tolist() == expected
+    assert unpack_hash(packed[3], (8, 8)) == hashes[3]
+
+
+def test_top_n_indices():
+    distances = np.array([5, 1, 3, 1, 0, 3])
+    # Ties in record order
+    assert top_n_indices(distances, 4).tolist() == [4, 1, 3, 2]
+    assert top_n_indices(distances, 10).tolist() == [4, 1, 3, 2, 5, 0]
+    assert top_n_indices(distances, 0).tolist() == []
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_search_similar(tmp_path: Path, legacy: bool):
+    db = tmp_path / "hashes.db"
+    if legacy:
+        hashes = make_legacy(db, 1000)
+    else:
+        with open_storage(db) as storage:
+            hashes = fill(storage, 1000)
+
+    query = hashes[123]
+    expected = sorted(range(len(hashes)), key=lambda i: (hashes[i] - query, i))
+    with open_storage(db) as storage:
+        results = search_similar(
+            IMAGE, storage, hash_algorithm=lambda image: query, top_n=10
+        )
+        assert [r.match.hash for r in results] == [hashes[i] for i in expected[:10]]
+        assert results[0].similarity == 1.0
+        assert str(results[0].match.path) == "/videos/1.mp4"
+        assert results[0].match.time == 23.0
+
+        close = search_similar(
+            IMAGE, storage, hash_algorithm=lambda image: query, max_distance=20
+        )
+        assert close
+        assert all(r.match.hash - query <= 20 for r in close)
+
+
+def test_search_many(tmp_path: Path):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        hashes = fill(storage, 1000)
+    queries = [hashes[5], hashes[500], random_hashes(1, seed=9)[0]]
+    images = [Image.new("RGB", (8, 8), i) for i in range(len(queries))]
+
+    def by_image(image: Image.Image):
+        return queries[image.getpixel((0, 0))[0]]
+
+    with open_storage(db) as storage:
+        many = search_many(images, storage, hash_algorithm=by_image, top_n=5)
+        single = [
+            search_similar(image, storage, hash_algorithm=by_image, top_n=5)
+            for image in images
+        ]
+    assert len(many) == len(images)
+    for a, b in zip(many, single, strict=True):
+        assert [r.match.hash for r in a] == [r.match.hash for r in b]
+        assert [r.similarity for r in a] == [r.similarity for r in b]
+
+
+def test_cli_search_directory(tmp_path: Path, cli):
+    db = tmp_path / "hashes.db"
+    directory = tmp_path / "queries"
+    directory.mkdir()
+    with open_storage(db) as storage:
+        for i in range(3):
+            image = Image.new("RGB", (64, 64), (80 * i, 40, 200 - 60 * i))
+            image.paste((255, 255, 255), (0, 0, 16 + 10 * i, 32))
+            image.save(directory / f"{i}.png")
+            storage.append_record(b"", phash(image), Path(f"/videos/{i}.mp4"), 1.0)
+    (directory / "notes.txt").write_text("not an image")
+
+    output = tmp_path / "results.csv"
+    result = cli(db, "search", str(directory), "--output", str(output))
+    assert result.exit_code == 0, result.output
+    with open(output, newline="") as f:
+        rows = list(csv.DictReader(f))
+    exact = {
+        (Path(row["query"]).stem, Path(row["path"]).stem)
+        for row in rows
+        if float(row["similarity"]) == 1.0
+    }
+    assert exact == {("0", "0"), ("1", "1"), ("2", "2")}
+
+
+@pytest.mark.parametrize("kind", list(HashKind))
+def test_refine(tmp_path: Path, kind: HashKind):
+    # Both records have the query's phash, only one has its finer hash
+    query = Image.fromarray(
+        np.random.default_rng(0).integers(0, 255, (64, 64, 3), dtype=np.uint8)
+    )
+    # Every bit flipped
+    other = unpack_hash(~pack_hash(kind.compute(query)), kind.shape)
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        fill(storage, 200)
+        storage.append_record(b"", phash(query), Path("/other.mp4"), 0.0, {kind: other})
+        storage.append_record(
+            b"", phash(query), Path("/match.mp4"), 0.0, {kind: kind.compute(query)}
+        )
+
+    with open_storage(db) as storage:
+        [coarse, refined] = [
+            search_similar(query, storage, top_n=2, refine=refine)
+            for refine in (None, kind)
+        ]
+        offsets = storage.hash_table().offsets
+        _, present = storage.extra_hashes(kind, offsets)
+    assert present.tolist() == [False] * 200 + [True, True]
+    assert [str(r.match.path) for r in coarse] == ["/other.mp4", "/match.mp4"]
+    # The other one falls behind records without the finer hash
+    assert str(refined[0].match.path) == "/match.mp4"
+    assert refined[0].similarity == 1.0
+    assert "/other.mp4" not in [str(r.match.path) for r in refined]
+
+
+def test_index_extra_hashes(tmp_path: Path, videos: list[Path]):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        index_videos(videos[:1], storage, extra_hashes=(HashKind.DHASH,))
+    with open_storage(db) as storage:
+        _, present = storage.extra_hashes(HashKind.DHASH, storage.hash_table().offsets)
+        assert len(present) and present.all()
+        _, present = storage.extra_hashes(HashKind.WHASH, storage.hash_table().offsets)
+        assert not present.any()
+
+
+def test_iter_search(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(search, "STREAM_CHUNK", 100)
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        hashes = fill(storage, 1000)
+    query = hashes[750]
+
+    def by_image(image):
+        return query
+
+    with open_storage(db) as storage:
+        snapshots = list(
+            iter_search(IMAGE, storage, hash_algorithm=by_image, top_n=5, interval=0)
+        )
+        expected = search_similar(IMAGE, storage, hash_algorithm=by_image, top_n=5)
+    assert len(snapshots) > 1
+    assert [s.scanned for s in snapshots] == sorted(s.scanned for s in snapshots)
+    assert [s.done for s in snapshots] == [False] * (len(snapshots) - 1) + [True]
+    assert snapshots[-1].scanned == snapshots[-1].total == 1000
+    assert [r.match.hash for r in snapshots[-1].results] == [
+        r.match.hash for r in expected
+    ]
+
+    with open_storage(db) as storage:
+        # Stops at the chunk with the exact match
+        [early] = iter_search(
+            IMAGE, storage, hash_algorithm=by_image, stop_after_exact=1
+        )
+        assert early.done
+        assert early.scanned == 800
+        assert early.results[0].similarity == 1.0
+
+        seen = []
+        seen.extend(
+            iter_search(
+                IMAGE,
+                storage,
+                hash_algorithm=by_image,
+                interval=0,
+                cancelled=lambda: len(seen) >= 2,
+            )
+        )
+        assert len(seen) == 2
+        assert not seen[-1].done
+
+
+def test_throttle(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(storage_module.time, "monotonic", lambda: now[0])
+    calls = []
+    throttled = throttle(lambda current, total: calls.append(current), 1.0)
+    for i in range(10):
+        now[0] = 10 + i * 0.3
+        throttled(i, 10)
+    throttled(10, 10)
+    # At most one call a second, and always the last one
+    assert calls == [0, 4, 8, 10]
@@ -0,0 +1,184 @@
+import http.client
+import json
+import threading
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pytest
+from imagehash import phash
+from PIL import Image
+
+import video_search.server as server_module
+from tests.helpers import fill
+from video_search.columnar import ColumnarHashStorage
+from video_search.index import build_index, index_path
+from video_search.server import SearchHTTPServer, SearchService
+from video_search.storage import ManifestEntry, VideoStatus, open_storage
+
+
+def image_bytes() -> bytes:
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 255, (64, 64, 3), dtype=np.uint8))
+    buffer = BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def server(tmp_path: Path):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        fill(storage, 500)
+    service = SearchService(db)
+    server = SearchHTTPServer(("127.0.0.1", 0), service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def post(server, body: bytes, headers: dict[str, str] | None = None):
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.putrequest("POST", "/search?top_n=5")
+    for key, value in (headers or {"Content-Length": str(len(body))}).items():
+        connection.putheader(key, value)
+    connection.endheaders()
+    connection.send(body)
+    response = connection.getresponse()
+    data = json.loads(response.read())
+    connection.close()
+    return response.status, data
+
+
+def test_search(server):
+    status, data = post(server, image_bytes())
+    assert status == 200
+    assert len(data["results"]) == 5
+
+
+def test_not_an_image(server):
+    status, data = post(server, b"not an image")
+    assert status == 400
+    assert "error" in data
+
+
+def test_truncated_image(server):
+    status, data = post(server, image_bytes()[:200])
+    assert status == 400
+    assert "error" in data
+
+
+def test_invalid_content_length(server):
+    status, data = post(server, b"", {"Content-Length": "many"})
+    assert status == 400
+    assert "error" in data
+
+
+def test_reload_appended(tmp_path: Path):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        fill(storage, 200)
+    service = SearchService(db)
+    try:
+        service.search(image_bytes())
+        assert service.stats()["records"] == 200
+
+        with open_storage(db) as storage:
+            fill(storage, 100, seed=1, prefix="/more/")
+        service.search(image_bytes())
+        assert service.stats()["records"] == 300
+    finally:
+        service.close()
+
+
+def test_reload_catalog(tmp_path: Path):
+    # Records are appended to a shard, the catalog file stays the same
+    db = tmp_path / "hashes.catalog"
+    with open_storage(db) as storage:
+        fill(storage, 200)
+    service = SearchService(db)
+    try:
+        service.search(image_bytes())
+        assert service.stats()["records"] == 200
+
+        catalog = db.read_bytes()
+        with open_storage(db) as storage:
+            fill(storage, 100, seed=1, prefix="/more/")
+        assert db.read_bytes() == catalog
+        service.search(image_bytes())
+        assert service.stats()["records"] == 300
+    finally:
+        service.close()
+
+
+def test_reload_reindexed(tmp_path: Path):
+    # The frame the query was taken from is replaced by another process
+    db = tmp_path / "hashes.db"
+    query = phash(Image.open(BytesIO(image_bytes())))
+    video = "/videos/query.mp4"
+
+    def index_video(time: float):
+        with open_storage(db) as storage:
+            storage.append_record(b"", query, video, time)
+            storage.commit_video(
+                ManifestEntry(video, -1, -1.0, 10.0, 1, VideoStatus.COMPLETE)
+            )
+
+    with open_storage(db) as storage:
+        fill(storage, 500)
+    index_video(1.0)
+    with open_storage(db) as storage:
+        storage.index = build_index(storage)
+
+    service = SearchService(db)
+    try:
+        [result] = service.search(image_bytes(), top_n=1)
+        assert result.match.time == 1.0
+        index_video(2.0)
+        saved = index_path(db).read_bytes()
+        results = service.search(image_bytes(), top_n=5, max_distance=4)
+        assert [r.match.time for r in results if str(r.match.path) == video] == [2.0]
+    finally:
+        service.close()
+    # The server never writes the index
+    assert index_path(db).read_bytes() == saved
+
+
+def test_reload_reads_tail(tmp_path: Path, monkeypatch):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        old = fill(storage, 300)[:100]
+    service = SearchService(db)
+    try:
+        catalogs = []
+        monkeypatch.setattr(
+            server_module, "is_catalog", lambda path: catalogs.append(path)
+        )
+        service.search(image_bytes())
+        assert catalogs == []
+
+        with open_storage(db) as storage:
+            fill(storage, 100, seed=1)
+            fill(storage, 100, seed=2, prefix="/more/")
+        reads = []
+        hash_table = ColumnarHashStorage.hash_table
+
+        def read(self, progress_callback=None, after=-1):
+            reads.append(after)
+            return hash_table(self, progress_callback, after)
+
+        monkeypatch.setattr(ColumnarHashStorage, "hash_table", read)
+        service.search(image_bytes())
+        assert len(catalogs) == 1
+        assert reads and -1 not in reads
+        # Video 0 was re-indexed, its old records are gone from the table
+        assert service.stats()["records"] == 400
+        assert not any(
+            str(r.match.path) == "/videos/0.mp4" and r.match.hash in old
+            for r in service.search(image_bytes(), top_n=400)
+        )
+    finally:
+        service.close()
@@ -0,0 +1,124 @@
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import video_search.storage as storage_module
+from tests.helpers import fill
+from video_search.hash import pack_hashes
+from video_search.search import search_similar
+from video_search.shards import (
+    SHARD_SHIFT,
+    Catalog,
+    ShardedStorage,
+    ShardSplit,
+    open_catalog,
+)
+from video_search.storage import open_storage
+
+IMAGE = Image.new("RGB", (8, 8))
+
+
+def test_split_by_size(tmp_path: Path):
+    # Every video starts a new shard once the last one has any records
+    catalog = tmp_path / "hashes.catalog"
+    Catalog(catalog, ShardSplit.SIZE, 1).save()
+    single = tmp_path / "single.db"
+    with open_storage(catalog) as sharded, open_storage(single) as storage:
+        assert isinstance(sharded, ShardedStorage)
+        hashes = fill(sharded, 500)
+        fill(storage, 500)
+
+    loaded = Catalog.load(catalog)
+    assert len(loaded.shards) == 5
+    assert all(loaded.shard_path(i).exists() for i in range(5))
+
+    query = hashes[321]
+    with open_storage(catalog) as sharded, open_storage(single) as storage:
+        table = sharded.hash_table()
+        assert len(table) == 500
+        assert sorted(set((table.offsets >> SHARD_SHIFT).tolist())) == list(range(5))
+        [a, b] = [
+            search_similar(IMAGE, s, hash_algorithm=lambda image: query, top_n=20)
+            for s in (sharded, storage)
+        ]
+    assert [(str(r.match.path), r.match.time) for r in a] == [
+        (str(r.match.path), r.match.time) for r in b
+    ]
+    assert str(a[0].match.path) == "/videos/3.mp4"
+
+
+def test_split_by_directory(tmp_path: Path):
+    catalog = tmp_path / "hashes.catalog"
+    Catalog(catalog, ShardSplit.DIRECTORY).save()
+    with open_storage(catalog) as sharded:
+        fill(sharded, 200, prefix="/a/")
+        fill(sharded, 200, prefix="/b/", seed=1)
+        fill(sharded, 100, prefix="/a/more-", seed=2)
+
+    loaded = Catalog.load(catalog)
+    assert loaded.directories == {"/a": 0, "/b": 1}
+    with open_storage(loaded.shard_path(0)) as shard:
+        assert sorted(shard.videos()) == [
+            "/a/0.mp4",
+            "/a/1.mp4",
+            "/a/more-0.mp4",
+        ]
+
+
+def test_reindex_same_shard(tmp_path: Path):
+    catalog = tmp_path / "hashes.catalog"
+    Catalog(catalog, ShardSplit.SIZE, 1).save()
+    with open_storage(catalog) as sharded:
+        fill(sharded, 300)
+    with open_catalog(catalog) as sharded:
+        fill(sharded, 100, seed=1)
+        # The first video was written to the first shard again
+        with open_storage(Catalog.load(catalog).shard_path(0)) as shard:
+            assert len(shard.hash_table()) == 100
+        assert len(sharded.catalog.shards) == 3
+        assert len(sharded.hash_table()) == 300
+
+
+def test_create_catalog(tmp_path: Path, cli):
+    existing = tmp_path / "existing.db"
+    with open_storage(existing) as storage:
+        fill(storage, 100)
+    catalog = tmp_path / "hashes.catalog"
+
+    result = cli(catalog, "create-catalog", str(existing), "--shard-size", "1")
+    assert result.exit_code == 0, result.output
+    with open_storage(catalog) as sharded:
+        assert sorted(sharded.videos()) == ["/videos/0.mp4"]
+        assert len(sharded.hash_table()) == 100
+
+    assert cli(catalog, "create-catalog").exit_code == 1
+
+
+def test_parallel_search_keeps_shards_open(tmp_path: Path, monkeypatch):
+    catalog = tmp_path / "hashes.catalog"
+    Catalog(catalog, ShardSplit.SIZE, 1).save()
+    with open_storage(catalog) as sharded:
+        hashes = fill(sharded, 500)
+    queries = pack_hashes(np.array([h.hash for h in hashes[::50]]))
+
+    opened = []
+    open_shard = storage_module.open_storage
+
+    def counting(path, *args):
+        opened.append(path)
+        return open_shard(path, *args)
+
+    monkeypatch.setattr(storage_module, "open_storage", counting)
+    with open_catalog(catalog, jobs=4) as parallel, open_catalog(catalog, 1) as single:
+        for _ in range(3):
+            found = parallel.nearest(queries, 5)
+            expected = single.nearest(queries, 5)
+            for (offsets, distances), (e_offsets, e_distances) in zip(
+                found, expected, strict=True
+            ):
+                assert offsets.tolist() == e_offsets.tolist()
+                assert distances.tolist() == e_distances.tolist()
+            assert found[0][1][0] == 0
+    # Each catalog opened every shard once
+    assert len(opened) == 2 * 5
@@ -0,0 +1,38 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+from imagehash import phash
+from PIL import Image
+
+from video_search.hash import phash_image
+
+HEAVY_MODULES = ["av", "scipy", "rich_pixels", "PyQt6", "video_search.server"]
+
+
+def test_lazy_imports():
+    code = (
+        "import sys, video_search.cli.main; "
+        f"print([m for m in {HEAVY_MODULES!r} if m in sys.modules])"
+    )
+    done = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(__file__).parent.parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert done.stdout.strip() == "[]"
+
+
+def test_phash_image():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        size = tuple(rng.integers(16, 200, 2))
+        image = Image.fromarray(rng.integers(0, 255, (*size, 3), dtype=np.uint8))
+        assert phash_image(image) == phash(image)
+    # Flat images have every coefficient at the median
+    assert phash_image(Image.new("RGB", (64, 64), "gray")) == phash(
+        Image.new("RGB", (64, 64), "gray")
+    )
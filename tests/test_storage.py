@@ -0,0 +1,217 @@
+import mmap
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tests.helpers import fill, make_legacy, random_hashes
+from video_search.columnar import ColumnarHashStorage
+from video_search.hash import encode_record
+from video_search.storage import (
+    LazyVideoFrameHash,
+    LegacyHashStorage,
+    ManifestEntry,
+    SyncPolicy,
+    VideoStatus,
+    WriteOptions,
+    detect_format,
+    open_storage,
+)
+
+
+def records(db: Path) -> list[tuple]:
+    with open_storage(db) as storage:
+        return [
+            (str(r.hash), str(r.path), r.time, bytes(r.frame_data)) for r in storage
+        ]
+
+
+def test_columnar(tmp_path: Path):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        assert isinstance(storage, ColumnarHashStorage)
+        hashes = fill(storage, 250, frame_data=b"thumbnail")
+
+    with open(db, "rb") as f:
+        assert detect_format(f) == 2
+    assert records(db) == [
+        (str(h), f"/videos/{i // 100}.mp4", float(i % 100), b"thumbnail")
+        for i, h in enumerate(hashes)
+    ]
+    with open_storage(db) as storage:
+        table = storage.hash_table()
+        assert table.hashes.shape == (250, 1)
+        assert str(storage.read_record(int(table.offsets[42])).hash) == str(hashes[42])
+
+
+def test_migrate(tmp_path: Path, cli):
+    db = tmp_path / "hashes.db"
+    make_legacy(db, 300)
+    expected = records(db)
+    with open_storage(db) as storage:
+        assert isinstance(storage, LegacyHashStorage)
+
+    result = cli(db, "migrate")
+    assert result.exit_code == 0, result.output
+    assert records(db) == expected
+    assert records(db.with_name("hashes.db.v1.bak")) == expected
+    with open_storage(db) as storage:
+        assert isinstance(storage, ColumnarHashStorage)
+
+    result = cli(db, "migrate")
+    assert "already in the current format" in " ".join(result.output.split())
+
+
+def test_write_options_not_shared(tmp_path: Path):
+    with open_storage(tmp_path / "a.db") as a, open_storage(tmp_path / "b.db") as b:
+        assert a.write_options is not b.write_options
+        a.write_options.sync = SyncPolicy.NEVER
+        assert b.write_options.sync == WriteOptions().sync
+
+    options = WriteOptions(batch_size=7)
+    with open_storage(tmp_path / "c.db", options) as c:
+        assert c.write_options is options
+
+
+def png(color: str) -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", (16, 9), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_lazy_records(tmp_path: Path, legacy: bool):
+    db = tmp_path / "hashes.db"
+    data = png("red")
+    if legacy:
+        with open(db, "ab+") as f:
+            storage = LegacyHashStorage(f)
+            fill(storage, 50, frame_data=data)
+            storage.flush()
+    else:
+        with open_storage(db) as storage:
+            fill(storage, 50, frame_data=data)
+
+    with open_storage(db) as storage:
+        records = list(storage)
+        # Thumbnails stay in the memory map until they are loaded
+        assert all(record.frame is None for record in records)
+        assert all(
+            isinstance(record._source, (mmap.mmap, np.memmap)) for record in records
+        )
+        assert bytes(records[7].frame_data) == data
+        image = records[7].load_image()
+        assert image.size == (16, 9)
+        assert image.getpixel((0, 0)) == (255, 0, 0)
+        assert records[8].frame is None
+
+
+def test_record_from_bytes():
+    [h] = random_hashes(1)
+    data = png("blue")
+    record = LazyVideoFrameHash.from_bytes(
+        encode_record(data, h, Path("/videos/a.mp4"), 1.5)
+    )
+    assert (record.hash, record.path, record.time) == (h, Path("/videos/a.mp4"), 1.5)
+    assert bytes(record.frame_data) == data
+    assert record.load_image().getpixel((0, 0)) == (0, 0, 255)
+
+
+def test_buffered_writes(tmp_path: Path):
+    db = tmp_path / "hashes.db"
+    with open_storage(db, WriteOptions(batch_size=100)) as storage:
+        [h] = random_hashes(1)
+        size = db.stat().st_size
+        for i in range(99):
+            storage.append_record(b"", h, Path("/videos/a.mp4"), float(i))
+        assert db.stat().st_size == size
+        storage.append_record(b"", h, Path("/videos/a.mp4"), 99.0)
+        assert db.stat().st_size > size
+        storage.append_record(b"", h, Path("/videos/a.mp4"), 100.0)
+    assert len(records(db)) == 101
+
+
+def test_interleaved_videos(tmp_path: Path):
+    # Every video's entry only covers its own records, whatever was written
+    # for other videos before it was committed
+    db = tmp_path / "hashes.db"
+    hashes = random_hashes(8)
+    with open_storage(db, WriteOptions(batch_size=3)) as storage:
+        for i, path in enumerate("abababcc"):
+            storage.append_record(b"", hashes[i], Path(f"/{path}.mp4"), float(i))
+        storage.remove_video("/c.mp4")
+        for path, frames in (("/a.mp4", 3), ("/b.mp4", 3)):
+            storage.commit_video(
+                ManifestEntry(path, -1, -1.0, 1.0, frames, VideoStatus.COMPLETE)
+            )
+
+    with open_storage(db) as storage:
+        videos = storage.videos()
+        a, b = storage.video_frames("/a.mp4"), storage.video_frames("/b.mp4")
+        assert a.times.tolist() == [0.0, 2.0, 4.0]
+        assert b.times.tolist() == [1.0, 3.0, 5.0]
+        assert (videos["/a.mp4"].first, videos["/a.mp4"].last) == (
+            a.offsets[0],
+            a.offsets[-1],
+        )
+        assert (videos["/b.mp4"].first, videos["/b.mp4"].last) == (
+            b.offsets[0],
+            b.offsets[-1],
+        )
+        assert len(storage.video_frames("/c.mp4").offsets) == 0
+        assert len(storage.hash_table()) == 6
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_torn_tail(tmp_path: Path, legacy: bool):
+    db = tmp_path / "hashes.db"
+    if legacy:
+        make_legacy(db, 300)
+    else:
+        with open_storage(db, WriteOptions(batch_size=50)) as storage:
+            fill(storage, 300)
+    expected = records(db)
+    size = db.stat().st_size
+
+    # A write that was cut short is ignored, and dropped once writing resumes
+    with open(db, "ab") as f:
+        f.write(b"\x17" * 37)
+    assert records(db) == expected
+    with open_storage(db) as storage:
+        fill(storage, 100, seed=1, prefix="/more/")
+    assert records(db)[:300] == expected
+    assert len(records(db)) == 400
+
+    # Records of blocks that were cut off are not read
+    with open(db, "r+b") as f:
+        f.truncate(size - 10)
+    torn = records(db)
+    assert torn == expected[: len(torn)]
+    with open_storage(db) as storage:
+        fill(storage, 100, seed=1, prefix="/more/")
+    assert len(records(db)) == len(torn) + 100
+
+
+def test_verify(tmp_path: Path, cli):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        fill(storage, 5, frame_data=b"first-frame")
+        fill(storage, 5, frame_data=b"other-frame", prefix="/more/")
+    with open_storage(db) as storage:
+        assert storage.verify() == (10, [])
+
+    data = bytearray(db.read_bytes())
+    start = data.index(b"other-frame")
+    data[start] ^= 1
+    db.write_bytes(bytes(data))
+    with open_storage(db) as storage:
+        checked, corrupt = storage.verify()
+        assert checked == 10
+        assert len(corrupt) == 1
+        assert str(storage.read_record(corrupt[0]).path) == "/more/0.mp4"
+
+    result = cli(db, "verify")
+    assert result.exit_code == 0, result.output
+    assert "1 corrupt" in result.output
@@ -0,0 +1,55 @@
+from pathlib import Path
+
+import pytest
+
+from video_search import thumbnails
+from video_search.hash import ThumbnailFormat, ThumbnailOptions
+from video_search.indexer import index_videos
+from video_search.storage import open_storage
+from video_search.thumbnails import ThumbnailCache
+
+SIGNATURES = {
+    ThumbnailFormat.PNG: b"\x89PNG",
+    ThumbnailFormat.JPEG: b"\xff\xd8",
+    ThumbnailFormat.WEBP: b"RIFF",
+}
+
+
+@pytest.fixture
+def cache(tmp_path: Path, monkeypatch) -> ThumbnailCache:
+    cache = ThumbnailCache(tmp_path / "cache")
+    monkeypatch.setattr(thumbnails, "default_cache", cache)
+    return cache
+
+
+@pytest.mark.parametrize("format", list(ThumbnailFormat))
+def test_formats(tmp_path: Path, videos: list[Path], cache, format):
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        index_videos(videos[:1], storage, thumbnails=ThumbnailOptions(format, 70))
+
+    with open_storage(db) as storage:
+        records = list(storage)
+        assert records
+        for record in records:
+            data = bytes(record.frame_data)
+            if format == ThumbnailFormat.NONE:
+                assert data == b""
+            else:
+                assert data.startswith(SIGNATURES[format])
+            assert record.load_image().size[1] > 0
+
+    # Frames without a thumbnail are decoded once, then read from the cache
+    cached = list(cache.directory.glob("*.png")) if cache.directory.exists() else []
+    assert len(cached) == (len(records) if format == ThumbnailFormat.NONE else 0)
+
+
+def test_cache_evicts(tmp_path: Path, videos: list[Path]):
+    cache = ThumbnailCache(tmp_path / "cache")
+    cache.load(videos[0], 0.0)
+    [first] = cache.directory.glob("*.png")
+    cache.max_bytes = first.stat().st_size * 3 // 2
+    cache.load(videos[0], 1.0)
+    # The least recently used frame makes room
+    [second] = cache.directory.glob("*.png")
+    assert second != first
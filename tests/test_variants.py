@@ -0,0 +1,100 @@
+import json
+from pathlib import Path
+
+import numpy as np
+from imagehash import phash
+from PIL import Image, ImageOps
+
+from tests.helpers import fill
+from video_search.search import search_many
+from video_search.storage import open_storage
+from video_search.variants import (
+    VariantMode,
+    VariantOptions,
+    letterbox,
+    query_variants,
+)
+
+
+def picture(seed: int = 0) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(40, 255, (8, 8, 3), dtype=np.uint8)
+    return Image.fromarray(np.kron(blocks, np.ones((30, 40, 1), np.uint8)))
+
+
+def letterboxed(image: Image.Image, bar: int = 60) -> Image.Image:
+    width, height = image.size
+    result = Image.new("RGB", (width, height + 2 * bar))
+    result.paste(image, (0, bar))
+    return result
+
+
+def test_letterbox():
+    image = picture()
+    assert letterbox(image) is None
+    assert letterbox(letterboxed(image)) == (0, 60, 320, 300)
+    # A dark picture is not a letterbox
+    assert letterbox(Image.new("RGB", (320, 240))) is None
+
+
+def test_query_variants():
+    image = letterboxed(picture())
+    assert [v.name for v in query_variants(image, None)] == ["original"]
+    names = [
+        v.name for v in query_variants(image, VariantOptions(VariantMode.LETTERBOX))
+    ]
+    assert names == ["original", "letterbox"]
+
+    variants = query_variants(image, VariantOptions(VariantMode.ALL))
+    assert len(variants) == 2 * (2 + len(VariantOptions().center_crops) + 2)
+    assert variants[-1].name.endswith("mirrored")
+    assert variants[1].image.size == (320, 240)
+
+
+def database(tmp_path: Path) -> Path:
+    db = tmp_path / "hashes.db"
+    with open_storage(db) as storage:
+        fill(storage, 500)
+        storage.append_record(b"", phash(picture()), Path("/match.mp4"), 5.0)
+    return db
+
+
+def test_search_letterboxed(tmp_path: Path):
+    db = database(tmp_path)
+    query = letterboxed(picture())
+    with open_storage(db) as storage:
+        [plain] = search_many([query], storage, top_n=1)
+        [found] = search_many(
+            [query], storage, top_n=1, variants=VariantOptions(VariantMode.LETTERBOX)
+        )
+    assert plain[0].variant is None
+    assert str(found[0].match.path) == "/match.mp4"
+    assert found[0].variant == "letterbox"
+    assert found[0].similarity == 1.0
+
+
+def test_search_mirrored(tmp_path: Path):
+    db = database(tmp_path)
+    query = ImageOps.mirror(picture())
+    with open_storage(db) as storage:
+        [found] = search_many(
+            [query], storage, top_n=1, variants=VariantOptions(VariantMode.ALL)
+        )
+    assert str(found[0].match.path) == "/match.mp4"
+    assert found[0].variant == "original mirrored"
+
+
+def test_cli_default(tmp_path: Path, cli):
+    db = database(tmp_path)
+    query = tmp_path / "query.png"
+    letterboxed(picture()).save(query)
+
+    result = cli(db, "search", str(query), "--json", "--threshold", "0")
+    assert result.exit_code == 0, result.output
+    rows = json.loads(result.output)
+    assert rows
+    assert {row["variant"] for row in rows} == {None}
+
+    result = cli(db, "search", str(query), "--json", "--variants", "letterbox")
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output)[0]["variant"] == "letterbox"
@@ -0,0 +1,88 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from imagehash import phash
+from PIL import Image
+
+from video_search.hash import phash_pixels
+from video_search.profiling import Profiler
+from video_search.video import (
+    DecodeMode,
+    DecodeOptions,
+    compare_decode_modes,
+    hash_video,
+)
+
+
+def frames(path: Path, options: DecodeOptions | None = None, **kwargs):
+    profiler = Profiler()
+    hashes = list(hash_video(path, options=options, profiler=profiler, **kwargs))
+    return [(h.time, str(h.hash)) for h in hashes], profiler.counters
+
+
+def test_decode_all(videos: list[Path]):
+    # Four one-second scenes at 12 frames a second
+    hashes, counters = frames(videos[0])
+    assert counters["frames_decoded"] == 48
+    assert counters["frames_kept"] == len(hashes)
+    assert {int(time) for time, _ in hashes} == {0, 1, 2, 3}
+    assert [time for time, _ in hashes] == sorted(time for time, _ in hashes)
+
+
+def test_decode_keyframes(videos: list[Path]):
+    hashes, counters = frames(videos[0], DecodeOptions(DecodeMode.KEYFRAMES))
+    assert 1 <= counters["frames_decoded"] < 48
+    assert set(hashes) <= set(frames(videos[0])[0])
+
+
+@pytest.mark.parametrize("rate", [1.0, 2.0])
+def test_decode_sample(videos: list[Path], rate: float):
+    hashes, counters = frames(videos[0], DecodeOptions(DecodeMode.SAMPLE, rate))
+    assert counters["frames_decoded"] == 4 * rate
+    # Every scene is sampled
+    assert {int(time) for time, _ in hashes} == {0, 1, 2, 3}
+
+
+def test_decode_threads(videos: list[Path]):
+    assert frames(videos[0], DecodeOptions(threads=True)) == frames(videos[0])
+
+
+def test_decode_report(videos: list[Path], cli, tmp_path: Path):
+    result = cli(tmp_path / "unused.db", "decode-report", str(videos[0]))
+    assert result.exit_code == 0, result.output
+    for mode in DecodeMode:
+        assert mode.value in result.output
+
+
+def test_compare_decode_modes(videos: list[Path]):
+    sample = DecodeOptions(DecodeMode.SAMPLE, 0.5)
+    [baseline, threads, sampled] = compare_decode_modes(
+        videos[0], [DecodeOptions(threads=True), sample]
+    )
+    assert baseline.recall == threads.recall == 1.0
+    assert threads.frames_kept == baseline.frames_kept
+    # Every other scene is sampled
+    assert sampled.frames_kept < baseline.frames_kept
+    assert 0.0 < sampled.recall < 1.0
+
+
+def test_phash_pixels():
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 255, (20, 32, 32), dtype=np.uint8)
+    bits = phash_pixels(pixels.astype(np.float64))
+    for frame, expected in zip(pixels, bits, strict=True):
+        assert (phash(Image.fromarray(frame)).hash == expected).all()
+
+
+def test_batched_hashes(videos: list[Path]):
+    # Frames are scaled by the decoder instead of PIL, the hashes of the same
+    # frame stay close and the same scenes are kept
+    batched = {h.time: h.hash for h in hash_video(videos[0])}
+    single = {
+        h.time: h.hash
+        for h in hash_video(videos[0], hash_algorithm=lambda image: phash(image))
+    }
+    assert {int(time) for time in batched} == {int(time) for time in single}
+    for time in batched.keys() & single.keys():
+        assert batched[time] - single[time] <= 6
@@ -0,0 +1,127 @@
+import shutil
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from video_search import indexer, watch
+from video_search.storage import VideoStatus, open_storage
+from video_search.watch import Debouncer, Watch, scan_videos
+
+
+def wait(condition: Callable[[], bool], timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+class Watching:
+    def __init__(self, directory: Path, db: Path, **kwargs):
+        self.stop = False
+        self.storage_context = open_storage(db)
+        storage = self.storage_context.__enter__()
+        self.watch = Watch(
+            [directory],
+            storage,
+            settle=0.2,
+            polling=True,
+            poll_interval=0.1,
+            stopped=lambda: self.stop,
+            **kwargs,
+        )
+        self.thread = threading.Thread(target=self.watch.run)
+
+    def __enter__(self) -> Watch:
+        self.thread.start()
+        return self.watch
+
+    def __exit__(self, *args):
+        self.stop = True
+        self.thread.join()
+        self.storage_context.__exit__(None, None, None)
+
+
+@pytest.fixture
+def directory(tmp_path: Path, videos: list[Path]) -> Path:
+    # The first video is there from the start, the others are copied in
+    directory = tmp_path / "watched"
+    directory.mkdir()
+    shutil.copy(videos[0], directory / "a.mp4")
+    return directory
+
+
+def test_watch(tmp_path: Path, directory: Path, videos: list[Path]):
+    db = tmp_path / "hashes.db"
+    with Watching(directory, db) as w:
+        wait(lambda: w.status.indexed == 1)
+        shutil.copy(videos[1], directory / "b.mp4")
+        wait(lambda: w.status.indexed == 2)
+        (directory / "a.mp4").unlink()
+        wait(lambda: w.status.removed == 1)
+
+    with open_storage(db) as storage:
+        entries = storage.videos()
+    assert entries[str(directory / "a.mp4")].status == VideoStatus.REMOVED
+    assert entries[str(directory / "b.mp4")].status == VideoStatus.COMPLETE
+
+
+def test_one_process_pool(
+    tmp_path: Path, directory: Path, videos: list[Path], monkeypatch
+):
+    started = []
+
+    class CountingPool(indexer.ProcessPool):
+        def __init__(self, jobs: int):
+            super().__init__(jobs)
+            started.append(self)
+
+    monkeypatch.setattr(indexer, "ProcessPool", CountingPool)
+    db = tmp_path / "hashes.db"
+    with Watching(directory, db, jobs=2) as w:
+        wait(lambda: w.status.indexed == 1)
+        shutil.copy(videos[1], directory / "b.mp4")
+        wait(lambda: w.status.indexed == 2)
+        shutil.copy(videos[2], directory / "c.mp4")
+        wait(lambda: w.status.indexed == 3)
+    assert len(started) == 1
+
+
+def test_queue_bound(tmp_path: Path, directory: Path, videos: list[Path], monkeypatch):
+    # Videos past the bound are found again by a scan once the queue is empty
+    monkeypatch.setattr(watch, "MAX_QUEUED", 1)
+    for i, video in enumerate(videos):
+        shutil.copy(video, directory / f"more{i}.mp4")
+    db = tmp_path / "hashes.db"
+    with Watching(directory, db) as w:
+        wait(lambda: w.status.indexed == 4)
+        assert w.status.queued <= 1
+
+
+def test_debouncer(tmp_path: Path):
+    path = tmp_path / "a.mp4"
+    path.write_bytes(b"a")
+    debouncer = Debouncer(settle=0.1, max_pending=1)
+    debouncer.add(path)
+    assert debouncer.ready() == []
+    time.sleep(0.15)
+    # Unchanged for `settle` seconds
+    assert debouncer.ready() == [path]
+
+    # Past the bound everything is dropped, a scan finds it again
+    (tmp_path / "b.mp4").write_bytes(b"b")
+    debouncer.add(path)
+    debouncer.add(tmp_path / "b.mp4")
+    assert len(debouncer) == 0
+    assert debouncer.overflowed
+
+
+def test_scan(tmp_path: Path):
+    (tmp_path / "sub").mkdir()
+    for name in ["a.mp4", "b.WEBM", "c.txt", "sub/d.mp4"]:
+        (tmp_path / name).write_bytes(b"")
+    assert set(scan_videos([tmp_path])) == {tmp_path / "a.mp4", tmp_path / "b.WEBM"}
+    assert len(scan_videos([tmp_path], recurse=True)) == 3
+    assert set(scan_videos([tmp_path], [".txt"])) == {tmp_path / "c.txt"}
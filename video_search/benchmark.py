@@ -0,0 +1,566 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from io import BytesIO
+from os import PathLike
+from pathlib import Path
+from typing import Any
+
+import av
+import numpy as np
+from imagehash import ImageHash
+from PIL import Image as PILImage
+
+from video_search.hash import (
+    ThumbnailFormat,
+    ThumbnailOptions,
+    VideoFrameHash,
+    pack_hashes,
+)
+from video_search.storage import ManifestEntry, VideoStatus, WriteOptions
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+RESULTS_FORMAT = "video-search-benchmark"
+DEFAULT_SIZES = [10_000, 1_000_000, 10_000_000]
+# Frames per video of a synthetic database, and the bits flipped between
+# consecutive frames of one video
+FRAMES_PER_VIDEO = 500
+FRAME_BIT_FLIPS = 4
+# Bits flipped in a stored hash to make a query for it
+QUERY_BIT_FLIPS = 6
+# Seconds a command line search may take from starting the interpreter to
+# exiting, and the runs timed per command
+STARTUP_BUDGET = 0.75
+STARTUP_RUNS = 5
+# Modules that take long to import and that searching does not need
+SLOW_MODULES = ("av", "scipy", "rich_pixels", "PyQt6", "qt_material")
+
+
+@dataclass
+class StartupCase:
+    name: str
+    args: list[str]
+    # Modules the command must not import
+    forbidden: tuple[str, ...] = SLOW_MODULES
+
+
+@dataclass
+class SyntheticVideo:
+    name: str
+    width: int
+    height: int
+    codec: str
+    suffix: str
+    seconds: float = 10.0
+    fps: int = 24
+    # Seconds between scene changes
+    scene_length: float = 1.0
+    options: dict[str, str] = field(default_factory=dict)
+
+
+DEFAULT_CORPUS = [
+    SyntheticVideo("240p-h264-cuts", 320, 240, "libx264", ".mp4", scene_length=0.25),
+    SyntheticVideo("480p-mpeg4", 854, 480, "mpeg4", ".mp4"),
+    SyntheticVideo(
+        "480p-vp9",
+        854,
+        480,
+        "libvpx-vp9",
+        ".webm",
+        options={"deadline": "realtime", "cpu-used": "8"},
+    ),
+    SyntheticVideo("720p-h264", 1280, 720, "libx264", ".mp4", scene_length=2.0),
+    SyntheticVideo(
+        "720p-hevc",
+        1280,
+        720,
+        "libx265",
+        ".mp4",
+        options={"x265-params": "log-level=error"},
+    ),
+    SyntheticVideo(
+        "1080p-h264-static", 1920, 1080, "libx264", ".mp4", scene_length=10.0
+    ),
+]
+
+
+def _scene(rng: np.random.Generator, width: int, height: int) -> np.ndarray:
+    # Smooth random colour blobs, which keep their hash while moving slightly
+    coarse = rng.integers(0, 256, size=(6, 8, 3), dtype=np.uint8)
+    image = PILImage.fromarray(coarse).resize(
+        (width + 64, height + 64), PILImage.Resampling.BICUBIC
+    )
+    return np.asarray(image)
+
+
+def generate_video(path: PathLike, video: SyntheticVideo, seed: int = 0):
+    # The same video and seed always give the same frames
+    rng = np.random.default_rng([seed, *video.name.encode("utf-8")])
+    with av.open(path, mode="w") as container:
+        stream = container.add_stream(video.codec, rate=video.fps)
+        stream.width = video.width
+        stream.height = video.height
+        stream.pix_fmt = "yuv420p"
+        stream.options = {"preset": "veryfast", **video.options}
+
+        scene_frames = max(1, round(video.scene_length * video.fps))
+        scene = _scene(rng, video.width, video.height)
+        for i in range(round(video.seconds * video.fps)):
+            if i and i % scene_frames == 0:
+                scene = _scene(rng, video.width, video.height)
+            # Slow pan within the scene
+            shift = (i % scene_frames) % 64
+            pixels = scene[shift : shift + video.height, shift : shift + video.width]
+            frame = av.VideoFrame.from_ndarray(
+                np.ascontiguousarray(pixels), format="rgb24"
+            )
+            container.mux(stream.encode(frame))
+        container.mux(stream.encode(None))
+
+
+def generate_corpus(
+    directory: PathLike,
+    corpus: list[SyntheticVideo] | None = None,
+    seed: int = 0,
+    progress_callback: Callable[[float, float], Any] | None = None,
+) -> list[Path]:
+    # Videos that were generated before with the same seed are reused
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    corpus = DEFAULT_CORPUS if corpus is None else corpus
+    paths = []
+    for i, video in enumerate(corpus):
+        path = directory / f"{video.name}-{seed}{video.suffix}"
+        if not path.exists():
+            tmp = path.with_name(f"{path.stem}.tmp{path.suffix}")
+            generate_video(tmp, video, seed)
+            tmp.replace(path)
+        paths.append(path)
+        if progress_callback:
+            progress_callback(float(i + 1), float(len(corpus)))
+    return paths
+
+
+def peak_rss() -> int | None:
+    # Peak resident set size of this process in bytes. Linux keeps ru_maxrss
+    # of the parent across the exec of a spawned worker, VmHWM is reset by it.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _isolated(fn: Callable[..., dict[str, Any]], *args: Any) -> dict[str, Any]:
+    # Runs a measurement in a fresh process, so that its peak RSS is its own
+    with ProcessPoolExecutor(1, max_tasks_per_child=1) as executor:
+        return executor.submit(_measured, fn, *args).result()
+
+
+def _measured(fn: Callable[..., dict[str, Any]], *args: Any) -> dict[str, Any]:
+    result = fn(*args)
+    result["peak_rss"] = peak_rss()
+    return result
+
+
+def _video_frames(path: PathLike) -> int:
+    with av.open(path, mode="r") as vid:
+        return sum(1 for _ in vid.decode(vid.streams.video[0]))
+
+
+def bench_indexing(
+    video: PathLike, db_path: PathLike, thumbnails: ThumbnailOptions
+) -> dict[str, Any]:
+    # Decoding is timed on its own, hashing together with decoding as that is
+    # how hash_video runs, and writing on the finished records.
+    from video_search.storage import open_storage
+    from video_search.video import hash_video
+
+    start = time.perf_counter()
+    frames = _video_frames(video)
+    decode_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    hashes: list[VideoFrameHash] = list(hash_video(video))
+    hash_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    records = [(h.frame_bytes(thumbnails), h.hash, h.path, h.time) for h in hashes]
+    encode_seconds = time.perf_counter() - start
+
+    Path(db_path).unlink(missing_ok=True)
+    start = time.perf_counter()
+    with open_storage(db_path) as storage:
+        for record in records:
+            storage.append_record(*record)
+        storage.commit_video(
+            ManifestEntry.for_file(Path(video), 0.0, len(records), VideoStatus.COMPLETE)
+        )
+    write_seconds = time.perf_counter() - start
+    db_size = os.path.getsize(db_path)
+    Path(db_path).unlink()
+
+    return {
+        "video": Path(video).name,
+        "frames": frames,
+        "frames_kept": len(records),
+        "decode_fps": frames / decode_seconds,
+        "hash_fps": frames / hash_seconds,
+        "encode_fps": len(records) / max(encode_seconds, 1e-9),
+        "write_fps": len(records) / max(write_seconds, 1e-9),
+        "db_bytes_per_frame": db_size / max(len(records), 1),
+    }
+
+
+def _synthetic_hashes(rng: np.random.Generator, count: int) -> np.ndarray:
+    # Every video starts at a random hash and drifts a few bits per frame,
+    # like consecutive kept frames of a real video do
+    bits = np.empty((count, 64), dtype=bool)
+    for start in range(0, count, FRAMES_PER_VIDEO):
+        frames = min(FRAMES_PER_VIDEO, count - start)
+        flips = np.zeros((frames, 64), dtype=bool)
+        columns = rng.integers(0, 64, size=(frames, FRAME_BIT_FLIPS))
+        flips[np.arange(frames)[:, np.newaxis], columns] = True
+        flips[0] = rng.integers(0, 2, size=64, dtype=bool)
+        bits[start : start + frames] = np.logical_xor.accumulate(flips, axis=0)
+    return bits
+
+
+def _thumbnail(format: ThumbnailFormat) -> bytes:
+    if format == ThumbnailFormat.NONE:
+        return b""
+    image = PILImage.fromarray(_scene(np.random.default_rng(0), 128, 72)[:72, :128])
+    with BytesIO() as im:
+        image.save(im, format=format.value.upper())
+        return im.getvalue()
+
+
+def build_database(
+    db_path: PathLike, frames: int, seed: int, thumbnails: ThumbnailFormat
+) -> dict[str, Any]:
+    from video_search.storage import open_storage
+
+    rng = np.random.default_rng([seed, frames])
+    bits = _synthetic_hashes(rng, frames)
+    thumbnail = _thumbnail(thumbnails)
+
+    Path(db_path).unlink(missing_ok=True)
+    start = time.perf_counter()
+    with open_storage(db_path, WriteOptions()) as storage:
+        for video_start in range(0, frames, FRAMES_PER_VIDEO):
+            path = f"/synthetic/{video_start // FRAMES_PER_VIDEO:06d}.mp4"
+            end = min(frames, video_start + FRAMES_PER_VIDEO)
+            for i in range(video_start, end):
+                storage.append_record(
+                    thumbnail, ImageHash(bits[i].reshape(8, 8)), path, i * 0.5
+                )
+            storage.commit_video(
+                ManifestEntry(
+                    path, -1, -1.0, 0.0, end - video_start, VideoStatus.COMPLETE
+                )
+            )
+    seconds = time.perf_counter() - start
+
+    return {"build_fps": frames / seconds}
+
+
+def _percentiles(latencies: list[float]) -> dict[str, float]:
+    ms = np.array(latencies) * 1000
+    return {
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+
+def bench_search(
+    db_path: PathLike, queries: int, seed: int, top_n: int = 50
+) -> dict[str, Any]:
+    # Queries are stored hashes with a few bits flipped. Single queries are
+    # timed one by one, then all of them together in one pass.
+    from video_search.search import nearest
+    from video_search.storage import open_storage
+
+    rng = np.random.default_rng([seed, queries])
+    start = time.perf_counter()
+    with open_storage(db_path) as storage:
+        table = storage.hash_table()
+        load_seconds = time.perf_counter() - start
+
+        picked = table.hashes[rng.integers(0, len(table), size=queries)]
+        masks = np.zeros((queries, 64), dtype=bool)
+        columns = rng.integers(0, 64, size=(queries, QUERY_BIT_FLIPS))
+        masks[np.arange(queries)[:, np.newaxis], columns] = True
+        packed = picked ^ pack_hashes(masks)
+
+        latencies = []
+        for query in packed:
+            start = time.perf_counter()
+            nearest(storage, query[np.newaxis], top_n)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        nearest(storage, packed, top_n)
+        batch_seconds = time.perf_counter() - start
+
+    return {
+        "load_seconds": load_seconds,
+        "queries": queries,
+        "top_n": top_n,
+        **_percentiles(latencies),
+        "batch_ms_per_query": batch_seconds * 1000 / queries,
+    }
+
+
+def _run_cli(args: list[str], importtime: bool = False) -> tuple[float, str]:
+    # Runs the command line in a new interpreter, returns its wall time and
+    # what it wrote to stderr
+    root = str(Path(__file__).resolve().parent.parent)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    command = [sys.executable, *(["-X", "importtime"] if importtime else [])]
+    command += ["-c", "from video_search.cli.main import app; app()", *args]
+    start = time.perf_counter()
+    done = subprocess.run(command, env=env, capture_output=True, text=True, check=False)
+    seconds = time.perf_counter() - start
+    if done.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed:\n{done.stderr}")
+    return seconds, done.stderr
+
+
+def _imports(stderr: str) -> list[tuple[str, int, float]]:
+    # (module, nesting level, cumulative seconds) of every line written by
+    # -X importtime
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), level, int(cumulative) / 1e6))
+    return imports
+
+
+def startup_cases(work_dir: PathLike, seed: int = 0) -> list[StartupCase]:
+    # Searches of a small synthetic database, with a noise image as query
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    db_path = work_dir / f"startup-{seed}.db"
+    if not db_path.exists():
+        tmp = db_path.with_name(db_path.name + ".tmp")
+        build_database(tmp, FRAMES_PER_VIDEO, seed, ThumbnailFormat.NONE)
+        tmp.replace(db_path)
+    query = work_dir / f"startup-{seed}.png"
+    if not query.exists():
+        rng = np.random.default_rng(seed)
+        pixels = rng.integers(0, 256, (240, 320, 3), dtype=np.uint8)
+        PILImage.fromarray(pixels).save(query)
+
+    db = ["--db-path", str(db_path)]
+    return [
+        StartupCase("help", ["--help"]),
+        StartupCase("search --json", [*db, "search", str(query), "--json"]),
+        StartupCase("search-clip --json", [*db, "search-clip", str(query), "--json"]),
+    ]
+
+
+def bench_startup(
+    cases: list[StartupCase], runs: int = STARTUP_RUNS
+) -> list[dict[str, Any]]:
+    # The median wall time of every command, and the modules it imports from
+    # one more run with -X importtime, which slows imports down
+    results = []
+    for case in cases:
+        seconds = sorted(_run_cli(case.args)[0] for _ in range(runs))
+        imports = _imports(_run_cli(case.args, importtime=True)[1])
+        modules = {name for name, _, _ in imports}
+        # The line of a package includes its submodules and what they import
+        packages = sorted(
+            (
+                (name, cumulative)
+                for name, _, cumulative in imports
+                if "." not in name and name != "video_search"
+            ),
+            key=lambda x: -x[1],
+        )
+        results.append(
+            {
+                "command": case.name,
+                "seconds": seconds[len(seconds) // 2],
+                "import_seconds": sum(
+                    cumulative for _, level, cumulative in imports if level == 0
+                ),
+                "modules": len(modules),
+                "slowest_imports": [
+                    {"module": name, "seconds": cumulative}
+                    for name, cumulative in packages[:3]
+                ],
+                "forbidden_imports": sorted(
+                    name for name in case.forbidden if name in modules
+                ),
+            }
+        )
+    return results
+
+
+def check_startup(
+    results: list[dict[str, Any]], budget: float = STARTUP_BUDGET
+) -> list[str]:
+    # Problems with the startup of the commands, empty when all are fine
+    problems = []
+    for entry in results:
+        if entry["seconds"] > budget:
+            problems.append(
+                f"{entry['command']} took {entry['seconds']:.3f}s, "
+                f"over the budget of {budget:.3f}s"
+            )
+        if entry["forbidden_imports"]:
+            problems.append(
+                f"{entry['command']} imports {', '.join(entry['forbidden_imports'])}"
+            )
+    return problems
+
+
+def environment() -> dict[str, Any]:
+    commit = None
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "av": av.__version__,
+    }
+
+
+def run_benchmarks(
+    work_dir: PathLike,
+    sizes: list[int],
+    queries: int = 100,
+    seed: int = 0,
+    videos: bool = True,
+    thumbnails: ThumbnailFormat = ThumbnailFormat.NONE,
+    status_callback: Callable[[str], Any] | None = None,
+    startup: bool = True,
+) -> dict[str, Any]:
+    # Synthetic videos and databases are kept in work_dir and reused by later
+    # runs with the same seed, only their build throughput is then missing.
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    def status(message: str):
+        if status_callback:
+            status_callback(message)
+
+    results: dict[str, Any] = {
+        "format": RESULTS_FORMAT,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "seed": seed,
+        "environment": environment(),
+        "corpus": [asdict(video) for video in DEFAULT_CORPUS],
+        "indexing": [],
+        "databases": [],
+        "startup": [],
+    }
+
+    if startup:
+        status("Timing command line startup...")
+        results["startup"] = bench_startup(startup_cases(work_dir, seed))
+
+    if videos:
+        status("Generating videos...")
+        for video in generate_corpus(work_dir / "videos", seed=seed):
+            status(f"Indexing {video.name}...")
+            results["indexing"].append(
+                _isolated(
+                    bench_indexing, video, work_dir / "index.db", ThumbnailOptions()
+                )
+            )
+
+    for size in sizes:
+        db_path = work_dir / f"synthetic-{size}-{seed}-{thumbnails.value}.db"
+        entry: dict[str, Any] = {"frames": size, "thumbnails": thumbnails.value}
+        if not db_path.exists():
+            status(f"Building database of {size} frames...")
+            tmp = db_path.with_name(db_path.name + ".tmp")
+            built = _isolated(build_database, tmp, size, seed, thumbnails)
+            tmp.replace(db_path)
+            entry["build"] = built
+
+        entry["db_bytes_per_frame"] = os.path.getsize(db_path) / size
+        status(f"Searching database of {size} frames...")
+        entry["search"] = _isolated(bench_search, db_path, queries, seed)
+        results["databases"].append(entry)
+
+    return results
+
+
+def save_results(results: dict[str, Any], path: PathLike):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path: PathLike) -> dict[str, Any]:
+    with open(path) as f:
+        results = json.load(f)
+    if results.get("format") != RESULTS_FORMAT:
+        raise ValueError(f"{path} is not a benchmark result")
+    return results
+
+
+def _metrics(results: dict[str, Any]) -> dict[str, float]:
+    metrics: dict[str, float] = {}
+    for entry in results["indexing"]:
+        for key in ("decode_fps", "hash_fps", "encode_fps", "write_fps", "peak_rss"):
+            if entry.get(key) is not None:
+                metrics[f"{entry['video']} {key}"] = entry[key]
+    for entry in results["databases"]:
+        name = f"{entry['frames']} frames"
+        metrics[f"{name} db_bytes_per_frame"] = entry["db_bytes_per_frame"]
+        if "build" in entry:
+            metrics[f"{name} build_fps"] = entry["build"]["build_fps"]
+        for key in ("p50_ms", "p99_ms", "batch_ms_per_query", "peak_rss"):
+            if entry["search"].get(key) is not None:
+                metrics[f"{name} search {key}"] = entry["search"][key]
+    for entry in results.get("startup", []):
+        metrics[f"startup {entry['command']} seconds"] = entry["seconds"]
+    return metrics
+
+
+def compare_results(
+    previous: dict[str, Any], current: dict[str, Any]
+) -> list[tuple[str, float, float]]:
+    # (metric, previous value, current value) of the metrics both runs have
+    old = _metrics(previous)
+    new = _metrics(current)
+    return [(key, old[key], value) for key, value in new.items() if key in old]
@@ -0,0 +1,205 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass
+from os import PathLike
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from video_search.profiling import Profiler
+from video_search.shards import SHARD_SHIFT, ShardedStorage
+from video_search.storage import (
+    HashStorage,
+    HashTable,
+    LegacyHashStorage,
+    ManifestEntry,
+)
+
+# Databases whose hash tables are kept, the least recently searched one is
+# dropped first
+CACHE_ENTRIES = 4
+
+
+@dataclass(frozen=True)
+class FileState:
+    path: Path
+    inode: int
+    size: int
+    mtime: int
+
+    @classmethod
+    def of(cls, path: Path) -> "FileState":
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return cls(path, 0, 0, 0)
+        return cls(path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def grown_from(self, other: "FileState") -> bool:
+        # The same file with records appended, or a shard created since
+        return self.path == other.path and (
+            other.inode == 0 or (self.inode == other.inode and self.size >= other.size)
+        )
+
+
+@dataclass
+class CachedTable:
+    files: list[FileState]
+    table: HashTable
+    videos: dict[str, ManifestEntry]
+
+
+def _files(db_path: PathLike, storage: HashStorage) -> list[FileState]:
+    # The files holding the records: the database itself or the shards of a
+    # catalog, whose own file is rewritten whenever a shard is added
+    if isinstance(storage, ShardedStorage):
+        catalog = storage.catalog
+        return [FileState.of(catalog.shard_path(i)) for i in range(len(catalog.shards))]
+    return [FileState.of(Path(db_path))]
+
+
+def _videos(storage: HashStorage) -> dict[str, ManifestEntry]:
+    # Legacy databases have no manifest and reading their videos is a full
+    # scan, their records never stop being live
+    if isinstance(storage, LegacyHashStorage):
+        return {}
+    return dict(storage.videos())
+
+
+def _tail(
+    storage: HashStorage,
+    cached: CachedTable,
+    files: list[FileState],
+    progress_callback: Callable[[float, float], Any] | None,
+) -> HashTable:
+    # Records appended after the cached ones. Every shard is appended to on
+    # its own, so their tails are read separately.
+    offsets = cached.table.offsets
+    if not isinstance(storage, ShardedStorage):
+        return storage.hash_table(
+            progress_callback, after=int(offsets.max()) if len(offsets) else -1
+        )
+
+    tail = HashTable(np.empty((0, 1), np.uint64), np.empty(0, np.int64))
+    shards = offsets >> SHARD_SHIFT
+    for shard, state in enumerate(files):
+        if state.inode == 0 or state in cached.files:
+            continue
+        local = offsets[shards == shard] & ((1 << SHARD_SHIFT) - 1)
+        loaded = storage.shard(shard).hash_table(
+            after=int(local.max()) if len(local) else -1
+        )
+        tail = _append(
+            tail, HashTable(loaded.hashes, loaded.offsets | (shard << SHARD_SHIFT))
+        )
+        if progress_callback:
+            progress_callback(float(shard + 1), float(len(files)))
+    return tail
+
+
+def _append(table: HashTable, tail: HashTable) -> HashTable:
+    if not len(table):
+        return tail
+    if not len(tail):
+        return table
+    table = HashTable(
+        np.concatenate([table.hashes, tail.hashes]),
+        np.concatenate([table.offsets, tail.offsets]),
+    )
+    # Records stay in offset order like in a table read at once, which breaks
+    # ties between equally close records
+    if (table.offsets[len(table) - len(tail) - 1] > tail.offsets[0]) or (
+        np.diff(tail.offsets) < 0
+    ).any():
+        order = np.argsort(table.offsets, kind="stable")
+        table = HashTable(table.hashes[order], table.offsets[order])
+    return table
+
+
+class IndexCache:
+    # Hash tables of databases kept between searches of one process. A table is
+    # reused while its files are unchanged. When records were appended only
+    # the tail after the last cached record is read, a truncated or replaced
+    # file, or a video that was re-indexed or removed, reads the whole table
+    # again. Loading is serialized, the returned tables are never modified.
+    def __init__(self, max_entries: int = CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Path, CachedTable] = OrderedDict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def hash_table(
+        self,
+        db_path: PathLike,
+        storage: HashStorage,
+        progress_callback: Callable[[float, float], Any] | None = None,
+        profiler: Profiler | None = None,
+    ) -> HashTable:
+        # `storage` has to be the database at `db_path`, opened by the caller
+        profiler = profiler or Profiler()
+        key = Path(db_path).resolve()
+        with self._lock:
+            # Taken before reading, so records appended meanwhile are read
+            # again as the tail of the next call instead of missed
+            files = _files(db_path, storage)
+            cached = self._entries.get(key)
+            if cached is not None and cached.files == files:
+                self._entries.move_to_end(key)
+                profiler.count("cache_hits")
+                if progress_callback:
+                    progress_callback(1.0, 1.0)
+                return cached.table
+
+            started = time.perf_counter()
+            videos = _videos(storage)
+            if cached is not None and (
+                not self._appended(cached, files)
+                or self._superseded(cached.videos, videos)
+            ):
+                cached = None
+
+            if cached is not None:
+                loaded = _tail(storage, cached, files, progress_callback)
+                table = _append(cached.table, loaded)
+                profiler.count("cache_tail_loads")
+            else:
+                table = loaded = storage.hash_table(progress_callback)
+                profiler.count("cache_rebuilds")
+            profiler.add(
+                "deserialize",
+                time.perf_counter() - started,
+                len(loaded),
+                loaded.hashes.nbytes + loaded.offsets.nbytes,
+                started,
+            )
+
+            self._entries[key] = CachedTable(files, table, videos)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return table
+
+    @staticmethod
+    def _appended(cached: CachedTable, files: list[FileState]) -> bool:
+        return len(files) >= len(cached.files) and all(
+            new.grown_from(old) for old, new in zip(cached.files, files)
+        )
+
+    @staticmethod
+    def _superseded(
+        old: dict[str, ManifestEntry], new: dict[str, ManifestEntry]
+    ) -> bool:
+        # Whether records of the cached table stopped being live
+        return any(
+            entry.first >= 0 and new.get(path) != entry for path, entry in old.items()
+        )
+
+
+default_index_cache = IndexCache()
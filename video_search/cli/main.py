@@ -1,19 +1,58 @@
+import csv
+import json
 from pathlib import Path
 from typing import Annotated
 
 import typer
 from PIL import Image
-from rich import print
+from rich import get_console, print
+from rich.console import Console
 from rich.panel import Panel
-from rich.progress import Progress, track
-from rich_pixels import Pixels
+from rich.progress import Progress, TaskID
+from rich.table import Table
 
-from video_search.search import search_similar
-from video_search.storage import open_storage
-from video_search.video import hash_video
+# Only modules every command needs are imported here, the ones that take
+# long to import (PyAV, rich_pixels, the benchmark and the server) are
+# imported by the commands that use them
+from video_search.clip import TOLERANCE, hash_clip, hash_images
+from video_search.clip import search_clip as search_video_clip
+from video_search.columnar import ColumnarHashStorage
+from video_search.columnar import compact as compact_storage
+from video_search.columnar import migrate as migrate_storage
+from video_search.decode import DecodeMode, DecodeOptions
+from video_search.dedupe import DedupeAction, DedupeOptions, DedupeScope
+from video_search.hash import HashKind, ThumbnailFormat, ThumbnailOptions
+from video_search.index import build_index as build_hash_index
+from video_search.index import check_recall, index_path
+from video_search.profiling import Profiler
+from video_search.search import Result, search_many
+from video_search.shards import (
+    DEFAULT_SHARD_SIZE,
+    Catalog,
+    ShardedStorage,
+    ShardSplit,
+    is_catalog,
+)
+from video_search.storage import (
+    LegacyHashStorage,
+    SyncPolicy,
+    VideoStatus,
+    WriteOptions,
+    open_storage,
+)
+from video_search.variants import VariantMode, VariantOptions
+from video_search.watch import (
+    DEFAULT_EXTENSIONS,
+    POLL_INTERVAL,
+    SETTLE_SECONDS,
+    Watch,
+    WatchStatus,
+    scan_videos,
+)
 
 app = typer.Typer()
 global_config = {"db": Path("data.db")}
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp", ".bmp"}
 
 
 def format_seconds(total_seconds: float) -> str:
@@ -23,62 +62,881 @@ def format_seconds(total_seconds: float) -> str:
     return f"{hours:02d}:{minutes:02d}:{seconds:07.4f}"
 
 
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+
+def report_profile(
+    profiler: Profiler, stats: bool, trace: Path | None, console: Console | None = None
+):
+    # With --json, stdout is kept for the results and this goes to stderr
+    console = console or get_console()
+    if stats:
+        table = Table("Stage", "Time (s)", "Items", "Items/s", "Bytes")
+        for name, stage in profiler.stages.items():
+            rate = stage.items / stage.seconds if stage.seconds > 0 else 0.0
+            table.add_row(
+                name,
+                f"{stage.seconds:.3f}",
+                str(stage.items),
+                f"{rate:.1f}",
+                format_bytes(stage.bytes) if stage.bytes else "-",
+            )
+        console.print(table)
+        for name, count in profiler.counters.items():
+            console.print(f"{name}: {count}")
+
+    if trace is not None:
+        profiler.write_trace(trace)
+        console.print(f"Trace written to {trace}.")
+
+
 @app.command()
 def index(
-    directory: Annotated[
-        Path, typer.Argument(help="Directory to scan for video files and index")
+    directories: Annotated[
+        list[Path], typer.Argument(help="Directories to scan for video files and index")
     ],
     recurse: Annotated[bool, typer.Option(help="Run scan recursively")] = False,
+    extension: Annotated[
+        list[str] | None,
+        typer.Option(
+            help="File extension of videos, can be repeated [default: mp4, webm]"
+        ),
+    ] = None,
+    watch: Annotated[
+        bool,
+        typer.Option(
+            help="Keep running, index new and changed videos and remove deleted ones"
+        ),
+    ] = False,
+    settle: Annotated[
+        float,
+        typer.Option(help="Seconds a video has to stay unchanged before it is indexed"),
+    ] = SETTLE_SECONDS,
+    poll: Annotated[
+        bool, typer.Option(help="Find changes by scanning instead of with inotify")
+    ] = False,
+    poll_interval: Annotated[
+        float, typer.Option(help="Seconds between scans when polling")
+    ] = POLL_INTERVAL,
+    jobs: Annotated[
+        int, typer.Option(help="Number of videos to index in parallel")
+    ] = 1,
+    frame_workers: Annotated[
+        int,
+        typer.Option(help="Threads hashing and encoding the frames of every video"),
+    ] = 1,
+    decode_mode: Annotated[
+        DecodeMode, typer.Option(help="Which frames of the video to decode")
+    ] = DecodeMode.ALL,
+    sample_rate: Annotated[
+        float, typer.Option(help="Frames per second to decode in sample mode")
+    ] = 1.0,
+    threads: Annotated[
+        bool, typer.Option(help="Use FFmpeg frame threading when decoding")
+    ] = False,
+    interpolation: Annotated[
+        str, typer.Option(help="Scaling interpolation, e.g. LANCZOS or BILINEAR")
+    ] = "LANCZOS",
+    thumbnails: Annotated[
+        ThumbnailFormat,
+        typer.Option(help="How to store thumbnails, none decodes them on demand"),
+    ] = ThumbnailFormat.PNG,
+    thumbnail_quality: Annotated[
+        int, typer.Option(help="Quality of jpeg and webp thumbnails")
+    ] = 85,
+    extra_hash: Annotated[
+        list[HashKind] | None,
+        typer.Option(help="Additional hash to store for re-ranking, can be repeated"),
+    ] = None,
+    batch_size: Annotated[
+        int, typer.Option(help="Number of frames buffered before writing")
+    ] = 1024,
+    sync: Annotated[
+        SyncPolicy, typer.Option(help="When to fsync the database")
+    ] = SyncPolicy.VIDEO,
+    dedupe: Annotated[
+        DedupeScope,
+        typer.Option(help="Find near-duplicate frames within a video or the database"),
+    ] = DedupeScope.NONE,
+    dedupe_radius: Annotated[
+        int, typer.Option(help="Hamming distance of frames that count as duplicates")
+    ] = 4,
+    dedupe_action: Annotated[
+        DedupeAction,
+        typer.Option(help="Skip duplicates or store them without a thumbnail"),
+    ] = DedupeAction.REFERENCE,
+    stats: Annotated[
+        bool, typer.Option(help="Print the time spent in every stage")
+    ] = False,
+    trace: Annotated[
+        Path | None, typer.Option(help="Write a Chrome trace of the stages to a file")
+    ] = None,
 ):
-    rs = ""
-    if recurse:
-        rs = "**/"
+    from video_search.indexer import index_videos, videos_to_index
 
-    with open_storage(global_config["db"]) as storage:
-        indexed_paths = {str(entry.path) for entry in storage}
+    if watch and trace is not None:
+        raise typer.BadParameter(
+            "--trace cannot be used with --watch, traces are kept in memory"
+        )
 
-        all_videos = [*directory.glob(rs + "*.mp4"), *directory.glob(rs + "*.webm")]
-        new_videos = [p for p in all_videos if str(p.resolve()) not in indexed_paths]
+    options = DecodeOptions(decode_mode, sample_rate, threads, interpolation.upper())
+    thumbnail_options = ThumbnailOptions(thumbnails, thumbnail_quality)
+    extensions = extension or list(DEFAULT_EXTENSIONS)
+    dedupe_options = DedupeOptions(dedupe, dedupe_radius, dedupe_action)
+
+    write_options = WriteOptions(batch_size, sync)
+    profiler = Profiler(trace is not None)
+    if watch:
+        with open_storage(global_config["db"], write_options) as storage:
+            watch_directories(
+                Watch(
+                    directories,
+                    storage,
+                    extensions,
+                    recurse,
+                    settle,
+                    poll,
+                    poll_interval,
+                    jobs,
+                    frame_workers,
+                    options=options,
+                    thumbnails=thumbnail_options,
+                    extra_hashes=tuple(extra_hash or ()),
+                    profiler=profiler,
+                    dedupe=dedupe_options,
+                )
+            )
+        report_profile(profiler, stats, trace)
+        return
+
+    with open_storage(global_config["db"], write_options) as storage:
+        all_videos = scan_videos(directories, extensions, recurse)
+        new_videos = videos_to_index(list(all_videos), storage, all_videos)
 
         if skipped := len(all_videos) - len(new_videos):
             print(f"Skipping {skipped} already indexed video(s).")
 
-        for path in track(new_videos, description="Processing videos..."):
-            with Progress() as progress:
-                task = progress.add_task(f"Processing video {path}...")
+        with Progress() as progress:
+            overall = progress.add_task("Processing videos...", total=len(new_videos))
+            tasks: dict[Path, TaskID] = {}
 
-                def cb(start: float, end: float):
-                    progress.update(task, total=end, completed=start)
+            def cb(path: Path, start: float, end: float):
+                if path not in tasks:
+                    tasks[path] = progress.add_task(f"Processing video {path}...")
+                progress.update(tasks[path], total=end, completed=start)
 
-                for hash in hash_video(path, progress_callback=cb):
-                    storage.append_hash(hash)
+            def done(path: Path):
+                progress.advance(overall)
+
+            report = index_videos(
+                new_videos,
+                storage,
+                jobs=jobs,
+                progress_callback=cb,
+                file_callback=done,
+                options=options,
+                thumbnails=thumbnail_options,
+                extra_hashes=tuple(extra_hash or ()),
+                profiler=profiler,
+                dedupe=dedupe_options,
+                workers=frame_workers,
+            )
+
+    if report.frames:
+        print(
+            f"Near-duplicates: {report.skipped} skipped and {report.referenced} "
+            f"stored without thumbnail, out of {report.frames} frame(s) "
+            f"({(report.skipped + report.referenced) / report.frames:.1%} saved)."
+        )
+    report_profile(profiler, stats, trace)
+
+
+def watch_directories(watcher: Watch):
+    console = get_console()
+    with console.status("Scanning...") as status:
+        progress: dict[str, str] = {"current": ""}
+
+        def describe(state: WatchStatus) -> str:
+            text = (
+                f"Watching ({state.backend}): {state.pending} settling, "
+                f"{state.queued} queued, {state.indexed} indexed, "
+                f"{state.removed} removed"
+            )
+            if state.failed:
+                text += f", {state.failed} failed"
+            if state.current is not None:
+                text += f" - {state.current.name} {progress['current']}"
+            return text
+
+        def on_status(state: WatchStatus):
+            status.update(describe(state))
+
+        def on_progress(path: Path, start: float, end: float):
+            progress["current"] = f"{start / end:.0%}" if end else ""
+            status.update(describe(watcher.status))
+
+        def on_error(path: Path, error: Exception):
+            console.print(f"[red]{path}: {error}[/red]")
+
+        watcher.status_callback = on_status
+        watcher.progress_callback = on_progress
+        watcher.error_callback = on_error
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+    state = watcher.status
+    print(
+        f"Stopped watching: {state.indexed} indexed, {state.removed} removed, "
+        f"{state.failed} failed, {state.pending + state.queued} left over."
+    )
+
+
+def expand_images(paths: list[Path]) -> list[Path]:
+    images: list[Path] = []
+    for path in paths:
+        if path.is_dir():
+            images.extend(
+                sorted(p for p in path.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+            )
+        else:
+            images.append(path)
+    return images
+
+
+def result_rows(images: list[Path], results: list[list[Result]]) -> list[dict]:
+    return [
+        {
+            "query": str(image),
+            "path": str(x.match.path),
+            "time": x.match.time,
+            "similarity": float(x.similarity),
+            "variant": x.variant,
+        }
+        for image, matches in zip(images, results)
+        for x in matches
+    ]
+
+
+def write_rows(output: Path, rows: list[dict], fields: list[str]):
+    if output.suffix.lower() == ".csv":
+        with open(output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+def write_results(output: Path, images: list[Path], results: list[list[Result]]):
+    write_rows(
+        output,
+        result_rows(images, results),
+        ["query", "path", "time", "similarity", "variant"],
+    )
 
 
 @app.command()
 def search(
-    image: Annotated[Path, typer.Argument(help="Image file to find for the source")],
+    images: Annotated[
+        list[Path],
+        typer.Argument(
+            help="Image files or directories of images to find the source of"
+        ),
+    ],
     threshold: Annotated[float, typer.Option(help="Threshold for similarity")] = 0.8,
+    max_distance: Annotated[
+        int | None,
+        typer.Option(help="Only return matches within this Hamming distance"),
+    ] = None,
+    output: Annotated[
+        Path | None,
+        typer.Option(help="Write the results to a .json or .csv file instead"),
+    ] = None,
+    refine: Annotated[
+        HashKind | None,
+        typer.Option(help="Re-rank the closest matches by this additional hash"),
+    ] = None,
+    variants: Annotated[
+        VariantMode,
+        typer.Option(
+            help="Also search the query without black bars, or also cropped and mirrored"
+        ),
+    ] = VariantMode.NONE,
+    json_output: Annotated[
+        bool,
+        typer.Option("--json", help="Print the results as JSON instead of images"),
+    ] = False,
+    stats: Annotated[
+        bool, typer.Option(help="Print the time spent in every stage")
+    ] = False,
+    trace: Annotated[
+        Path | None, typer.Option(help="Write a Chrome trace of the stages to a file")
+    ] = None,
 ):
+    images = expand_images(images)
+    profiler = Profiler(trace is not None)
     with open_storage(global_config["db"]) as storage:
-        with Progress() as progress:
+        with Progress(disable=json_output) as progress:
             task = progress.add_task("Searching...")
 
             def cb(current: float, total: float):
                 progress.update(task, total=total, completed=current)
 
-            res = search_similar(Image.open(image), storage, progress_callback=cb)
+            # All images are searched with one pass over the database
+            results = search_many(
+                [Image.open(image) for image in images],
+                storage,
+                progress_callback=cb,
+                max_distance=max_distance,
+                refine=refine,
+                profiler=profiler,
+                variants=VariantOptions(variants)
+                if variants != VariantMode.NONE
+                else None,
+            )
+        results = [[x for x in res if x.similarity >= threshold] for res in results]
 
-        for x in res:
-            if x.similarity < threshold:
-                continue
+        if json_output:
+            typer.echo(json.dumps(result_rows(images, results), indent=2))
+            report_profile(profiler, stats, trace, Console(stderr=True))
+            return
+        if output is not None:
+            write_results(output, images, results)
+            print(f"Wrote results of {len(images)} image(s) to {output}.")
+            report_profile(profiler, stats, trace)
+            return
 
-            print(
-                Panel(
-                    Pixels.from_image(x.match.load_image()),
-                    title=str(x.match.path),
-                    subtitle=f"Time: {format_seconds(x.match.time)}s | Similarity {x.similarity}",
+        from rich_pixels import Pixels
+
+        for image, res in zip(images, results):
+            if len(images) > 1:
+                print(f"[bold]{image}[/bold]: {len(res)} match(es)")
+
+            for x in res:
+                print(
+                    Panel(
+                        Pixels.from_image(x.match.load_image()),
+                        title=str(x.match.path),
+                        subtitle=f"Time: {format_seconds(x.match.time)}s | Similarity {x.similarity}"
+                        + (f" | {x.variant}" if x.variant else ""),
+                    )
+                )
+    report_profile(profiler, stats, trace)
+
+
+@app.command()
+def search_clip(
+    query: Annotated[
+        list[Path],
+        typer.Argument(
+            help="A video clip, or image files and directories in the order they were taken"
+        ),
+    ],
+    interval: Annotated[
+        float, typer.Option(help="Seconds between two query images")
+    ] = 1.0,
+    tolerance: Annotated[
+        float, typer.Option(help="Seconds a query frame may be off from its match")
+    ] = TOLERANCE,
+    top_n: Annotated[int, typer.Option(help="Number of matches to return")] = 10,
+    threshold: Annotated[float, typer.Option(help="Threshold for similarity")] = 0.8,
+    output: Annotated[
+        Path | None,
+        typer.Option(help="Write the results to a .json or .csv file instead"),
+    ] = None,
+    json_output: Annotated[
+        bool, typer.Option("--json", help="Print the results as JSON")
+    ] = False,
+    stats: Annotated[
+        bool, typer.Option(help="Print the time spent in every stage")
+    ] = False,
+    trace: Annotated[
+        Path | None, typer.Option(help="Write a Chrome trace of the stages to a file")
+    ] = None,
+):
+    profiler = Profiler(trace is not None)
+    if (
+        len(query) == 1
+        and query[0].is_file()
+        and query[0].suffix.lower() not in IMAGE_SUFFIXES
+    ):
+        clip = hash_clip(query[0], profiler=profiler)
+    else:
+        clip = hash_images(expand_images(query), interval, profiler=profiler)
+
+    with (
+        open_storage(global_config["db"]) as storage,
+        Progress(disable=json_output) as progress,
+    ):
+        task = progress.add_task("Aligning...")
+
+        def cb(current: float, total: float):
+            progress.update(task, total=total, completed=current)
+
+        results = search_video_clip(
+            clip,
+            storage,
+            top_n=top_n,
+            tolerance=tolerance,
+            progress_callback=cb,
+            profiler=profiler,
+        )
+    results = [x for x in results if x.similarity >= threshold]
+    rows = [
+        {
+            "path": x.path,
+            "start": x.start,
+            "similarity": x.similarity,
+            "matched": x.matched,
+            "frames": x.frames,
+        }
+        for x in results
+    ]
+
+    if json_output:
+        typer.echo(json.dumps(rows, indent=2))
+        report_profile(profiler, stats, trace, Console(stderr=True))
+        return
+    if output is not None:
+        write_rows(output, rows, ["path", "start", "similarity", "matched", "frames"])
+        print(f"Wrote {len(results)} match(es) to {output}.")
+        report_profile(profiler, stats, trace)
+        return
+
+    table = Table("Video", "Start", "Similarity", "Matched frames")
+    for x in results:
+        table.add_row(
+            x.path,
+            f"{format_seconds(x.start)}s",
+            f"{x.similarity:.3f}",
+            f"{x.matched}/{x.frames}",
+        )
+    print(table)
+    report_profile(profiler, stats, trace)
+
+
+@app.command()
+def decode_report(
+    video: Annotated[Path, typer.Argument(help="Video file to test decode modes on")],
+    sample_rate: Annotated[
+        float, typer.Option(help="Frames per second to decode in sample mode")
+    ] = 1.0,
+    interpolation: Annotated[
+        str, typer.Option(help="Cheaper interpolation to compare against LANCZOS")
+    ] = "BILINEAR",
+):
+    candidates = [
+        DecodeOptions(DecodeMode.ALL, threads=True),
+        DecodeOptions(DecodeMode.ALL, threads=True, interpolation=interpolation),
+        DecodeOptions(DecodeMode.KEYFRAMES, interpolation=interpolation),
+        DecodeOptions(DecodeMode.SAMPLE, sample_rate, interpolation=interpolation),
+    ]
+    from video_search.video import compare_decode_modes
+
+    with Progress() as progress:
+        progress.add_task("Decoding...", total=None)
+        reports = compare_decode_modes(video, candidates)
+
+    table = Table("Mode", "Threads", "Interpolation", "Frames/s", "Kept", "Recall")
+    for report in reports:
+        mode = report.options.mode.value
+        if report.options.mode == DecodeMode.SAMPLE:
+            mode += f" ({report.options.sample_rate:g}/s)"
+        table.add_row(
+            mode,
+            "yes" if report.options.threads else "no",
+            report.options.interpolation,
+            f"{report.frames_per_second:.1f}",
+            str(report.frames_kept),
+            f"{report.recall:.3f}",
+        )
+    print(table)
+
+
+@app.command()
+def benchmark(
+    output: Annotated[
+        Path, typer.Option(help="JSON file to write the results to")
+    ] = Path("benchmark.json"),
+    work_dir: Annotated[
+        Path,
+        typer.Option(help="Directory for the synthetic videos and databases"),
+    ] = Path("benchmark-data"),
+    size: Annotated[
+        list[int] | None,
+        typer.Option(help="Frames of a synthetic database to search, can be repeated"),
+    ] = None,
+    queries: Annotated[
+        int, typer.Option(help="Number of queries to time per database")
+    ] = 100,
+    seed: Annotated[int, typer.Option(help="Seed of the synthetic data")] = 0,
+    videos: Annotated[
+        bool, typer.Option(help="Benchmark indexing the synthetic videos")
+    ] = True,
+    thumbnails: Annotated[
+        ThumbnailFormat,
+        typer.Option(help="Thumbnails stored in the synthetic databases"),
+    ] = ThumbnailFormat.NONE,
+    compare: Annotated[
+        Path | None, typer.Option(help="Earlier results to compare against")
+    ] = None,
+    startup: Annotated[
+        bool, typer.Option(help="Time the startup of command line searches")
+    ] = True,
+):
+    from video_search.benchmark import (
+        DEFAULT_SIZES,
+        compare_results,
+        load_results,
+        run_benchmarks,
+        save_results,
+    )
+
+    previous = load_results(compare) if compare else None
+    with Progress() as progress:
+        task = progress.add_task("Benchmarking...", total=None)
+        results = run_benchmarks(
+            work_dir,
+            size or DEFAULT_SIZES,
+            queries,
+            seed,
+            videos,
+            thumbnails,
+            status_callback=lambda message: progress.update(task, description=message),
+            startup=startup,
+        )
+    save_results(results, output)
+
+    table = Table(
+        "Video", "Frames", "Kept", "Decode/s", "Hash/s", "Encode/s", "Write/s"
+    )
+    for entry in results["indexing"]:
+        table.add_row(
+            entry["video"],
+            str(entry["frames"]),
+            str(entry["frames_kept"]),
+            f"{entry['decode_fps']:.1f}",
+            f"{entry['hash_fps']:.1f}",
+            f"{entry['encode_fps']:.1f}",
+            f"{entry['write_fps']:.1f}",
+        )
+    if results["indexing"]:
+        print(table)
+
+    table = Table(
+        "Frames", "Bytes/frame", "p50 ms", "p99 ms", "Batch ms/query", "RSS MB"
+    )
+    for entry in results["databases"]:
+        search = entry["search"]
+        rss = search["peak_rss"]
+        table.add_row(
+            str(entry["frames"]),
+            f"{entry['db_bytes_per_frame']:.1f}",
+            f"{search['p50_ms']:.2f}",
+            f"{search['p99_ms']:.2f}",
+            f"{search['batch_ms_per_query']:.2f}",
+            f"{rss / 2**20:.0f}" if rss is not None else "-",
+        )
+    print(table)
+
+    if previous is not None:
+        table = Table("Metric", "Previous", "Current", "Change")
+        for metric, old, new in compare_results(previous, results):
+            change = f"{(new - old) / old:+.1%}" if old else "-"
+            table.add_row(metric, f"{old:.2f}", f"{new:.2f}", change)
+        print(table)
+    print(f"Results written to {output}.")
+    if results["startup"] and not report_startup(results["startup"]):
+        raise typer.Exit(1)
+
+
+def report_startup(results: list[dict], budget: float | None = None) -> bool:
+    from video_search.benchmark import STARTUP_BUDGET, check_startup
+
+    table = Table("Command", "Seconds", "Imports (s)", "Modules", "Slowest imports")
+    for entry in results:
+        table.add_row(
+            entry["command"],
+            f"{entry['seconds']:.3f}",
+            f"{entry['import_seconds']:.3f}",
+            str(entry["modules"]),
+            ", ".join(
+                f"{x['module']} {x['seconds']:.3f}" for x in entry["slowest_imports"]
+            ),
+        )
+    print(table)
+
+    problems = check_startup(results, STARTUP_BUDGET if budget is None else budget)
+    for problem in problems:
+        print(f"[red]{problem}[/red]")
+    return not problems
+
+
+@app.command()
+def check_startup(
+    budget: Annotated[
+        float | None,
+        typer.Option(help="Seconds a search may take, 0.75 by default"),
+    ] = None,
+    runs: Annotated[int, typer.Option(help="Runs timed per command")] = 5,
+    work_dir: Annotated[
+        Path, typer.Option(help="Directory for the synthetic database")
+    ] = Path("benchmark-data"),
+):
+    # Fails when a command line search is slower than the budget or imports a
+    # module it does not need
+    from video_search.benchmark import bench_startup, startup_cases
+
+    with Progress() as progress:
+        progress.add_task("Timing startup...", total=None)
+        results = bench_startup(startup_cases(work_dir), runs)
+    if not report_startup(results, budget):
+        raise typer.Exit(1)
+
+
+@app.command()
+def build_index(
+    check: Annotated[
+        int, typer.Option(help="Number of random queries to check recall with")
+    ] = 0,
+):
+    with open_storage(global_config["db"]) as storage:
+        with Progress() as progress:
+            task = progress.add_task("Building index...")
+
+            def cb(current: float, total: float):
+                progress.update(task, total=total, completed=current)
+
+            # Catalogs get an index per shard, next to the shard's database
+            shards = [storage]
+            if isinstance(storage, ShardedStorage):
+                shards = [storage.shard(i) for i in range(len(storage.catalog.shards))]
+            for shard in shards:
+                shard.index = build_hash_index(shard, progress_callback=cb)
+
+        for shard in shards:
+            assert shard.index is not None
+            print(f"Indexed {len(shard.index)} frame(s).")
+            if check:
+                recall, answered = check_recall(shard, shard.index, queries=check)
+                print(
+                    f"Recall against exhaustive scan: {recall:.4f} "
+                    f"({answered:.0%} of queries answered by the index)"
                 )
+
+
+@app.command()
+def migrate(
+    keep_backup: Annotated[
+        bool, typer.Option(help="Keep the original database next to the new one")
+    ] = True,
+):
+    db: Path = global_config["db"]
+    if not db.exists():
+        print(f"Database {db} does not exist.")
+        raise typer.Exit(1)
+
+    target = db.with_name(db.name + ".migrating")
+    target.unlink(missing_ok=True)
+
+    with open_storage(db) as source:
+        if isinstance(source, ShardedStorage):
+            print("Catalogs can't be migrated, migrate each shard instead.")
+            raise typer.Exit(1)
+        if not isinstance(source, LegacyHashStorage):
+            print(f"Database {db} is already in the current format.")
+            return
+
+        with open_storage(target) as dest, Progress() as progress:
+            assert isinstance(dest, ColumnarHashStorage)
+            task = progress.add_task("Migrating...")
+
+            def cb(current: float, total: float):
+                progress.update(task, total=total, completed=current)
+
+            migrate_storage(source, dest, progress_callback=cb)
+
+    if keep_backup:
+        backup = db.with_name(db.name + ".v1.bak")
+        db.replace(backup)
+        print(f"Original database kept at {backup}.")
+    target.replace(db)
+    rebuild_index(db)
+
+
+def rebuild_index(db: Path):
+    # Record offsets changed, an existing index has to be rebuilt
+    if index_path(db).exists():
+        index_path(db).unlink()
+        with open_storage(db) as storage:
+            storage.index = build_hash_index(storage)
+
+
+def compact_file(db: Path, keep_missing: bool):
+    target = db.with_name(db.name + ".compacting")
+    target.unlink(missing_ok=True)
+
+    with open_storage(db) as source:
+        if not isinstance(source, ColumnarHashStorage):
+            print(f"Database {db} has to be migrated before it can be compacted.")
+            raise typer.Exit(1)
+
+        with open_storage(target) as dest, Progress() as progress:
+            assert isinstance(dest, ColumnarHashStorage)
+            task = progress.add_task(f"Compacting {db}...")
+
+            def cb(current: float, total: float):
+                progress.update(task, total=total, completed=current)
+
+            def keep(path: str) -> bool:
+                return keep_missing or Path(path).exists()
+
+            compact_storage(source, dest, keep=keep, progress_callback=cb)
+
+    before = db.stat().st_size
+    target.replace(db)
+    print(f"Compacted {db} from {before} to {db.stat().st_size} bytes.")
+    rebuild_index(db)
+
+
+@app.command()
+def compact(
+    keep_missing: Annotated[
+        bool, typer.Option(help="Keep videos that no longer exist on disk")
+    ] = False,
+):
+    db: Path = global_config["db"]
+    if not db.exists():
+        print(f"Database {db} does not exist.")
+        raise typer.Exit(1)
+
+    if is_catalog(db):
+        catalog = Catalog.load(db)
+        for shard in range(len(catalog.shards)):
+            if catalog.shard_path(shard).exists():
+                compact_file(catalog.shard_path(shard), keep_missing)
+    else:
+        compact_file(db, keep_missing)
+
+
+@app.command()
+def remove(
+    paths: Annotated[
+        list[Path],
+        typer.Argument(help="Videos, or directories of videos, to remove"),
+    ],
+):
+    with open_storage(global_config["db"]) as storage:
+        shards = [storage]
+        if isinstance(storage, ShardedStorage):
+            shards = [storage.shard(i) for i in range(len(storage.catalog.shards))]
+        if any(isinstance(shard, LegacyHashStorage) for shard in shards):
+            print(
+                "Videos can only be removed from databases in the current format, "
+                "migrate first."
             )
+            raise typer.Exit(1)
+
+        videos = storage.videos()
+        for path in paths:
+            path = path.resolve()
+            removed = [
+                video
+                for video, entry in videos.items()
+                if entry.status != VideoStatus.REMOVED
+                and (Path(video) == path or Path(video).is_relative_to(path))
+            ]
+            if not removed:
+                print(f"{path} is not in the database.")
+            for video in removed:
+                storage.remove_video(video)
+                print(f"Removed {video}.")
+
+
+@app.command()
+def verify():
+    with open_storage(global_config["db"]) as storage:
+        shards = [storage]
+        if isinstance(storage, ShardedStorage):
+            shards = [storage.shard(i) for i in range(len(storage.catalog.shards))]
+
+        for shard in shards:
+            if not isinstance(shard, ColumnarHashStorage):
+                print("Databases in the legacy format have no checksums.")
+                continue
+
+            with Progress() as progress:
+                task = progress.add_task("Verifying...")
+
+                def cb(current: float, total: float, task: TaskID = task):
+                    progress.update(task, total=total, completed=current)
+
+                checked, corrupt = shard.verify(progress_callback=cb)
+
+            print(f"Checked {checked} frame(s), {len(corrupt)} corrupt.")
+            for offset in corrupt:
+                print(f"Corrupt frame at offset {offset}.")
+
+
+@app.command()
+def create_catalog(
+    shards: Annotated[
+        list[Path] | None,
+        typer.Argument(help="Existing databases to add to the catalog as shards"),
+    ] = None,
+    split: Annotated[
+        ShardSplit, typer.Option(help="When to start writing to a new shard")
+    ] = ShardSplit.SIZE,
+    shard_size: Annotated[
+        int, typer.Option(help="Size in MB after which a new shard is started")
+    ] = DEFAULT_SHARD_SIZE >> 20,
+):
+    path: Path = global_config["db"]
+    if path.exists():
+        print(f"{path} already exists.")
+        raise typer.Exit(1)
+
+    catalog = Catalog(path, split, shard_size << 20)
+    for shard in shards or []:
+        catalog.add_shard(shard)
+    catalog.save()
+    print(f"Created catalog {path} with {len(catalog.shards)} shard(s).")
+
+
+@app.command()
+def serve(
+    host: Annotated[str, typer.Option(help="Address to listen on")] = "127.0.0.1",
+    port: Annotated[int, typer.Option(help="Port to listen on")] = 8000,
+    socket: Annotated[
+        Path | None, typer.Option(help="Listen on this Unix socket instead")
+    ] = None,
+):
+    from video_search.server import SearchHTTPServer, SearchService, SearchUnixServer
+
+    service = SearchService(global_config["db"])
+    if socket is not None:
+        server = SearchUnixServer(socket, service)
+        print(f"Serving {service.db_path} on {socket}")
+    else:
+        server = SearchHTTPServer((host, port), service)
+        print(f"Serving {service.db_path} on http://{host}:{port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if socket is not None:
+            socket.unlink(missing_ok=True)
 
 
 @app.callback()
@@ -0,0 +1,214 @@
+from collections.abc import Callable
+from dataclasses import dataclass
+from os import PathLike
+from typing import Any
+
+import numpy as np
+from imagehash import ImageHash, phash
+from PIL import Image as PILImage
+from PIL.Image import Image
+
+from video_search.decode import DecodeOptions
+from video_search.hash import pack_hashes, phash_image
+from video_search.profiling import Profiler
+from video_search.search import _read_records, nearest
+from video_search.storage import HashStorage, LazyVideoFrameHash, VideoFrames
+
+# Records fetched per query frame to find the videos worth aligning, and how
+# many of those videos are aligned
+CANDIDATE_RECORDS = 20
+CANDIDATE_VIDEOS = 50
+# Start times tried per query frame, from its closest frames in a video
+STARTS_PER_FRAME = 3
+# Seconds an expected frame time may be off by, as kept frames of the query
+# and the video do not fall on the same decoded frames
+TOLERANCE = 0.5
+
+
+@dataclass
+class ClipQuery:
+    # Packed hashes of the query frames and their times from its start
+    hashes: np.ndarray
+    times: np.ndarray
+    # Bits per hash
+    bits: int
+
+
+@dataclass
+class ClipResult:
+    path: str
+    # Where in the video the query starts, in seconds
+    start: float
+    # Mean hamming distance of the aligned frames as a fraction of the hash
+    # size, subtracted from 1
+    similarity: float
+    # Query frames whose aligned video frame is within `radius` of them
+    matched: int
+    frames: int
+    # The video frame aligned with the first query frame
+    match: LazyVideoFrameHash
+
+
+def hash_clip(
+    video: PathLike,
+    hash_algorithm: Callable[[Image], ImageHash] = phash,
+    options: DecodeOptions | None = None,
+    profiler: Profiler | None = None,
+) -> ClipQuery:
+    # Hashes the query the same way as indexing does, so its kept frames are
+    # the scene changes that were kept of the indexed videos
+    from video_search.video import hash_video
+
+    frames = list(hash_video(video, hash_algorithm, options=options, profiler=profiler))
+    if not frames:
+        raise ValueError(f"No frames in {video}")
+    return ClipQuery(
+        pack_hashes(np.stack([f.hash.hash for f in frames])),
+        np.array([f.time for f in frames], dtype=np.float64),
+        frames[0].hash.hash.size,
+    )
+
+
+def hash_images(
+    images: list[PathLike],
+    interval: float = 1.0,
+    hash_algorithm: Callable[[Image], ImageHash] = phash_image,
+    profiler: Profiler | None = None,
+) -> ClipQuery:
+    # An ordered image sequence taken every `interval` seconds
+    profiler = profiler or Profiler()
+    if not images:
+        raise ValueError("No query images")
+    with profiler.stage("query_hash", len(images)):
+        hashes = [hash_algorithm(PILImage.open(image)) for image in images]
+    return ClipQuery(
+        pack_hashes(np.stack([h.hash for h in hashes])),
+        np.arange(len(images), dtype=np.float64) * interval,
+        hashes[0].hash.size,
+    )
+
+
+def _candidate_videos(
+    storage: HashStorage,
+    query: ClipQuery,
+    max_distance: int | None,
+    profiler: Profiler,
+) -> list[str]:
+    # Videos with the most records among the closest ones to any query frame
+    found = nearest(
+        storage, query.hashes, CANDIDATE_RECORDS, max_distance, profiler=profiler
+    )
+    offsets = np.unique(np.concatenate([o for o, _ in found]))
+    hits: dict[str, int] = {}
+    for record in _read_records(storage, offsets, profiler):
+        path = str(record.path)
+        hits[path] = hits.get(path, 0) + 1
+    ranked = sorted(hits, key=lambda path: (-hits[path], path))
+    return ranked[:CANDIDATE_VIDEOS]
+
+
+def _align(
+    query: ClipQuery,
+    hashes: np.ndarray,
+    times: np.ndarray,
+    duration: float,
+    tolerance: float,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Scores every start time suggested by a close pair of query and video
+    # frames. The frame shown at a time is the last kept one before it, so
+    # every query frame is compared with the video frame kept before its
+    # expected time and, within the tolerance, the one after it. Query frames
+    # that fall outside the video count as the largest distance.
+    # Returns the starts, their mean distances and the distance of every
+    # aligned frame, best first.
+    distances = np.bitwise_count(hashes[np.newaxis] ^ query.hashes[:, np.newaxis]).sum(
+        axis=2, dtype=np.int64
+    )
+
+    k = min(STARTS_PER_FRAME, len(times))
+    closest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    starts = np.unique((times[closest] - query.times[:, np.newaxis]).ravel())
+
+    expected = starts[:, np.newaxis] + query.times
+    before = np.searchsorted(times, expected, "right") - 1
+    after = np.searchsorted(times, expected + tolerance, "right") - 1
+    rows = np.arange(len(query.times))
+    aligned = np.minimum(
+        distances[rows, np.maximum(before, 0)], distances[rows, np.maximum(after, 0)]
+    )
+    outside = (after < 0) | (expected > duration + tolerance)
+    aligned = np.where(outside, query.bits, aligned)
+
+    scores = aligned.mean(axis=1)
+    order = np.lexsort((starts, scores))
+    return starts[order], scores[order], aligned[order]
+
+
+def search_clip(
+    query: ClipQuery,
+    storage: HashStorage,
+    top_n: int = 10,
+    radius: int = 10,
+    tolerance: float = TOLERANCE,
+    max_distance: int | None = None,
+    progress_callback: Callable[[float, float], Any] | None = None,
+    profiler: Profiler | None = None,
+) -> list[ClipResult]:
+    # Finds where in the indexed videos the query clip appears. Candidate
+    # videos come from a frame search of every query frame, then the hash
+    # sequence of each is aligned with the query. Starts of the same video
+    # closer than the query's length are reported once.
+    profiler = profiler or Profiler()
+    paths = _candidate_videos(storage, query, max_distance, profiler)
+    videos = storage.videos()
+    length = float(query.times[-1])
+
+    candidates: list[tuple[float, str, float, int]] = []
+    frames_of: dict[str, VideoFrames] = {}
+    for i, path in enumerate(paths):
+        with profiler.stage("video_frames"):
+            frames = frames_of[path] = storage.video_frames(path)
+        if len(frames.offsets) == 0:
+            continue
+
+        entry = videos.get(path)
+        duration = float(frames.times[-1])
+        if entry is not None and entry.duration:
+            duration = max(duration, entry.duration)
+
+        with profiler.stage("align", len(frames.offsets) * len(query.times)):
+            starts, scores, aligned = _align(
+                query, frames.hashes, frames.times, duration, tolerance
+            )
+
+        kept: list[float] = []
+        for start, score, row in zip(starts, scores, aligned):
+            if any(abs(start - other) <= max(length, tolerance) for other in kept):
+                continue
+            kept.append(float(start))
+            candidates.append(
+                (float(score), path, float(start), int((row <= radius).sum()))
+            )
+            if len(kept) >= top_n:
+                break
+
+        if progress_callback:
+            progress_callback(float(i + 1), float(len(paths)))
+
+    candidates.sort(key=lambda c: (c[0], c[1], c[2]))
+    results = []
+    for score, path, start, matched in candidates[:top_n]:
+        frames = frames_of[path]
+        first = max(int(np.searchsorted(frames.times, start, "right")) - 1, 0)
+        [record] = _read_records(storage, [frames.offsets[first]], profiler)
+        results.append(
+            ClipResult(
+                path,
+                start,
+                1.0 - score / query.bits,
+                matched,
+                len(query.times),
+                record,
+            )
+        )
+    return results
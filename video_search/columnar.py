@@ -0,0 +1,655 @@
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from collections.abc import Callable
+from dataclasses import dataclass
+from itertools import pairwise
+from os import PathLike
+from pathlib import Path
+from typing import Any, BinaryIO
+
+import numpy as np
+from imagehash import ImageHash
+
+from video_search.hash import HashKind, pack_hash, unpack_hash
+from video_search.storage import (
+    HashStorage,
+    HashTable,
+    LazyVideoFrameHash,
+    LegacyHashStorage,
+    ManifestEntry,
+    SyncPolicy,
+    VideoFrames,
+    VideoStatus,
+    WriteOptions,
+)
+
+# Layout of a v2 database:
+#
+#   MAGIC
+#   block*
+#
+# Every block is a header, a column directory and the column data. Each column
+# starts at an 8-byte aligned file offset, so fixed-width columns (hashes,
+# times, ...) can be viewed straight out of a memory map. Variable sized data
+# (thumbnails, paths) is stored as a blob column addressed by an offset column.
+#
+# FRMS blocks hold frame records, MNFT blocks hold manifest entries describing
+# indexed videos. The latest manifest entry of a path decides which of its
+# records are live: records outside the entry's range were superseded.
+MAGIC = b"VSDB\x00\x02\r\n"
+BLOCK_HEADER = struct.Struct("<4sIIQ")  # kind, rows, columns, body length
+COLUMN_HEADER = struct.Struct("<8s4sIQ")  # name, dtype, width, length
+
+FRAMES = b"FRMS"
+MANIFEST = b"MNFT"
+TIME = struct.Struct("<d")
+
+
+def _pad(length: int) -> bytes:
+    return bytes(-length % 8)
+
+
+@dataclass
+class Column:
+    offset: int
+    dtype: np.dtype
+    width: int
+    length: int
+
+
+@dataclass
+class Block:
+    kind: bytes
+    offset: int
+    rows: int
+    columns: dict[str, Column]
+    end: int
+
+
+def encode_block(kind: bytes, rows: int, columns: dict[str, np.ndarray]) -> bytes:
+    body = bytearray()
+    for name, arr in columns.items():
+        width = arr.shape[1] if arr.ndim > 1 else 1
+        body += COLUMN_HEADER.pack(
+            name.encode("ascii"), arr.dtype.str.encode("ascii"), width, arr.nbytes
+        )
+    body += _pad(BLOCK_HEADER.size + len(body))
+
+    for arr in columns.values():
+        body += np.ascontiguousarray(arr).tobytes()
+        body += _pad(BLOCK_HEADER.size + len(body))
+
+    return BLOCK_HEADER.pack(kind, rows, len(columns), len(body)) + body
+
+
+def _offsets(lengths: list[int]) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.uint64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def record_checksum(frame: bytes, hash: np.ndarray, time: float, path: bytes) -> int:
+    return zlib.crc32(frame, zlib.crc32(hash.tobytes() + TIME.pack(time) + path))
+
+
+class ColumnarHashStorage(HashStorage):
+    def __init__(self, file: BinaryIO, write_options: WriteOptions | None = None):
+        self._file = file
+        self.write_options = write_options or WriteOptions()
+        self._file.seek(0, 2)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+            self._file.flush()
+
+        self._pending: list[
+            tuple[
+                bytes,
+                np.ndarray,
+                tuple[int, ...],
+                str,
+                float,
+                dict[HashKind, np.ndarray],
+            ]
+        ] = []
+        self._blocks: list[Block] = []
+        self._hash_starts: list[int] = []
+        self._scanned = len(MAGIC)
+        self._map: np.memmap | None = None
+        self._paths: dict[int, list[Path]] = {}
+        self._videos: dict[str, ManifestEntry] = {}
+        # First and last offset of the records written for every video whose
+        # manifest entry wasn't committed yet
+        self._uncommitted: dict[str, tuple[int, int]] = {}
+        # Bytes past the last complete block, left behind by a writer that was
+        # interrupted. They are cut off before anything is appended.
+        self._torn = False
+        self._scan_blocks()
+
+    def _size(self) -> int:
+        self._file.seek(0, 2)
+        return self._file.tell()
+
+    def _read_block(self, offset: int, size: int) -> Block | None:
+        if offset + BLOCK_HEADER.size > size:
+            return None
+
+        self._file.seek(offset)
+        kind, rows, count, length = BLOCK_HEADER.unpack(
+            self._file.read(BLOCK_HEADER.size)
+        )
+        end = offset + BLOCK_HEADER.size + length
+        if kind not in (FRAMES, MANIFEST) or end > size:
+            return None
+
+        directory = self._file.read(count * COLUMN_HEADER.size)
+        position = offset + BLOCK_HEADER.size + len(directory)
+        position += -position % 8
+
+        columns: dict[str, Column] = {}
+        for i in range(count):
+            name, dtype, width, col_length = COLUMN_HEADER.unpack_from(
+                directory, i * COLUMN_HEADER.size
+            )
+            columns[name.rstrip(b"\0").decode("ascii")] = Column(
+                position,
+                np.dtype(dtype.rstrip(b"\0").decode("ascii")),
+                width,
+                col_length,
+            )
+            position += col_length + (-col_length % 8)
+
+        return Block(kind, offset, rows, columns, end)
+
+    def _refresh(self) -> int:
+        self.flush()
+        return self._scan_blocks()
+
+    def _scan_blocks(self) -> int:
+        size = self._size()
+        new_blocks: list[Block] = []
+        while block := self._read_block(self._scanned, size):
+            new_blocks.append(block)
+            if block.kind == FRAMES:
+                self._hash_starts.append(block.columns["hash"].offset)
+            self._scanned = block.end
+        self._blocks.extend(new_blocks)
+        self._torn = self._scanned < size
+
+        if self._scanned > len(MAGIC) and (
+            self._map is None or len(self._map) < self._scanned
+        ):
+            self._map = np.memmap(self._file, dtype=np.uint8, mode="r")
+
+        for block in new_blocks:
+            if block.kind == MANIFEST:
+                for entry in self._manifest_entries(block):
+                    self._videos[entry.path] = entry
+        return size
+
+    def _frame_blocks(self) -> list[Block]:
+        return [block for block in self._blocks if block.kind == FRAMES]
+
+    def _column(self, block: Block, name: str) -> np.ndarray:
+        assert self._map is not None
+        column = block.columns[name]
+        data = self._map[column.offset : column.offset + column.length]
+        values = data.view(column.dtype)
+        if column.width > 1:
+            return values.reshape(-1, column.width)
+        return values
+
+    def _hashes(self, block: Block) -> np.ndarray:
+        return self._column(block, "hash").reshape(block.rows, -1)
+
+    def _block_paths(self, block: Block) -> list[Path]:
+        if block.offset not in self._paths:
+            offsets = self._column(block, "pathoff")
+            data = self._column(block, "paths")
+            self._paths[block.offset] = [
+                Path(bytes(data[start:end]).decode("utf-8"))
+                for start, end in pairwise(offsets)
+            ]
+        return self._paths[block.offset]
+
+    def _manifest_entries(self, block: Block) -> list[ManifestEntry]:
+        columns = [
+            self._column(block, name)
+            for name in (
+                "size",
+                "mtime",
+                "duration",
+                "frames",
+                "status",
+                "first",
+                "last",
+            )
+        ]
+        return [
+            ManifestEntry(
+                str(path),
+                int(size),
+                float(mtime),
+                float(duration),
+                int(frames),
+                VideoStatus(int(status)),
+                int(first),
+                int(last),
+            )
+            for path, size, mtime, duration, frames, status, first, last in zip(
+                self._block_paths(block), *columns
+            )
+        ]
+
+    def _record_offsets(self, block: Block) -> np.ndarray:
+        column = block.columns["hash"]
+        return column.offset + np.arange(block.rows, dtype=np.int64) * (
+            column.length // block.rows
+        )
+
+    def _live(self, block: Block, offsets: np.ndarray) -> np.ndarray | None:
+        # Returns a mask of the records in the block that are still live, or
+        # None when all of them are.
+        ids = self._column(block, "path_id")
+        mask = None
+        for path_id, path in enumerate(self._block_paths(block)):
+            entry = self._videos.get(str(path))
+            if entry is None:
+                continue
+
+            dead = (ids == path_id) & ((offsets < entry.first) | (offsets > entry.last))
+            if dead.any():
+                mask = ~dead if mask is None else mask & ~dead
+        return mask
+
+    def _record(self, block: Block, row: int) -> LazyVideoFrameHash:
+        assert self._map is not None
+        thumb_offsets = self._column(block, "thumboff")
+        thumbs = block.columns["thumbs"].offset
+        shape = tuple(int(x) for x in self._column(block, "hshape"))
+        return LazyVideoFrameHash.from_buffer(
+            self._map,
+            thumbs + int(thumb_offsets[row]),
+            int(thumb_offsets[row + 1] - thumb_offsets[row]),
+            unpack_hash(self._hashes(block)[row], shape),
+            self._block_paths(block)[self._column(block, "path_id")[row]],
+            float(self._column(block, "time")[row]),
+        )
+
+    def __iter__(self):
+        return self.iter_with_progress()
+
+    def iter_with_progress(
+        self, progress_callback: Callable[[float, float], Any] | None = None
+    ):
+        total = float(self._refresh())
+        for block in self._frame_blocks():
+            live = self._live(block, self._record_offsets(block))
+            for row in range(block.rows):
+                if live is None or live[row]:
+                    yield self._record(block, row)
+            if progress_callback:
+                progress_callback(float(block.end), total)
+
+        if progress_callback:
+            progress_callback(total, total)
+
+    def append_record(
+        self,
+        frame_data: bytes,
+        hash: ImageHash,
+        path: PathLike[str],
+        time: float,
+        extra: dict[HashKind, ImageHash] | None = None,
+    ):
+        # Records of a block share the hash shape and the additional hashes
+        shape = hash.hash.shape
+        packed = {kind: pack_hash(h) for kind, h in (extra or {}).items()}
+        if self._pending and (
+            self._pending[0][2] != shape or self._pending[0][5].keys() != packed.keys()
+        ):
+            self.flush()
+        self._pending.append(
+            (frame_data, pack_hash(hash), shape, str(path), time, packed)
+        )
+        if len(self._pending) >= self.write_options.batch_size:
+            self.flush()
+
+    def _prepare_write(self) -> int:
+        # Returns the offset new data is written at. Other processes may read
+        # the database concurrently, so the torn tail is only checked for once
+        # this process starts writing.
+        self._scan_blocks()
+        if self._torn:
+            self._file.truncate(self._scanned)
+            self._torn = False
+        return self._scanned
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        frames, hashes, shapes, paths, times, extras = zip(*self._pending)
+        self._pending = []
+
+        unique_paths = list(dict.fromkeys(paths))
+        path_ids = {path: i for i, path in enumerate(unique_paths)}
+        encoded_paths = [path.encode("utf-8") for path in unique_paths]
+        ids = np.array([path_ids[p] for p in paths], dtype=np.uint32)
+        stacked = np.stack(hashes)
+        checksums = [
+            record_checksum(frame, row, time, encoded_paths[path_ids[path]])
+            for frame, row, time, path in zip(frames, stacked, times, paths)
+        ]
+
+        block = encode_block(
+            FRAMES,
+            len(frames),
+            {
+                "hash": stacked,
+                "hshape": np.array(shapes[0], dtype=np.uint32),
+                "time": np.array(times, dtype=np.float64),
+                "path_id": ids,
+                "pathoff": _offsets([len(p) for p in encoded_paths]),
+                "paths": np.frombuffer(b"".join(encoded_paths), dtype=np.uint8),
+                "thumboff": _offsets([len(f) for f in frames]),
+                "thumbs": np.frombuffer(b"".join(frames), dtype=np.uint8),
+                "crc": np.array(checksums, dtype=np.uint32),
+                **{
+                    kind.value: np.stack([extra[kind] for extra in extras])
+                    for kind in extras[0]
+                },
+            },
+        )
+        position = self._prepare_write()
+        self._file.write(block)
+        self._file.flush()
+        if self.write_options.sync == SyncPolicy.BATCH:
+            os.fsync(self._file.fileno())
+
+        written = self._read_block(position, position + len(block))
+        assert written is not None
+        offsets = self._record_offsets(written)
+        for path, path_id in path_ids.items():
+            selected = offsets[ids == path_id]
+            first = self._uncommitted.get(path, (int(selected[0]), 0))[0]
+            self._uncommitted[path] = (first, int(selected[-1]))
+        self._written(stacked, offsets)
+
+    def videos(self) -> dict[str, ManifestEntry]:
+        self._refresh()
+        return self._videos
+
+    def commit_video(self, entry: ManifestEntry):
+        self.flush()
+        # Records of a removed video written meanwhile are dropped with it
+        span = self._uncommitted.pop(entry.path, None)
+        if span is not None and entry.status != VideoStatus.REMOVED:
+            entry.first, entry.last = span
+
+        previous = self.videos().get(entry.path)
+        encoded_path = entry.path.encode("utf-8")
+        self._prepare_write()
+        self._file.write(
+            encode_block(
+                MANIFEST,
+                1,
+                {
+                    "pathoff": _offsets([len(encoded_path)]),
+                    "paths": np.frombuffer(encoded_path, dtype=np.uint8),
+                    "size": np.array([entry.size], dtype=np.int64),
+                    "mtime": np.array([entry.mtime], dtype=np.float64),
+                    "duration": np.array([entry.duration], dtype=np.float64),
+                    "frames": np.array([entry.frames], dtype=np.int64),
+                    "status": np.array([entry.status], dtype=np.uint8),
+                    "first": np.array([entry.first], dtype=np.int64),
+                    "last": np.array([entry.last], dtype=np.int64),
+                },
+            )
+        )
+        self._file.flush()
+        if self.write_options.sync != SyncPolicy.NEVER:
+            os.fsync(self._file.fileno())
+
+        if self.index is not None:
+            self.index.reconcile([e for e in (previous, entry) if e is not None])
+
+    def video_frames(self, path: str) -> VideoFrames:
+        # The live records of a video lie between the first and last offset of
+        # its manifest entry, records without one are all live
+        self._refresh()
+        entry = self._videos.get(path)
+        first, last = (entry.first, entry.last) if entry else (0, self._size())
+        if entry is not None and first < 0:
+            return VideoFrames.empty()
+
+        offsets: list[np.ndarray] = []
+        times: list[np.ndarray] = []
+        hashes: list[np.ndarray] = []
+        for block in self._frame_blocks():
+            block_offsets = self._record_offsets(block)
+            if block_offsets[-1] < first or block_offsets[0] > last:
+                continue
+
+            block_paths = [str(p) for p in self._block_paths(block)]
+            if path not in block_paths:
+                continue
+            keep = (
+                (self._column(block, "path_id") == block_paths.index(path))
+                & (block_offsets >= first)
+                & (block_offsets <= last)
+            )
+            offsets.append(block_offsets[keep])
+            times.append(self._column(block, "time")[keep])
+            hashes.append(self._hashes(block)[keep])
+
+        if not offsets:
+            return VideoFrames.empty()
+        return VideoFrames(
+            np.concatenate(offsets), np.concatenate(times), np.concatenate(hashes)
+        )
+
+    def hash_table(
+        self,
+        progress_callback: Callable[[float, float], Any] | None = None,
+        after: int = -1,
+    ) -> HashTable:
+        total = float(self._refresh())
+
+        hashes: list[np.ndarray] = []
+        offsets: list[np.ndarray] = []
+        for block in self._frame_blocks():
+            block_offsets = self._record_offsets(block)
+            if after >= block_offsets[-1]:
+                continue
+            block_hashes = self._hashes(block)
+            if hashes and block_hashes.shape[1] != hashes[0].shape[1]:
+                raise ValueError("Database contains hashes of different sizes")
+
+            keep = self._live(block, block_offsets)
+            if after >= block_offsets[0]:
+                after_mask = block_offsets > after
+                keep = after_mask if keep is None else keep & after_mask
+            if keep is not None:
+                block_hashes = block_hashes[keep]
+                block_offsets = block_offsets[keep]
+
+            hashes.append(block_hashes)
+            offsets.append(block_offsets)
+            if progress_callback:
+                progress_callback(float(block.end), total)
+
+        if progress_callback:
+            progress_callback(total, total)
+
+        if not hashes:
+            return HashTable(np.empty((0, 1), np.uint64), np.empty(0, np.int64))
+        if len(hashes) == 1:
+            return HashTable(hashes[0], offsets[0])
+        return HashTable(np.concatenate(hashes), np.concatenate(offsets))
+
+    def extra_hashes(
+        self, kind: HashKind, offsets: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        hashes, present = super().extra_hashes(kind, offsets)
+        self._refresh()
+        offsets = np.asarray(offsets, dtype=np.int64)
+        frame_blocks = self._frame_blocks()
+        which = np.searchsorted(self._hash_starts, offsets, side="right") - 1
+        for i in np.unique(which):
+            block = frame_blocks[i]
+            if kind.value not in block.columns:
+                continue
+
+            selected = which == i
+            column = block.columns["hash"]
+            rows = (offsets[selected] - column.offset) // (column.length // block.rows)
+            hashes[selected] = self._column(block, kind.value).reshape(block.rows, -1)[
+                rows
+            ]
+            present[selected] = True
+        return hashes, present
+
+    def verify(
+        self, progress_callback: Callable[[float, float], Any] | None = None
+    ) -> tuple[int, list[int]]:
+        # Recomputes the checksum of every record. Returns the number of
+        # records checked and the offsets of those that don't match. Blocks
+        # written before checksums were added are skipped.
+        total = float(self._refresh())
+        checked = 0
+        corrupt: list[int] = []
+        for block in self._frame_blocks():
+            if "crc" in block.columns:
+                assert self._map is not None
+                hashes = self._hashes(block)
+                times = self._column(block, "time")
+                ids = self._column(block, "path_id")
+                thumb_offsets = self._column(block, "thumboff")
+                thumbs = self._column(block, "thumbs")
+                paths = [str(p).encode("utf-8") for p in self._block_paths(block)]
+                offsets = self._record_offsets(block)
+                for row, expected in enumerate(self._column(block, "crc")):
+                    frame = thumbs[thumb_offsets[row] : thumb_offsets[row + 1]]
+                    checksum = record_checksum(
+                        frame.tobytes(), hashes[row], float(times[row]), paths[ids[row]]
+                    )
+                    if checksum != expected:
+                        corrupt.append(int(offsets[row]))
+                checked += block.rows
+            if progress_callback:
+                progress_callback(float(block.end), total)
+
+        if progress_callback:
+            progress_callback(total, total)
+        return checked, corrupt
+
+    def read_record(self, offset: int) -> LazyVideoFrameHash:
+        self._refresh()
+        frame_blocks = self._frame_blocks()
+        block = frame_blocks[bisect_right(self._hash_starts, offset) - 1]
+        row = (offset - block.columns["hash"].offset) // self._hashes(block).strides[0]
+        return self._record(block, row)
+
+
+def migrate(
+    source: LegacyHashStorage,
+    target: ColumnarHashStorage,
+    progress_callback: Callable[[float, float], Any] | None = None,
+):
+    # Thumbnails are copied as-is, there is no need to decode and re-encode them.
+    # A manifest entry is written whenever the path changes, so a video that was
+    # indexed more than once only keeps its last copy.
+    path: str | None = None
+    frames = 0
+    for record in source.iter_with_progress(progress_callback):
+        if str(record.path) != path:
+            if path is not None:
+                target.commit_video(
+                    ManifestEntry.for_file(
+                        Path(path), 0.0, frames, VideoStatus.COMPLETE
+                    )
+                )
+            path = str(record.path)
+            frames = 0
+
+        target.append_record(
+            bytes(record.frame_data), record.hash, record.path, record.time
+        )
+        frames += 1
+
+    if path is not None:
+        target.commit_video(
+            ManifestEntry.for_file(Path(path), 0.0, frames, VideoStatus.COMPLETE)
+        )
+
+
+def compact(
+    source: ColumnarHashStorage,
+    target: ColumnarHashStorage,
+    keep: Callable[[str], bool] | None = None,
+    progress_callback: Callable[[float, float], Any] | None = None,
+):
+    # Copies the live records of every video `keep` accepts, one video after
+    # the other, together with its manifest entry. Superseded and removed
+    # records are left behind.
+    total = float(source._refresh())
+    videos = source.videos()
+    rows: dict[str, list[tuple[Block, np.ndarray]]] = {}
+    for block in source._frame_blocks():
+        live = source._live(block, source._record_offsets(block))
+        ids = source._column(block, "path_id")
+        for path_id, path in enumerate(source._block_paths(block)):
+            selected = ids == path_id
+            if live is not None:
+                selected &= live
+            if selected.any() and (keep is None or keep(str(path))):
+                rows.setdefault(str(path), []).append((block, np.flatnonzero(selected)))
+
+    for done, (path, parts) in enumerate(rows.items()):
+        frames = 0
+        for block, block_rows in parts:
+            extras = [kind for kind in HashKind if kind.value in block.columns]
+            for row in block_rows:
+                record = source._record(block, int(row))
+                extra = {
+                    kind: unpack_hash(
+                        source._column(block, kind.value).reshape(block.rows, -1)[row],
+                        kind.shape,
+                    )
+                    for kind in extras
+                }
+                target.append_record(
+                    bytes(record.frame_data),
+                    record.hash,
+                    record.path,
+                    record.time,
+                    extra,
+                )
+                frames += 1
+
+        entry = videos.get(path)
+        if entry is None:
+            entry = ManifestEntry(path, -1, -1.0, 0.0, frames, VideoStatus.COMPLETE)
+        target.commit_video(
+            ManifestEntry(
+                path, entry.size, entry.mtime, entry.duration, frames, entry.status
+            )
+        )
+        if progress_callback:
+            progress_callback(total * (done + 1) / len(rows), total)
+
+    # Videos without any frames are kept too, so they aren't indexed again
+    for path, entry in videos.items():
+        if path in rows or entry.status == VideoStatus.REMOVED:
+            continue
+        if keep is None or keep(path):
+            target.commit_video(
+                ManifestEntry(
+                    path, entry.size, entry.mtime, entry.duration, 0, entry.status
+                )
+            )
+
+    if progress_callback:
+        progress_callback(total, total)
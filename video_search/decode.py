@@ -0,0 +1,19 @@
+from dataclasses import dataclass
+from enum import Enum
+
+# Kept apart from video.py, which imports PyAV, so that the options can be
+# used without loading it
+
+
+class DecodeMode(str, Enum):
+    ALL = "all"
+    KEYFRAMES = "keyframes"
+    SAMPLE = "sample"
+
+
+@dataclass
+class DecodeOptions:
+    mode: DecodeMode = DecodeMode.ALL
+    sample_rate: float = 1.0
+    threads: bool = False
+    interpolation: str = "LANCZOS"
@@ -0,0 +1,144 @@
+from dataclasses import dataclass
+from enum import Enum
+
+import numpy as np
+from imagehash import ImageHash
+
+from video_search.hash import hamming_distances, pack_hash
+from video_search.index import MultiIndexHash
+
+# New hashes are scanned linearly until there are this many of them, then
+# they are added to the multi-index
+PENDING_SIZE = 4096
+
+
+class DedupeScope(str, Enum):
+    NONE = "none"
+    # Frames are compared to the frames kept of the same video
+    VIDEO = "video"
+    # ... and to every frame already in the database or indexed before
+    DATABASE = "database"
+
+
+class DedupeAction(str, Enum):
+    SKIP = "skip"
+    # The frame is stored without a thumbnail, so search still finds it and
+    # the thumbnail is decoded from the video when displayed
+    REFERENCE = "reference"
+
+
+@dataclass
+class DedupeOptions:
+    scope: DedupeScope = DedupeScope.NONE
+    # Hamming distance up to which frames count as near-duplicates
+    radius: int = 4
+    action: DedupeAction = DedupeAction.REFERENCE
+
+
+@dataclass
+class DedupeReport:
+    frames: int = 0
+    skipped: int = 0
+    referenced: int = 0
+
+    def merge(self, other: "DedupeReport"):
+        self.frames += other.frames
+        self.skipped += other.skipped
+        self.referenced += other.referenced
+
+
+class NearDuplicates:
+    # Packed hashes of kept frames, to look up whether a new frame is within
+    # `radius` of one of them
+    def __init__(self, radius: int, hashes: np.ndarray | None = None):
+        self.radius = radius
+        self._hashes: list[np.ndarray] = []
+        self._index: MultiIndexHash | None = None
+        self._pending: np.ndarray | None = None
+        self._pending_size = 0
+        if hashes is not None and len(hashes):
+            self._add_to_index(hashes)
+
+    def _add_to_index(self, hashes: np.ndarray):
+        hashes = np.ascontiguousarray(hashes, dtype=np.uint64)
+        self._hashes.append(hashes)
+        offsets = np.arange(len(hashes), dtype=np.int64)
+        if self._index is None:
+            self._index = MultiIndexHash(hashes, offsets)
+        else:
+            self._index.add(hashes, offsets)
+
+    def contains(self, packed: np.ndarray) -> bool:
+        if self._pending is not None and self._pending_size:
+            pending = self._pending[: self._pending_size]
+            if (hamming_distances(pending, packed) <= self.radius).any():
+                return True
+
+        if self._index is None:
+            return False
+        found = self._index.search(packed, 1, self.radius)
+        if found is not None:
+            return len(found[0]) > 0
+        # The index can't answer this radius, so all hashes are scanned
+        return any(
+            (hamming_distances(hashes, packed) <= self.radius).any()
+            for hashes in self._hashes
+        )
+
+    def add(self, packed: np.ndarray):
+        if self._pending is None:
+            self._pending = np.empty((PENDING_SIZE, len(packed)), dtype=np.uint64)
+        self._pending[self._pending_size] = packed
+        self._pending_size += 1
+        if self._pending_size == PENDING_SIZE:
+            self._add_to_index(self._pending.copy())
+            self._pending_size = 0
+
+
+class Deduplicator:
+    # Decides for every frame kept by hash_video whether it is stored, skipped
+    # or stored as a reference. `existing` are the packed hashes of the
+    # database, only used with the database scope.
+    def __init__(self, options: DedupeOptions, existing: np.ndarray | None = None):
+        self.options = options
+        self.report = DedupeReport()
+        self._video = NearDuplicates(options.radius)
+        self._database: NearDuplicates | None = None
+        if options.scope == DedupeScope.DATABASE:
+            self._database = NearDuplicates(options.radius, existing)
+
+    def start_video(self):
+        self._video = NearDuplicates(self.options.radius)
+
+    def _duplicate(self, action: DedupeAction) -> DedupeAction:
+        if action == DedupeAction.SKIP:
+            self.report.skipped += 1
+        else:
+            self.report.referenced += 1
+        return action
+
+    def check(self, hash: ImageHash) -> DedupeAction | None:
+        # Returns what to do with the frame, None when it is stored in full
+        if self.options.scope == DedupeScope.NONE:
+            return None
+
+        self.report.frames += 1
+        packed = pack_hash(hash)
+        if self._video.contains(packed):
+            return self._duplicate(self.options.action)
+        self._video.add(packed)
+        return self.check_database(hash, packed)
+
+    def check_database(
+        self, hash: ImageHash, packed: np.ndarray | None = None
+    ) -> DedupeAction | None:
+        # Only compares to the database. Used by the writer of a parallel run,
+        # whose workers already compared frames within each video.
+        if self._database is None:
+            return None
+
+        packed = pack_hash(hash) if packed is None else packed
+        if self._database.contains(packed):
+            return self._duplicate(self.options.action)
+        self._database.add(packed)
+        return None
@@ -9,10 +9,12 @@ from PyQt6.QtGui import QDragEnterEvent, QDropEvent, QImage, QPixmap
 from PyQt6.QtWidgets import (
     QApplication,
     QCheckBox,
+    QComboBox,
     QDoubleSpinBox,
     QFileDialog,
     QFormLayout,
     QFrame,
+    QGroupBox,
     QHBoxLayout,
     QLabel,
     QLineEdit,
@@ -21,14 +23,21 @@ from PyQt6.QtWidgets import (
     QProgressBar,
     QPushButton,
     QScrollArea,
+    QSpinBox,
     QStatusBar,
+    QTableWidget,
+    QTableWidgetItem,
     QTabWidget,
     QVBoxLayout,
     QWidget,
 )
 from qt_material import apply_stylesheet
 
+from video_search.dedupe import DedupeAction, DedupeOptions, DedupeReport, DedupeScope
 from video_search.gui.workers import IndexWorker, SearchWorker
+from video_search.hash import ThumbnailFormat, ThumbnailOptions
+from video_search.profiling import Profiler
+from video_search.video import DecodeMode, DecodeOptions
 
 
 def pil_to_pixmap(image: Image) -> QPixmap:
@@ -47,6 +56,52 @@ def format_seconds(total_seconds: float) -> str:
     return f"{hours:02d}:{minutes:02d}:{seconds:07.4f}"
 
 
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+
+class StatsPanel(QGroupBox):
+    # Time spent in every stage of the last indexing run or search
+    def __init__(self):
+        super().__init__("Statistics")
+        self.setVisible(False)
+
+        layout = QVBoxLayout(self)
+        self._table = QTableWidget(0, 5)
+        self._table.setHorizontalHeaderLabels(
+            ["Stage", "Time (s)", "Items", "Items/s", "Bytes"]
+        )
+        self._table.verticalHeader().setVisible(False)
+        self._table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self._table.setMaximumHeight(180)
+        layout.addWidget(self._table)
+        self._counters = QLabel()
+        layout.addWidget(self._counters)
+
+    def show_profile(self, profiler: Profiler):
+        self._table.setRowCount(len(profiler.stages))
+        for row, (name, stage) in enumerate(profiler.stages.items()):
+            rate = stage.items / stage.seconds if stage.seconds > 0 else 0.0
+            cells = [
+                name,
+                f"{stage.seconds:.3f}",
+                str(stage.items),
+                f"{rate:.1f}",
+                format_bytes(stage.bytes) if stage.bytes else "-",
+            ]
+            for column, text in enumerate(cells):
+                self._table.setItem(row, column, QTableWidgetItem(text))
+        self._table.resizeColumnsToContents()
+        self._counters.setText(
+            "  ".join(f"{name}: {count}" for name, count in profiler.counters.items())
+        )
+        self.setVisible(True)
+
+
 class ResultCard(QFrame):
     def __init__(self, pixmap: QPixmap, path: str, time: float, similarity: float):
         super().__init__()
@@ -94,6 +149,8 @@ class Settings:
     def __init__(self):
         self.db_path = "data.db"
         self.threshold = 0.80
+        # Searches stop once this many exact matches were found, 0 never stops
+        self.stop_after_exact = 0
 
 
 class SettingsTab(QWidget):
@@ -123,6 +180,13 @@ class SettingsTab(QWidget):
         self._threshold.valueChanged.connect(self._on_threshold_changed)
         form.addRow("Search threshold:", self._threshold)
 
+        self._stop_after_exact = QSpinBox()
+        self._stop_after_exact.setRange(0, 1000)
+        self._stop_after_exact.setValue(settings.stop_after_exact)
+        self._stop_after_exact.setSpecialValueText("Never")
+        self._stop_after_exact.valueChanged.connect(self._on_stop_after_exact_changed)
+        form.addRow("Stop after exact matches:", self._stop_after_exact)
+
         layout.addLayout(form)
         layout.addStretch()
 
@@ -131,7 +195,7 @@ class SettingsTab(QWidget):
             self,
             "Select Database File",
             self._db_edit.text(),
-            "Database (*.db);;All Files (*)",
+            "Database (*.db *.catalog);;All Files (*)",
         )
         if path:
             self._db_edit.setText(path)
@@ -142,6 +206,9 @@ class SettingsTab(QWidget):
     def _on_threshold_changed(self, value: float):
         self._settings.threshold = value
 
+    def _on_stop_after_exact_changed(self, value: int):
+        self._settings.stop_after_exact = value
+
 
 class IndexTab(QWidget):
     def __init__(self, settings: Settings, status_bar: QStatusBar):
@@ -149,6 +216,7 @@ class IndexTab(QWidget):
         self._settings = settings
         self._status_bar = status_bar
         self._worker: IndexWorker | None = None
+        self._dedupe_report: DedupeReport | None = None
 
         layout = QVBoxLayout(self)
         layout.setSpacing(12)
@@ -166,9 +234,77 @@ class IndexTab(QWidget):
         opts_row = QHBoxLayout()
         self._recurse_cb = QCheckBox("Scan recursively")
         opts_row.addWidget(self._recurse_cb)
+        opts_row.addSpacing(16)
+        opts_row.addWidget(QLabel("Parallel jobs:"))
+        self._jobs = QSpinBox()
+        self._jobs.setRange(1, os.cpu_count() or 1)
+        self._jobs.setValue(1)
+        opts_row.addWidget(self._jobs)
         opts_row.addStretch()
         layout.addLayout(opts_row)
 
+        decode_row = QHBoxLayout()
+        decode_row.addWidget(QLabel("Decode:"))
+        self._decode_mode = QComboBox()
+        for mode in DecodeMode:
+            self._decode_mode.addItem(mode.value, mode)
+        self._decode_mode.currentIndexChanged.connect(self._on_decode_mode_changed)
+        decode_row.addWidget(self._decode_mode)
+        self._sample_rate = QDoubleSpinBox()
+        self._sample_rate.setRange(0.05, 60.0)
+        self._sample_rate.setValue(1.0)
+        self._sample_rate.setSuffix(" fps")
+        self._sample_rate.setEnabled(False)
+        decode_row.addWidget(self._sample_rate)
+        decode_row.addSpacing(16)
+        decode_row.addWidget(QLabel("Scaling:"))
+        self._interpolation = QComboBox()
+        self._interpolation.addItems(["LANCZOS", "BICUBIC", "BILINEAR", "AREA"])
+        decode_row.addWidget(self._interpolation)
+        self._threads_cb = QCheckBox("Threaded decoding")
+        decode_row.addWidget(self._threads_cb)
+        decode_row.addStretch()
+        layout.addLayout(decode_row)
+
+        thumb_row = QHBoxLayout()
+        thumb_row.addWidget(QLabel("Thumbnails:"))
+        self._thumbnail_format = QComboBox()
+        for fmt in ThumbnailFormat:
+            self._thumbnail_format.addItem(fmt.value, fmt)
+        self._thumbnail_format.currentIndexChanged.connect(
+            self._on_thumbnail_format_changed
+        )
+        thumb_row.addWidget(self._thumbnail_format)
+        self._thumbnail_quality = QSpinBox()
+        self._thumbnail_quality.setRange(1, 100)
+        self._thumbnail_quality.setValue(85)
+        self._thumbnail_quality.setPrefix("Quality: ")
+        self._thumbnail_quality.setEnabled(False)
+        thumb_row.addWidget(self._thumbnail_quality)
+        thumb_row.addStretch()
+        layout.addLayout(thumb_row)
+
+        dedupe_row = QHBoxLayout()
+        dedupe_row.addWidget(QLabel("Near-duplicates:"))
+        self._dedupe_scope = QComboBox()
+        for scope in DedupeScope:
+            self._dedupe_scope.addItem(scope.value, scope)
+        self._dedupe_scope.currentIndexChanged.connect(self._on_dedupe_scope_changed)
+        dedupe_row.addWidget(self._dedupe_scope)
+        self._dedupe_radius = QSpinBox()
+        self._dedupe_radius.setRange(0, 16)
+        self._dedupe_radius.setValue(4)
+        self._dedupe_radius.setPrefix("Radius: ")
+        self._dedupe_radius.setEnabled(False)
+        dedupe_row.addWidget(self._dedupe_radius)
+        self._dedupe_action = QComboBox()
+        for action in DedupeAction:
+            self._dedupe_action.addItem(action.value, action)
+        self._dedupe_action.setEnabled(False)
+        dedupe_row.addWidget(self._dedupe_action)
+        dedupe_row.addStretch()
+        layout.addLayout(dedupe_row)
+
         self._progress_group = QWidget()
         self._progress_group.setVisible(False)
         pg_layout = QVBoxLayout(self._progress_group)
@@ -204,8 +340,27 @@ class IndexTab(QWidget):
         btn_row.addStretch()
         layout.addLayout(btn_row)
 
+        self._stats = StatsPanel()
+        layout.addWidget(self._stats)
+
         layout.addStretch()
 
+    def _on_decode_mode_changed(self):
+        self._sample_rate.setEnabled(
+            self._decode_mode.currentData() == DecodeMode.SAMPLE
+        )
+
+    def _on_thumbnail_format_changed(self):
+        self._thumbnail_quality.setEnabled(
+            self._thumbnail_format.currentData()
+            in (ThumbnailFormat.JPEG, ThumbnailFormat.WEBP)
+        )
+
+    def _on_dedupe_scope_changed(self):
+        enabled = self._dedupe_scope.currentData() != DedupeScope.NONE
+        self._dedupe_radius.setEnabled(enabled)
+        self._dedupe_action.setEnabled(enabled)
+
     def _browse_dir(self):
         d = QFileDialog.getExistingDirectory(self, "Select Video Directory")
         if d:
@@ -235,9 +390,34 @@ class IndexTab(QWidget):
         self._file_progress.setValue(0)
         self._status_bar.showMessage("Indexing...")
 
-        self._worker = IndexWorker(path, db_path, self._recurse_cb.isChecked())
+        options = DecodeOptions(
+            self._decode_mode.currentData(),
+            self._sample_rate.value(),
+            self._threads_cb.isChecked(),
+            self._interpolation.currentText(),
+        )
+        thumbnails = ThumbnailOptions(
+            self._thumbnail_format.currentData(), self._thumbnail_quality.value()
+        )
+        dedupe = DedupeOptions(
+            self._dedupe_scope.currentData(),
+            self._dedupe_radius.value(),
+            self._dedupe_action.currentData(),
+        )
+        self._dedupe_report = None
+        self._worker = IndexWorker(
+            path,
+            db_path,
+            self._recurse_cb.isChecked(),
+            self._jobs.value(),
+            options,
+            thumbnails,
+            dedupe,
+        )
         self._worker.signals.progress.connect(self._on_progress)
         self._worker.signals.file_progress.connect(self._on_file_progress)
+        self._worker.signals.stats.connect(self._stats.show_profile)
+        self._worker.signals.dedupe_report.connect(self._on_dedupe_report)
         self._worker.signals.finished.connect(self._on_finished)
         self._worker.signals.error.connect(self._on_error)
         QThreadPool.globalInstance().start(self._worker)
@@ -261,16 +441,23 @@ class IndexTab(QWidget):
         else:
             self._file_progress.setValue(0)
 
+    def _on_dedupe_report(self, report: DedupeReport):
+        self._dedupe_report = report
+
     def _on_finished(self):
         cancelled = self._worker._cancelled if self._worker else False
         self._index_btn.setEnabled(True)
         self._cancel_btn.setVisible(False)
         self._cancel_btn.setEnabled(True)
         self._progress_group.setVisible(False)
-        if cancelled:
-            self._status_bar.showMessage("Indexing cancelled.", 5000)
-        else:
-            self._status_bar.showMessage("Indexing complete.", 5000)
+        message = "Indexing cancelled." if cancelled else "Indexing complete."
+        report = self._dedupe_report
+        if report is not None and report.frames:
+            message += (
+                f" {report.skipped + report.referenced} of {report.frames} "
+                "frame(s) were near-duplicates."
+            )
+        self._status_bar.showMessage(message, 5000)
         self._worker = None
 
     def _on_error(self, msg: str):
@@ -289,6 +476,7 @@ class SearchTab(QWidget):
         self._settings = settings
         self._status_bar = status_bar
         self._image_path: Path | None = None
+        self._worker: SearchWorker | None = None
         self.setAcceptDrops(True)
 
         layout = QVBoxLayout(self)
@@ -306,6 +494,10 @@ class SearchTab(QWidget):
         self._search_btn = QPushButton("Search")
         self._search_btn.clicked.connect(self._start_search)
         top_row.addWidget(self._search_btn)
+        self._cancel_btn = QPushButton("Cancel")
+        self._cancel_btn.setVisible(False)
+        self._cancel_btn.clicked.connect(self._cancel_search)
+        top_row.addWidget(self._cancel_btn)
         layout.addLayout(top_row)
 
         self._search_progress = QProgressBar()
@@ -328,6 +520,9 @@ class SearchTab(QWidget):
         self._results_area.setWidget(self._results_container)
         layout.addWidget(self._results_area, 1)
 
+        self._stats = StatsPanel()
+        layout.addWidget(self._stats)
+
     def _browse_image(self):
         path, _ = QFileDialog.getOpenFileName(
             self, "Select Image", "", "Images (*.png *.jpg *.jpeg *.bmp *.webp)"
@@ -380,21 +575,36 @@ class SearchTab(QWidget):
 
         self._clear_results()
         self._search_btn.setEnabled(False)
+        self._cancel_btn.setVisible(True)
         self._status_bar.showMessage("Searching...")
 
-        worker = SearchWorker(self._image_path, db_path, self._settings.threshold)
-        worker.signals.result.connect(self._on_result)
-        worker.signals.finished.connect(self._on_finished)
-        worker.signals.error.connect(self._on_error)
-        worker.signals.search_progress.connect(self._on_search_progress)
-        QThreadPool.globalInstance().start(worker)
-
-    def _on_result(self, result):
-        pixmap = pil_to_pixmap(result.match.load_image())
-        card = ResultCard(
-            pixmap, str(result.match.path), result.match.time, result.similarity
+        self._worker = SearchWorker(
+            self._image_path,
+            db_path,
+            self._settings.threshold,
+            self._settings.stop_after_exact or None,
         )
-        self._results_layout.addWidget(card)
+        self._worker.signals.results.connect(self._on_results)
+        self._worker.signals.finished.connect(self._on_finished)
+        self._worker.signals.error.connect(self._on_error)
+        self._worker.signals.search_progress.connect(self._on_search_progress)
+        self._worker.signals.stats.connect(self._stats.show_profile)
+        QThreadPool.globalInstance().start(self._worker)
+
+    def _cancel_search(self):
+        if self._worker:
+            self._worker.cancel()
+            self._cancel_btn.setVisible(False)
+
+    def _on_results(self, results):
+        # Every snapshot replaces the best-so-far results shown before
+        self._clear_results()
+        for result in results:
+            pixmap = pil_to_pixmap(result.match.load_image())
+            card = ResultCard(
+                pixmap, str(result.match.path), result.match.time, result.similarity
+            )
+            self._results_layout.addWidget(card)
 
     def _on_search_progress(self, current: float, total: float):
         self._search_progress.setVisible(True)
@@ -405,9 +615,17 @@ class SearchTab(QWidget):
             self._search_progress.setValue(0)
 
     def _on_finished(self):
+        cancelled = self._worker._cancelled if self._worker else False
+        self._worker = None
         self._search_progress.setVisible(False)
         self._search_btn.setEnabled(True)
+        self._cancel_btn.setVisible(False)
         count = self._results_layout.count()
+        if cancelled:
+            self._status_bar.showMessage(
+                f"Search cancelled, showing {count} result(s) so far.", 5000
+            )
+            return
         self._status_bar.showMessage(f"Found {count} result(s).", 5000)
         if count == 0:
             lbl = QLabel("No results found.")
@@ -415,8 +633,10 @@ class SearchTab(QWidget):
             self._results_layout.addWidget(lbl)
 
     def _on_error(self, msg: str):
+        self._worker = None
         self._search_progress.setVisible(False)
         self._search_btn.setEnabled(True)
+        self._cancel_btn.setVisible(False)
         self._status_bar.showMessage("Search failed.", 5000)
         QMessageBox.critical(self, "Error", msg)
 
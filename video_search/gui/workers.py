@@ -4,23 +4,44 @@ from pathlib import Path
 from PIL import Image
 from PyQt6.QtCore import QObject, QRunnable, pyqtSignal, pyqtSlot
 
-from video_search.search import search_similar
-from video_search.storage import open_storage
-from video_search.video import hash_video
+from video_search.cache import default_index_cache
+from video_search.dedupe import DedupeOptions, DedupeReport
+from video_search.hash import ThumbnailOptions
+from video_search.indexer import VIDEO_ERRORS, index_videos, videos_to_index
+from video_search.profiling import Profiler
+from video_search.search import iter_search
+from video_search.storage import open_storage, throttle
+from video_search.video import DecodeOptions
+from video_search.watch import scan_videos
 
 
 class IndexWorker(QRunnable):
     class Signals(QObject):
         progress = pyqtSignal(int, int)
         file_progress = pyqtSignal(str, float, float)
+        stats = pyqtSignal(object)
+        dedupe_report = pyqtSignal(object)
         finished = pyqtSignal()
         error = pyqtSignal(str)
 
-    def __init__(self, directory: Path, db_path: Path, recurse: bool):
+    def __init__(
+        self,
+        directory: Path,
+        db_path: Path,
+        recurse: bool,
+        jobs: int = 1,
+        options: DecodeOptions | None = None,
+        thumbnails: ThumbnailOptions | None = None,
+        dedupe: DedupeOptions | None = None,
+    ):
         super().__init__()
         self.directory = directory
         self.db_path = db_path
         self.recurse = recurse
+        self.jobs = jobs
+        self.options = options
+        self.thumbnails = thumbnails
+        self.dedupe = dedupe
         self.signals = self.Signals()
         self._cancelled = False
 
@@ -30,69 +51,112 @@ class IndexWorker(QRunnable):
     @pyqtSlot()
     def run(self):
         try:
-            rs = "**/" if self.recurse else ""
-            files = [
-                *self.directory.glob(rs + "*.mp4"),
-                *self.directory.glob(rs + "*.webm"),
-            ]
-            total = len(files)
+            found = scan_videos([self.directory], recurse=self.recurse)
 
+            profiler = Profiler()
             with open_storage(self.db_path) as storage:
-                indexed_paths = {str(entry.path) for entry in storage}
-                files = [f for f in files if str(f.resolve()) not in indexed_paths]
+                files = videos_to_index(list(found), storage, found)
                 total = len(files)
 
-                for i, path in enumerate(files):
-                    if self._cancelled:
-                        break
-                    self.signals.progress.emit(i, total)
-
-                    def cb(start: float, end: float):
-                        self.signals.file_progress.emit(str(path.name), start, end)
-
-                    for h in hash_video(path, progress_callback=cb):
-                        storage.append_hash(h)
-
-                    if self._cancelled:
-                        break
+                completed = 0
+                self.signals.progress.emit(completed, total)
+
+                # Progress is reported for every kept frame, which would flood
+                # the event loop
+                throttled = {}
+
+                def cb(path: Path, start: float, end: float):
+                    if path not in throttled:
+                        throttled[path] = throttle(
+                            lambda start, end, name=path.name: (
+                                self.signals.file_progress.emit(name, start, end)
+                            )
+                        )
+                    throttled[path](start, end)
+
+                def done(path: Path):
+                    nonlocal completed
+                    completed += 1
+                    self.signals.progress.emit(completed, total)
+
+                report: DedupeReport = index_videos(
+                    files,
+                    storage,
+                    jobs=self.jobs,
+                    progress_callback=cb,
+                    file_callback=done,
+                    cancelled=lambda: self._cancelled,
+                    options=self.options,
+                    thumbnails=self.thumbnails,
+                    profiler=profiler,
+                    dedupe=self.dedupe,
+                )
 
                 if not self._cancelled:
                     self.signals.progress.emit(total, total)
+            self.signals.stats.emit(profiler)
+            self.signals.dedupe_report.emit(report)
             self.signals.finished.emit()
-        except Exception as e:
+        except VIDEO_ERRORS as e:
             traceback.print_exc()
             self.signals.error.emit(str(e))
 
 
 class SearchWorker(QRunnable):
     class Signals(QObject):
-        result = pyqtSignal(object)
+        # The best results so far, replacing the ones emitted before
+        results = pyqtSignal(object)
         search_progress = pyqtSignal(float, float)
+        stats = pyqtSignal(object)
         finished = pyqtSignal()
         error = pyqtSignal(str)
 
-    def __init__(self, image_path: Path, db_path: Path, threshold: float):
+    def __init__(
+        self,
+        image_path: Path,
+        db_path: Path,
+        threshold: float,
+        stop_after_exact: int | None = None,
+    ):
         super().__init__()
         self.image_path = image_path
         self.db_path = db_path
         self.threshold = threshold
+        self.stop_after_exact = stop_after_exact
         self.signals = self.Signals()
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
 
     @pyqtSlot()
     def run(self):
         try:
+            profiler = Profiler()
             with open_storage(self.db_path) as storage:
-
-                def cb(current: float, total: float):
-                    self.signals.search_progress.emit(current, total)
-
-                results = search_similar(
-                    Image.open(self.image_path), storage, progress_callback=cb
-                )
-                for r in results:
-                    if r.similarity >= self.threshold:
-                        self.signals.result.emit(r)
+                # Searches after the first one only read what was indexed
+                # since, unless the database has an index to search instead
+                table = None
+                if storage.index is None:
+                    table = default_index_cache.hash_table(
+                        self.db_path, storage, profiler=profiler
+                    )
+                for snapshot in iter_search(
+                    Image.open(self.image_path),
+                    storage,
+                    cancelled=lambda: self._cancelled,
+                    stop_after_exact=self.stop_after_exact,
+                    profiler=profiler,
+                    table=table,
+                ):
+                    self.signals.search_progress.emit(
+                        float(snapshot.scanned), float(snapshot.total)
+                    )
+                    self.signals.results.emit(
+                        [r for r in snapshot.results if r.similarity >= self.threshold]
+                    )
+            self.signals.stats.emit(profiler)
             self.signals.finished.emit()
-        except Exception as e:
+        except (OSError, ValueError) as e:
             traceback.print_exc()
             self.signals.error.emit(str(e))
@@ -1,14 +1,79 @@
 import struct
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from enum import Enum
 from io import BytesIO
 from os import PathLike
 from pathlib import Path
 
 import numpy as np
-from imagehash import ImageHash
+from imagehash import ImageHash, dhash, phash, whash
 from PIL import Image as PILImage
 from PIL.Image import Image
 
+# Low frequencies of phash_image closer than this to the median, relative to
+# the largest one, are left to imagehash
+DCT_TIE_TOLERANCE = 1e-9
+
+
+class ThumbnailFormat(str, Enum):
+    PNG = "png"
+    JPEG = "jpeg"
+    WEBP = "webp"
+    # Nothing is stored, the frame is decoded from the video when displayed
+    NONE = "none"
+
+
+@dataclass
+class ThumbnailOptions:
+    format: ThumbnailFormat = ThumbnailFormat.PNG
+    # Only used by the lossy formats
+    quality: int = 85
+
+
+class HashKind(str, Enum):
+    # Additional hashes that can be stored beside the 64-bit phash every record
+    # has, to re-rank its nearest matches with.
+    DHASH = "dhash"
+    PHASH16 = "phash16"
+    WHASH = "whash"
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        if self == HashKind.PHASH16:
+            return (16, 16)
+        return (8, 8)
+
+    @property
+    def bits(self) -> int:
+        return self.shape[0] * self.shape[1]
+
+    def compute(self, image: Image) -> ImageHash:
+        if self == HashKind.DHASH:
+            return dhash(image)
+        if self == HashKind.PHASH16:
+            return phash(image, hash_size=16)
+        return whash(image)
+
+
+def encode_record(
+    frame_data: bytes, hash: ImageHash, path: PathLike[str], time: float
+) -> bytes:
+    with BytesIO() as hashf:
+        np.save(hashf, hash.hash, False)
+        hash_data = hashf.getvalue()
+
+    path_data = str(path).encode("utf-8")
+
+    buf = BytesIO()
+    buf.write(struct.pack("<I", len(frame_data)))
+    buf.write(frame_data)
+    buf.write(struct.pack("<I", len(hash_data)))
+    buf.write(hash_data)
+    buf.write(struct.pack("<I", len(path_data)))
+    buf.write(path_data)
+    buf.write(struct.pack("<d", time))
+    return buf.getvalue()
+
 
 @dataclass
 class VideoFrameHash:
@@ -16,27 +81,22 @@ class VideoFrameHash:
     hash: ImageHash
     path: PathLike[str]
     time: float
+    extra: dict[HashKind, ImageHash] = field(default_factory=dict)
 
-    def to_bytes(self) -> bytes:
-        with BytesIO() as im:
-            self.frame.save(im, format="PNG")
-            frame_data = im.getvalue()
-
-        with BytesIO() as hashf:
-            np.save(hashf, self.hash.hash, False)
-            hash_data = hashf.getvalue()
+    def frame_bytes(self, options: ThumbnailOptions | None = None) -> bytes:
+        options = options or ThumbnailOptions()
+        if options.format == ThumbnailFormat.NONE:
+            return b""
 
-        path_data = str(self.path).encode("utf-8")
+        with BytesIO() as im:
+            if options.format == ThumbnailFormat.PNG:
+                self.frame.save(im, format="PNG")
+            else:
+                self.frame.save(im, format=options.format.name, quality=options.quality)
+            return im.getvalue()
 
-        buf = BytesIO()
-        buf.write(struct.pack("<I", len(frame_data)))
-        buf.write(frame_data)
-        buf.write(struct.pack("<I", len(hash_data)))
-        buf.write(hash_data)
-        buf.write(struct.pack("<I", len(path_data)))
-        buf.write(path_data)
-        buf.write(struct.pack("<d", self.time))
-        return buf.getvalue()
+    def to_bytes(self) -> bytes:
+        return encode_record(self.frame_bytes(), self.hash, self.path, self.time)
 
     @classmethod
     def from_bytes(cls, data: bytes) -> "VideoFrameHash":
@@ -58,4 +118,67 @@ class VideoFrameHash:
         instance.hash = ImageHash(hash_array)
         instance.path = Path(path)
         instance.time = time
+        instance.extra = {}
         return instance
+
+
+def phash_pixels(pixels: np.ndarray, hash_size: int = 8) -> np.ndarray:
+    # Batched equivalent of imagehash.phash for a stack of grayscale images that
+    # are already (hash_size * 4) pixels square. Gives bit-identical results.
+    # SciPy takes long to import, so it is only loaded once frames are hashed.
+    import scipy.fft
+
+    dct = scipy.fft.dct(scipy.fft.dct(pixels, axis=1), axis=2)
+    low = dct[:, :hash_size, :hash_size]
+    medians = np.median(low.reshape(len(low), -1), axis=1)
+    return low > medians[:, np.newaxis, np.newaxis]
+
+
+def _dct_rows(size: int, rows: int) -> np.ndarray:
+    # The first rows of the unnormalized DCT-II matrix, as scipy's dct uses
+    k = np.arange(rows)[:, np.newaxis]
+    n = np.arange(size)
+    return 2 * np.cos(np.pi * k * (2 * n + 1) / (2 * size))
+
+
+def phash_image(image: Image, hash_size: int = 8) -> ImageHash:
+    # imagehash.phash without importing SciPy, which takes longer than the
+    # rest of a search from the command line. Only the low frequencies are
+    # computed, by two small matrix products. They differ from SciPy's by
+    # rounding, so when one is about as large as the median the bit could go
+    # either way and imagehash computes it instead.
+    size = hash_size * 4
+    pixels = np.asarray(
+        image.convert("L").resize((size, size), PILImage.Resampling.LANCZOS),
+        dtype=np.float64,
+    )
+    dct = _dct_rows(size, hash_size)
+    low = dct @ pixels @ dct.T
+    median = np.median(low)
+    if (np.abs(low - median) <= DCT_TIE_TOLERANCE * np.abs(low).max()).any():
+        return phash(image, hash_size)
+    return ImageHash(low > median)
+
+
+def pack_hashes(bits: np.ndarray) -> np.ndarray:
+    # Packs boolean hash matrices of shape (n, ...) into rows of uint64 words,
+    # so that Hamming distance becomes XOR + popcount.
+    packed = np.packbits(bits.reshape(len(bits), -1), axis=1)
+    padding = -packed.shape[1] % 8
+    if padding:
+        packed = np.pad(packed, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def pack_hash(hash: ImageHash) -> np.ndarray:
+    return pack_hashes(hash.hash[np.newaxis])[0]
+
+
+def unpack_hash(words: np.ndarray, shape: tuple[int, ...]) -> ImageHash:
+    size = int(np.prod(shape))
+    bits = np.unpackbits(np.ascontiguousarray(words).view(np.uint8))[:size]
+    return ImageHash(bits.astype(bool).reshape(shape))
+
+
+def hamming_distances(hashes: np.ndarray, query: np.ndarray) -> np.ndarray:
+    return np.bitwise_count(hashes ^ query).sum(axis=1, dtype=np.int64)
@@ -0,0 +1,336 @@
+import hashlib
+import os
+from collections.abc import Iterable
+from math import comb
+from os import PathLike
+from pathlib import Path
+
+import numpy as np
+
+from video_search.hash import hamming_distances
+from video_search.search import top_n_indices
+from video_search.storage import HashStorage, ManifestEntry, video_manifest
+
+INDEX_SUFFIX = ".mih"
+CHUNK_BITS = 16
+# Buckets are probed with at most this many flipped bits per chunk. Past that
+# the number of probes grows quickly and an exhaustive scan is cheaper.
+MAX_CHUNK_DISTANCE = 2
+# Appended records are scanned linearly until there are this many of them
+# (or more than 1/8 of the index), then the bucket tables are rebuilt.
+MERGE_THRESHOLD = 65536
+# Bytes at the start of a database that identify it together with its inode.
+# Appending never rewrites them, replacing the file (migrate, compact) does.
+FINGERPRINT_SIZE = 4096
+
+# All 16-bit flip masks, ordered by the number of bits they flip
+_MASKS = np.array(
+    sorted(range(1 << CHUNK_BITS), key=lambda m: m.bit_count()), dtype=np.uint16
+)
+
+
+def _mask_count(distance: int) -> int:
+    return sum(comb(CHUNK_BITS, i) for i in range(distance + 1))
+
+
+def index_path(db_path: PathLike) -> Path:
+    path = Path(db_path)
+    return path.with_name(path.name + INDEX_SUFFIX)
+
+
+def fingerprint(db_path: PathLike, size: int) -> str:
+    # Of the first `size` bytes at most, so a database that grew since keeps
+    # the fingerprint it had
+    with open(db_path, "rb") as f:
+        head = f.read(min(size, FINGERPRINT_SIZE))
+        inode = os.fstat(f.fileno()).st_ino
+    return f"{inode}:{hashlib.sha256(head).hexdigest()}"
+
+
+def _gather(order: np.ndarray, begin: np.ndarray, end: np.ndarray) -> np.ndarray:
+    lengths = end - begin
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=order.dtype)
+
+    # Concatenation of order[begin[i]:end[i]] for every i without a Python loop
+    shift = np.repeat(begin - np.cumsum(lengths) + lengths, lengths)
+    return order[shift + np.arange(total)]
+
+
+class MultiIndexHash:
+    # Multi-index hashing: every hash is split into 16-bit chunks and each
+    # chunk position gets a bucket table. Two hashes within distance r share
+    # at least one chunk within distance r // chunks, so only a handful of
+    # buckets need to be probed to find every record within r.
+    def __init__(self, hashes: np.ndarray, offsets: np.ndarray):
+        self._hashes = np.ascontiguousarray(hashes, dtype=np.uint64)
+        self._offsets = np.asarray(offsets, dtype=np.int64)
+        self._tail_hashes: list[np.ndarray] = []
+        self._tail_offsets: list[np.ndarray] = []
+        self._tail_size = 0
+        self._dead = np.empty((0, 2), dtype=np.int64)
+        # First and last offset of every video as of the manifest the index
+        # was last reconciled with, None for indexes saved before it was kept
+        self.manifest: dict[str, tuple[int, int]] | None = {}
+        self._build()
+        self.dirty = True
+
+    def _build(self):
+        chunks = self._hashes.view(np.uint16)
+        dtype = np.uint32 if len(self._hashes) < 1 << 32 else np.int64
+        self._orders = np.empty((chunks.shape[1], len(chunks)), dtype=dtype)
+        self._starts = np.zeros((chunks.shape[1], (1 << CHUNK_BITS) + 1), np.int64)
+        for i in range(chunks.shape[1]):
+            self._orders[i] = np.argsort(chunks[:, i], kind="stable")
+            counts = np.bincount(chunks[:, i], minlength=1 << CHUNK_BITS)
+            np.cumsum(counts, out=self._starts[i, 1:])
+
+    def __len__(self):
+        return len(self._offsets) + self._tail_size
+
+    @property
+    def last_offset(self) -> int:
+        if self._tail_offsets:
+            return int(self._tail_offsets[-1][-1])
+        if len(self._offsets):
+            return int(self._offsets[-1])
+        return -1
+
+    def add(self, hashes: np.ndarray, offsets: np.ndarray):
+        if not len(offsets):
+            return
+        if len(self._offsets) == 0 and not self._tail_size:
+            self._hashes = np.empty((0, hashes.shape[1]), dtype=np.uint64)
+        elif hashes.shape[1] != self._hashes.shape[1]:
+            raise ValueError("Index contains hashes of different sizes")
+
+        self._tail_hashes.append(np.asarray(hashes, dtype=np.uint64))
+        self._tail_offsets.append(np.asarray(offsets, dtype=np.int64))
+        self._tail_size += len(offsets)
+        self.dirty = True
+
+        if self._tail_size > max(MERGE_THRESHOLD, len(self._offsets) // 8):
+            self._merge()
+
+    def discard(self, first: int, last: int):
+        # Records in [first, last] were superseded. They are filtered out of
+        # results until the next merge drops them from the tables.
+        self._dead = np.vstack([self._dead, [[first, last]]])
+        self._dead = self._dead[np.argsort(self._dead[:, 0])]
+        self.dirty = True
+
+    def reconcile(self, entries: Iterable[ManifestEntry]):
+        # Discards the records of videos that were re-indexed or removed since
+        # the index last saw their manifest entries
+        assert self.manifest is not None
+        for entry in entries:
+            old = self.manifest.get(entry.path)
+            new = (entry.first, entry.last)
+            if old == new:
+                continue
+            if old is not None and old[0] >= 0:
+                self.discard(*old)
+            self.manifest[entry.path] = new
+            self.dirty = True
+
+    def _alive(self, offsets: np.ndarray) -> np.ndarray:
+        i = np.searchsorted(self._dead[:, 0], offsets, side="right") - 1
+        return (i < 0) | (offsets > self._dead[np.maximum(i, 0), 1])
+
+    def _merge(self):
+        if not self._tail_size and not len(self._dead):
+            return
+        self._hashes = np.concatenate([self._hashes, *self._tail_hashes])
+        self._offsets = np.concatenate([self._offsets, *self._tail_offsets])
+        if len(self._dead):
+            alive = self._alive(self._offsets)
+            self._hashes = self._hashes[alive]
+            self._offsets = self._offsets[alive]
+            self._dead = np.empty((0, 2), dtype=np.int64)
+        self._tail_hashes = []
+        self._tail_offsets = []
+        self._tail_size = 0
+        self._build()
+
+    def _candidates(self, query: np.ndarray, distance: int) -> np.ndarray:
+        masks = _MASKS[: _mask_count(distance)]
+        found = []
+        for i, value in enumerate(query.view(np.uint16)):
+            buckets = (masks ^ value).astype(np.int64)
+            found.append(
+                _gather(
+                    self._orders[i],
+                    self._starts[i, buckets],
+                    self._starts[i, buckets + 1],
+                )
+            )
+        return np.unique(np.concatenate(found))
+
+    def search(
+        self, query: np.ndarray, top_n: int, max_distance: int | None = None
+    ) -> tuple[np.ndarray, np.ndarray] | None:
+        # Returns (offsets, distances) ordered by distance, or None when the
+        # query is too far from everything for the index to beat a full scan.
+        tail_hashes = np.concatenate([self._hashes[:0], *self._tail_hashes])
+        tail_offsets = np.concatenate([self._offsets[:0], *self._tail_offsets])
+        tail_distances = hamming_distances(tail_hashes, query)
+
+        chunks = len(query) * 64 // CHUNK_BITS
+        for distance in range(MAX_CHUNK_DISTANCE + 1):
+            candidates = self._candidates(query, distance)
+            if len(candidates) > len(self._offsets) // 4:
+                return None
+
+            distances = np.concatenate(
+                [hamming_distances(self._hashes[candidates], query), tail_distances]
+            )
+            offsets = np.concatenate([self._offsets[candidates], tail_offsets])
+            if len(self._dead):
+                alive = self._alive(offsets)
+                distances = distances[alive]
+                offsets = offsets[alive]
+
+            # Every record within this distance of the query is a candidate
+            complete = chunks * (distance + 1) - 1
+            limit = complete if max_distance is None else max_distance
+            if limit > complete:
+                continue
+
+            within = np.flatnonzero(distances <= limit)
+            if max_distance is None and len(within) < top_n:
+                continue
+
+            best = within[top_n_indices(distances[within], top_n)]
+            return offsets[best], distances[best]
+
+        return None
+
+    def save(self, path: PathLike, db_size: int, db_fingerprint: str):
+        self._merge()
+        manifest = self.manifest or {}
+        # Shards of a catalog can be open in several processes at once
+        tmp = Path(f"{path}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                hashes=self._hashes,
+                offsets=self._offsets,
+                orders=self._orders,
+                starts=self._starts,
+                db_size=np.array(db_size, dtype=np.int64),
+                db_fingerprint=np.array(db_fingerprint),
+                manifest_paths=np.array(list(manifest), dtype=str),
+                manifest_ranges=np.array(
+                    list(manifest.values()), dtype=np.int64
+                ).reshape(-1, 2),
+            )
+        os.replace(tmp, path)
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path: PathLike) -> tuple["MultiIndexHash", int, str | None]:
+        # Also returns the size and fingerprint of the database it was saved
+        # for, indexes from before fingerprints have none
+        with np.load(path) as data:
+            instance = cls.__new__(cls)
+            instance._hashes = data["hashes"]
+            instance._offsets = data["offsets"]
+            instance._orders = data["orders"]
+            instance._starts = data["starts"]
+            instance._tail_hashes = []
+            instance._tail_offsets = []
+            instance._tail_size = 0
+            instance._dead = np.empty((0, 2), dtype=np.int64)
+            instance.manifest = None
+            if "manifest_paths" in data:
+                instance.manifest = {
+                    str(path): (int(first), int(last))
+                    for path, (first, last) in zip(
+                        data["manifest_paths"], data["manifest_ranges"]
+                    )
+                }
+            instance.dirty = False
+            db_fingerprint = None
+            if "db_fingerprint" in data:
+                db_fingerprint = str(data["db_fingerprint"])
+            return instance, int(data["db_size"]), db_fingerprint
+
+
+def build_index(storage: HashStorage, progress_callback=None) -> MultiIndexHash:
+    # Taken before reading, entries committed meanwhile are reconciled later
+    videos = dict(video_manifest(storage))
+    table = storage.hash_table(progress_callback)
+    index = MultiIndexHash(table.hashes, table.offsets)
+    index.reconcile(videos.values())
+    return index
+
+
+def sync_index(storage: HashStorage):
+    # Catches the storage's index up with the records and manifest entries
+    # written since it was saved, by this process or any other
+    index = storage.index
+    assert index is not None
+    tail = storage.hash_table(after=index.last_offset)
+    index.add(tail.hashes, tail.offsets)
+    index.reconcile(video_manifest(storage).values())
+
+
+def attach_index(storage: HashStorage, db_path: PathLike, db_size: int):
+    path = index_path(db_path)
+    if not path.exists():
+        return
+
+    index, indexed_size, indexed_fingerprint = MultiIndexHash.load(path)
+    if (
+        db_size < indexed_size
+        or indexed_fingerprint != fingerprint(db_path, indexed_size)
+        or index.manifest is None
+    ):
+        # The database was replaced or rewritten since the index was built,
+        # its offsets point at other records
+        storage.index = build_index(storage)
+    else:
+        storage.index = index
+        sync_index(storage)
+
+
+def check_recall(
+    storage: HashStorage,
+    index: MultiIndexHash,
+    queries: int = 100,
+    flipped_bits: int = 4,
+    top_n: int = 50,
+    seed: int = 0,
+) -> tuple[float, float]:
+    # Queries are stored hashes with a few random bits flipped. Returns the
+    # recall against an exhaustive scan and the fraction of queries the index
+    # answered without falling back to it.
+    table = storage.hash_table()
+    if not len(table):
+        return 1.0, 1.0
+
+    rng = np.random.default_rng(seed)
+    total_recall = 0.0
+    answered = 0
+    bits = table.hashes.shape[1] * 64
+    for row in rng.integers(0, len(table), queries):
+        query = table.hashes[row].copy()
+        for bit in rng.choice(bits, flipped_bits, replace=False):
+            query[bit // 64] ^= np.uint64(1) << np.uint64(bit % 64)
+
+        distances = hamming_distances(table.hashes, query)
+        expected = top_n_indices(distances, top_n)
+        found = index.search(query, top_n)
+        if found is None:
+            total_recall += 1.0
+            continue
+
+        # Records tied with the last expected result are equally good answers
+        cutoff = distances[expected[-1]]
+        relevant = set(table.offsets[distances <= cutoff].tolist())
+        hits = sum(1 for offset in found[0].tolist() if offset in relevant)
+        total_recall += hits / len(expected)
+        answered += 1
+
+    return total_recall / queries, answered / queries
@@ -0,0 +1,385 @@
+import os
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import BrokenExecutor, Future, ProcessPoolExecutor
+from contextlib import ExitStack
+from multiprocessing import Manager
+from pathlib import Path
+from queue import Empty, Full, Queue
+from threading import Event
+from typing import Any
+
+import av
+import numpy as np
+from imagehash import ImageHash
+
+from video_search.dedupe import (
+    DedupeAction,
+    DedupeOptions,
+    DedupeReport,
+    DedupeScope,
+    Deduplicator,
+)
+from video_search.hash import HashKind, ThumbnailOptions, VideoFrameHash
+from video_search.pipeline import FramePool
+from video_search.profiling import Profiler
+from video_search.shards import ShardedStorage
+from video_search.storage import HashStorage, ManifestEntry, VideoStatus
+from video_search.video import DecodeOptions, hash_video
+
+Record = tuple[bytes, ImageHash, Path, float, dict[HashKind, ImageHash]]
+
+# Records a worker process sends to the writer at once, and how many of those
+# batches it may get ahead of the writer. Together with the videos hashed
+# ahead, per process, they bound the memory of indexing with several jobs.
+RESULT_BATCH = 256
+RESULT_QUEUE = 4
+HASH_AHEAD = 2
+
+# What indexing fails with when a video can't be read or decoded, or the
+# worker process hashing it died
+VIDEO_ERRORS = (OSError, ValueError, av.error.FFmpegError, BrokenExecutor)
+
+
+class ProcessPool:
+    # The worker processes videos are hashed in and the manager of the queues
+    # they report through. Starting them takes a while, so callers indexing
+    # batch after batch keep one open.
+    def __init__(self, jobs: int):
+        self.jobs = max(jobs, 1)
+        self.manager = Manager()
+        self.executor = ProcessPoolExecutor(self.jobs)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.manager.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _hash_file(
+    path: Path,
+    events: Queue,
+    results: Queue,
+    stop: Event,
+    options: DecodeOptions | None,
+    thumbnails: ThumbnailOptions | None,
+    extra_hashes: tuple[HashKind, ...],
+    trace: bool,
+    dedupe: DedupeOptions,
+    workers: int,
+) -> tuple[float, Profiler, DedupeReport]:
+    # Runs in a worker process. Thumbnails are encoded here as well, so the
+    # writer only has to append the finished records. Near-duplicates within
+    # the video are handled here, the writer compares the rest to the database.
+    # The records are sent to the writer in batches through `results`, with
+    # whether they are references, as they are hashed. Gives up once `stop`
+    # is set, the writer no longer takes them then.
+    duration = 0.0
+    profiler = Profiler(trace)
+    deduplicator = Deduplicator(
+        DedupeOptions(
+            DedupeScope.NONE if dedupe.scope == DedupeScope.NONE else DedupeScope.VIDEO,
+            dedupe.radius,
+            dedupe.action,
+        )
+    )
+
+    def cb(start: float, end: float):
+        nonlocal duration
+        duration = end
+        events.put((path, start, end))
+
+    def send(batch: list[tuple[Record, bool]]) -> bool:
+        while not stop.is_set():
+            try:
+                results.put(batch, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    batch: list[tuple[Record, bool]] = []
+    with FramePool(workers) as pool:
+        frames = hash_video(
+            path,
+            progress_callback=cb,
+            options=options,
+            extra_hashes=extra_hashes,
+            profiler=profiler,
+            pool=pool,
+        )
+        for record in _records(frames, deduplicator, thumbnails, profiler, pool):
+            batch.append(record)
+            if len(batch) >= RESULT_BATCH:
+                if not send(batch):
+                    return duration, profiler, deduplicator.report
+                batch = []
+    if batch:
+        send(batch)
+    return duration, profiler, deduplicator.report
+
+
+def _records(
+    frames: Iterator[VideoFrameHash],
+    deduplicator: Deduplicator,
+    thumbnails: ThumbnailOptions | None,
+    profiler: Profiler,
+    pool: FramePool,
+) -> Iterator[tuple[Record, bool]]:
+    # The records of the frames that are not skipped as near-duplicates, in
+    # order, and whether they are references. Thumbnails are encoded on the
+    # pool.
+    def checked():
+        for h in frames:
+            action = deduplicator.check(h.hash)
+            if action != DedupeAction.SKIP:
+                yield h, action
+
+    def encode(checked: tuple[VideoFrameHash, DedupeAction | None]):
+        h, action = checked
+        task = Profiler(profiler.trace) if pool.parallel else profiler
+        frame_data = b""
+        if action is None:
+            frame_data = _encode(h, thumbnails, task)
+        return (frame_data, h.hash, h.path, h.time, h.extra), action is not None, task
+
+    for record, reference, task in pool.map(encode, checked()):
+        if task is not profiler:
+            profiler.merge(task)
+        yield record, reference
+
+
+def _encode(
+    h: VideoFrameHash, thumbnails: ThumbnailOptions | None, profiler: Profiler
+) -> bytes:
+    start = time.perf_counter()
+    frame_data = h.frame_bytes(thumbnails)
+    profiler.add("encode", time.perf_counter() - start, 1, len(frame_data), start)
+    return frame_data
+
+
+def _write(storage: HashStorage, record: Record, profiler: Profiler):
+    with profiler.stage("write", bytes=len(record[0])):
+        storage.append_record(*record)
+
+
+def videos_to_index(
+    paths: list[Path],
+    storage: HashStorage,
+    stats: dict[Path, os.stat_result] | None = None,
+) -> list[Path]:
+    # Only the manifest is consulted. Videos that are missing, were not
+    # indexed completely or changed on disk since are (re-)indexed. `stats`
+    # saves stating the files again when they were just listed.
+    videos = storage.videos()
+    stats = stats or {}
+    return [
+        path
+        for path in paths
+        if (entry := videos.get(str(path))) is None
+        or not entry.is_current(stats.get(path) or path.stat())
+    ]
+
+
+def _existing_hashes(storage: HashStorage, paths: list[Path]) -> np.ndarray:
+    # Hashes in the database, except those of the videos about to be
+    # re-indexed, which would otherwise all be duplicates of themselves
+    shards = [storage]
+    if isinstance(storage, ShardedStorage):
+        shards = [storage.shard(i) for i in range(len(storage.catalog.shards))]
+
+    hashes = [np.empty((0, 1), dtype=np.uint64)]
+    for shard in shards:
+        table = shard.hash_table()
+        videos = shard.videos()
+        keep = np.ones(len(table), dtype=bool)
+        for path in paths:
+            entry = videos.get(str(path))
+            if entry is not None and entry.first >= 0:
+                keep &= (table.offsets < entry.first) | (table.offsets > entry.last)
+        if len(table):
+            hashes.append(table.hashes[keep])
+    return np.concatenate(hashes) if len(hashes) > 1 else hashes[0]
+
+
+def index_videos(
+    paths: list[Path],
+    storage: HashStorage,
+    jobs: int = 1,
+    progress_callback: Callable[[Path, float, float], Any] | None = None,
+    file_callback: Callable[[Path], Any] | None = None,
+    cancelled: Callable[[], bool] | None = None,
+    options: DecodeOptions | None = None,
+    thumbnails: ThumbnailOptions | None = None,
+    extra_hashes: tuple[HashKind, ...] = (),
+    profiler: Profiler | None = None,
+    dedupe: DedupeOptions | None = None,
+    workers: int = 1,
+    processes: ProcessPool | None = None,
+) -> DedupeReport:
+    # Returns how many frames were found to be near-duplicates. `workers` are
+    # the threads hashing and encoding the frames of every video, so a single
+    # long video is indexed on several cores as well. `processes` are used
+    # instead of starting `jobs` of them for this call.
+    profiler = profiler or Profiler()
+    dedupe = dedupe or DedupeOptions()
+    existing = None
+    if dedupe.scope == DedupeScope.DATABASE:
+        existing = _existing_hashes(storage, paths)
+    deduplicator = Deduplicator(dedupe, existing)
+
+    if jobs <= 1 and processes is None:
+        for path in paths:
+            if cancelled and cancelled():
+                return deduplicator.report
+
+            duration = 0.0
+            frames = 0
+            status = VideoStatus.INCOMPLETE
+            deduplicator.start_video()
+
+            def cb(start: float, end: float, path: Path = path):
+                nonlocal duration
+                duration = end
+                if progress_callback:
+                    progress_callback(path, start, end)
+
+            try:
+                with FramePool(workers) as pool:
+                    hashes = hash_video(
+                        path,
+                        progress_callback=cb,
+                        options=options,
+                        extra_hashes=extra_hashes,
+                        profiler=profiler,
+                        pool=pool,
+                    )
+                    for record, _ in _records(
+                        hashes, deduplicator, thumbnails, profiler, pool
+                    ):
+                        _write(storage, record, profiler)
+                        frames += 1
+                status = VideoStatus.COMPLETE
+            finally:
+                with profiler.stage("commit"):
+                    storage.commit_video(
+                        ManifestEntry.for_file(path, duration, frames, status)
+                    )
+            if file_callback:
+                file_callback(path)
+        return deduplicator.report
+
+    # Videos are decoded and hashed in worker processes, the storage is only
+    # ever written from this process, one complete video after the other.
+    # Their records are written as they arrive, in the order the videos were
+    # submitted, while the following videos are hashed ahead.
+    with ExitStack() as stack:
+        if processes is None:
+            processes = stack.enter_context(ProcessPool(jobs))
+        manager = processes.manager
+        executor = processes.executor
+        jobs = processes.jobs
+        events = manager.Queue()
+        stop = manager.Event()
+        todo = iter(paths)
+        inflight: deque[
+            tuple[Path, Future[tuple[float, Profiler, DedupeReport]], Queue]
+        ] = deque()
+        # Progress of the videos being hashed, the duration of a video that
+        # failed is as far as it got
+        durations: dict[Path, float] = {}
+
+        def submit():
+            while len(inflight) < jobs * HASH_AHEAD:
+                if cancelled and cancelled():
+                    return
+                path = next(todo, None)
+                if path is None:
+                    return
+                results = manager.Queue(RESULT_QUEUE)
+                future = executor.submit(
+                    _hash_file,
+                    path,
+                    events,
+                    results,
+                    stop,
+                    options,
+                    thumbnails,
+                    extra_hashes,
+                    profiler.trace,
+                    dedupe,
+                    workers,
+                )
+                inflight.append((path, future, results))
+
+        def drain():
+            while True:
+                try:
+                    path, start, end = events.get_nowait()
+                except Empty:
+                    return
+                durations[path] = end
+                if progress_callback:
+                    progress_callback(path, start, end)
+
+        def batches(future: Future, results: Queue) -> Iterator[list]:
+            while True:
+                drain()
+                # Every batch is put before the worker returns
+                done = future.done()
+                try:
+                    batch = results.get_nowait() if done else results.get(timeout=0.1)
+                except Empty:
+                    if done:
+                        return
+                    continue
+                yield batch
+
+        try:
+            submit()
+            while inflight:
+                path, future, results = inflight.popleft()
+                frames = 0
+                status = VideoStatus.INCOMPLETE
+                try:
+                    for batch in batches(future, results):
+                        for record, reference in batch:
+                            if not reference:
+                                action = deduplicator.check_database(record[1])
+                                if action == DedupeAction.SKIP:
+                                    continue
+                                if action == DedupeAction.REFERENCE:
+                                    record = (b"", *record[1:])
+                            _write(storage, record, profiler)
+                            frames += 1
+                    duration, worker_profiler, report = future.result()
+                    durations[path] = duration
+                    profiler.merge(worker_profiler)
+                    deduplicator.report.merge(report)
+                    status = VideoStatus.COMPLETE
+                finally:
+                    with profiler.stage("commit"):
+                        storage.commit_video(
+                            ManifestEntry.for_file(
+                                path, durations.pop(path, 0.0), frames, status
+                            )
+                        )
+                if file_callback:
+                    file_callback(path)
+
+                if cancelled and cancelled():
+                    # Videos that are already being hashed are still written out
+                    for item in [item for item in inflight if item[1].cancel()]:
+                        inflight.remove(item)
+                submit()
+        finally:
+            stop.set()
+            for _, future, _ in inflight:
+                future.cancel()
+    return deduplicator.report
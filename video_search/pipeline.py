@@ -0,0 +1,121 @@
+import threading
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from queue import Empty, Full, Queue
+from typing import TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Items a stage works on or holds for the next one, per worker, and items
+# decoded ahead. Decoded frames are large, so this is what bounds the memory
+# of a pipeline.
+PIPELINE_DEPTH = 2
+
+
+@dataclass
+class _Failed:
+    error: BaseException
+
+
+_END = object()
+
+
+class FramePool:
+    # Threads the stages of indexing one video run on: decoding on a thread
+    # of its own, scaling, hashing, thumbnails and encoding on the workers.
+    # The results of a stage come back in order, so a single consumer keeps
+    # writing frames by time. With one worker everything runs in sequence on
+    # the calling thread.
+    def __init__(self, workers: int = 1):
+        self.workers = max(workers, 1)
+        self.depth = self.workers * PIPELINE_DEPTH
+        self._executor = None
+        if self.workers > 1:
+            self._executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix="frames"
+            )
+
+    @property
+    def parallel(self) -> bool:
+        return self._executor is not None
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def map(self, fn: Callable[[T], R], items: Iterable[T]) -> Iterator[R]:
+        # fn of every item on the workers, in the order of `items`. Items are
+        # only taken as results are, at most `depth` of them are in flight.
+        if self._executor is None:
+            for item in items:
+                yield fn(item)
+            return
+
+        pending: deque[Future[R]] = deque()
+        try:
+            for item in items:
+                pending.append(self._executor.submit(fn, item))
+                if len(pending) >= self.depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def produce(self, items: Iterable[T]) -> Iterator[T]:
+        # `items` produced on a thread of its own, at most PIPELINE_DEPTH of
+        # them ahead of the consumer. Errors are raised in the consumer, closing
+        # the iterator stops the thread.
+        if self._executor is None:
+            yield from items
+            return
+
+        queue: Queue = Queue(PIPELINE_DEPTH)
+        stopped = threading.Event()
+
+        def put(item) -> bool:
+            while not stopped.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def run():
+            try:
+                for item in items:
+                    if not put(item):
+                        return
+                put(_END)
+            except Exception as e:  # noqa: BLE001 - raised in the consumer
+                put(_Failed(e))
+
+        thread = threading.Thread(target=run, name="decode", daemon=True)
+        thread.start()
+        try:
+            while True:
+                try:
+                    item = queue.get(timeout=0.1)
+                except Empty:
+                    if not thread.is_alive() and queue.empty():
+                        return
+                    continue
+                if item is _END:
+                    return
+                if isinstance(item, _Failed):
+                    raise item.error
+                yield item
+        finally:
+            stopped.set()
+            thread.join()
@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from os import PathLike
+from typing import Any, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class Stage:
+    seconds: float = 0.0
+    items: int = 0
+    bytes: int = 0
+
+
+@dataclass
+class Profiler:
+    # Time, items and bytes per stage of indexing or searching, and plain
+    # counters. With `trace`, every timed span is also kept as an event of the
+    # Chrome trace format, which chrome://tracing and Perfetto open.
+    trace: bool = False
+    stages: dict[str, Stage] = field(default_factory=dict)
+    counters: dict[str, int] = field(default_factory=dict)
+    events: list[dict[str, Any]] = field(default_factory=list)
+
+    def add(
+        self,
+        name: str,
+        seconds: float,
+        items: int = 1,
+        bytes: int = 0,
+        start: float | None = None,
+    ):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage()
+        stage.seconds += seconds
+        stage.items += items
+        stage.bytes += bytes
+
+        if self.trace and start is not None:
+            self.events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": start * 1e6,
+                    "dur": seconds * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": {"items": items, "bytes": bytes},
+                }
+            )
+
+    @contextmanager
+    def stage(self, name: str, items: int = 1, bytes: int = 0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, items, bytes, start)
+
+    def timed(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        # Times producing every item of `iterable`, not what the caller does
+        # with it
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start, 0, start=start)
+                return
+            self.add(name, time.perf_counter() - start, 1, start=start)
+            yield item
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other: "Profiler"):
+        # Adds the stages of a profiler from a worker process
+        for name, stage in other.stages.items():
+            self.add(name, stage.seconds, stage.items, stage.bytes)
+        for name, n in other.counters.items():
+            self.count(name, n)
+        if self.trace:
+            self.events.extend(other.events)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "stages": {
+                name: {
+                    "seconds": stage.seconds,
+                    "items": stage.items,
+                    "bytes": stage.bytes,
+                }
+                for name, stage in self.stages.items()
+            },
+            "counters": dict(self.counters),
+        }
+
+    def write_trace(self, path: PathLike):
+        # perf_counter is the same clock in all processes of a machine, so
+        # events of workers line up with the ones of this process
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "traceEvents": self.events,
+                    "displayTimeUnit": "ms",
+                    "otherData": self.to_dict(),
+                },
+                f,
+            )
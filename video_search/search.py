@@ -1,17 +1,42 @@
-import heapq
+import time
+from collections.abc import Callable, Iterable, Iterator
 from dataclasses import dataclass
-from typing import Any, Callable
+from typing import Any
 
-from imagehash import ImageHash, phash
+import numpy as np
+from imagehash import ImageHash
 from PIL.Image import Image
 
-from video_search.storage import HashStorage, LazyVideoFrameHash
+from video_search.hash import (
+    HashKind,
+    hamming_distances,
+    pack_hash,
+    pack_hashes,
+    phash_image,
+)
+from video_search.profiling import Profiler
+from video_search.shards import ShardedStorage
+from video_search.storage import HashStorage, HashTable, LazyVideoFrameHash, throttle
+from video_search.variants import Variant, VariantOptions, query_variants
+
+# Upper bound on query x record distances computed at once by nearest
+BATCH_ELEMENTS = 1 << 22
+# Candidates per requested result that a cascaded search re-ranks
+CASCADE_FACTOR = 10
+# Records a streaming search scans between checking for cancellation, and the
+# minimum seconds between two of its snapshots
+STREAM_CHUNK = 1 << 16
+SNAPSHOT_INTERVAL = 0.25
 
 
 @dataclass
 class Result:
     base: ImageHash
     match: LazyVideoFrameHash
+    # Similarity by the finer hash of a cascaded search
+    refined_similarity: float | None = None
+    # The variant of the query that matched, for searches with variants
+    variant: str | None = None
 
     def __lt__(self, other: "Result"):
         # !!! Value is negated for purpose of max heap
@@ -22,27 +47,490 @@ class Result:
 
     @property
     def similarity(self):
+        if self.refined_similarity is not None:
+            return self.refined_similarity
         return 1.0 - (self._value() / 64)
 
 
+def top_n_indices(distances: np.ndarray, top_n: int) -> np.ndarray:
+    k = min(top_n, len(distances))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    candidates = np.argpartition(distances, k - 1)[:k]
+    # Ties are broken by record order so results are stable between runs
+    return candidates[np.lexsort((candidates, distances[candidates]))]
+
+
+def _refine(
+    image: Image,
+    storage: HashStorage,
+    kind: HashKind,
+    offsets: np.ndarray,
+    distances: np.ndarray,
+    bits: int,
+    top_n: int,
+    profiler: Profiler,
+) -> tuple[np.ndarray, np.ndarray]:
+    # Re-ranks the candidates of the coarse search by their `kind` hash.
+    # Returns (offsets, distances) with distances as a fraction of the hash
+    # size, candidates stored without that hash keep their coarse distance.
+    with profiler.stage("refine", len(offsets)):
+        query = pack_hash(kind.compute(image))
+        hashes, present = storage.extra_hashes(kind, offsets)
+        scores = distances / bits
+        scores[present] = hamming_distances(hashes[present], query) / kind.bits
+        order = np.argsort(scores, kind="stable")[:top_n]
+    return offsets[order], scores[order]
+
+
+def _read_records(
+    storage: HashStorage, offsets: Iterable[int], profiler: Profiler
+) -> list[LazyVideoFrameHash]:
+    records = []
+    for offset in offsets:
+        start = time.perf_counter()
+        record = storage.read_record(int(offset))
+        profiler.add(
+            "read_records",
+            time.perf_counter() - start,
+            1,
+            len(record.frame_data),
+            start,
+        )
+        records.append(record)
+    return records
+
+
+def _results(
+    image: Image,
+    current_hash: ImageHash,
+    storage: HashStorage,
+    offsets: np.ndarray,
+    distances: np.ndarray,
+    top_n: int,
+    refine: HashKind | None,
+    profiler: Profiler,
+) -> list[Result]:
+    if refine is None:
+        return [
+            Result(current_hash, record)
+            for record in _read_records(storage, offsets, profiler)
+        ]
+
+    offsets, scores = _refine(
+        image,
+        storage,
+        refine,
+        offsets,
+        distances,
+        current_hash.hash.size,
+        top_n,
+        profiler,
+    )
+    return [
+        Result(current_hash, record, 1.0 - float(score))
+        for record, score in zip(_read_records(storage, offsets, profiler), scores)
+    ]
+
+
+def _merge_top_n(keys: np.ndarray, top_n: int) -> np.ndarray:
+    # Keeps the top_n smallest keys of every row, sorted
+    if keys.shape[1] > top_n:
+        if top_n <= 0:
+            return keys[:, :0]
+        keys = np.partition(keys, top_n - 1, axis=1)[:, :top_n]
+    return np.sort(keys, axis=1)
+
+
+def _hash_table(
+    storage: HashStorage,
+    progress_callback: Callable[[float, float], Any] | None,
+    profiler: Profiler,
+) -> HashTable:
+    # Reading the hash table is the deserialization step of a search, its
+    # bytes are the hashes and offsets handed to the distance computation
+    started = time.perf_counter()
+    table = storage.hash_table(progress_callback)
+    profiler.add(
+        "deserialize",
+        time.perf_counter() - started,
+        len(table),
+        table.hashes.nbytes + table.offsets.nbytes,
+        started,
+    )
+    return table
+
+
+def nearest(
+    storage: HashStorage,
+    queries: np.ndarray,
+    top_n: int,
+    max_distance: int | None = None,
+    progress_callback: Callable[[float, float], Any] | None = None,
+    profiler: Profiler | None = None,
+    table: HashTable | None = None,
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    # Returns (offsets, distances) of the closest records to each of the packed
+    # queries. Queries the index can't answer are searched together with a
+    # single pass over the storage: their distances to a chunk of records are
+    # computed at once and merged into a running top-N per query. `table` is
+    # the storage's hash table when it was already read, e.g. from a cache.
+    profiler = profiler or Profiler()
+    if progress_callback:
+        progress_callback = throttle(progress_callback)
+    if isinstance(storage, ShardedStorage) and table is None:
+        return storage.nearest(
+            queries, top_n, max_distance, progress_callback, profiler
+        )
+
+    empty = np.empty(0, dtype=np.int64)
+    found: list[tuple[np.ndarray, np.ndarray]] = []
+    pending: list[int] = []
+    for i, query in enumerate(queries):
+        result = None
+        if storage.index is not None:
+            with profiler.stage("index"):
+                result = storage.index.search(query, top_n, max_distance)
+        if result is None:
+            pending.append(i)
+        found.append((empty, empty) if result is None else result)
+
+    if not pending:
+        if progress_callback:
+            progress_callback(1.0, 1.0)
+        return found
+
+    if table is None:
+        table = _hash_table(storage, progress_callback, profiler)
+    elif progress_callback:
+        progress_callback(1.0, 1.0)
+    profiler.count("records_scanned", len(table))
+    # Distance and record index are packed into one key, so that ties are
+    # broken by record order like in top_n_indices.
+    shift = max(len(table), 1).bit_length()
+    pending_queries = queries[pending][:, np.newaxis]
+    best = np.empty((len(pending), 0), dtype=np.int64)
+    chunk = max(1024, BATCH_ELEMENTS // len(pending))
+    for start in range(0, len(table), chunk):
+        hashes = table.hashes[start : start + chunk]
+        with profiler.stage("distance", len(hashes) * len(pending), hashes.nbytes):
+            distances = np.bitwise_count(hashes[np.newaxis] ^ pending_queries).sum(
+                axis=2, dtype=np.int64
+            )
+        with profiler.stage("select", len(hashes) * len(pending)):
+            keys = (distances << shift) | np.arange(start, start + len(hashes))
+            best = _merge_top_n(np.concatenate([best, keys], axis=1), top_n)
+
+    for i, keys in zip(pending, best):
+        if max_distance is not None:
+            keys = keys[keys >> shift <= max_distance]
+        found[i] = (table.offsets[keys & ((1 << shift) - 1)], keys >> shift)
+    return found
+
+
 def search_similar(
     image: Image,
     storage: HashStorage,
-    hash_algorithm: Callable[[Image], ImageHash] = phash,
+    hash_algorithm: Callable[[Image], ImageHash] = phash_image,
     top_n: int = 50,
     progress_callback: Callable[[float, float], Any] | None = None,
+    max_distance: int | None = None,
+    refine: HashKind | None = None,
+    profiler: Profiler | None = None,
+    table: HashTable | None = None,
+    variants: VariantOptions | None = None,
 ):
-    current_hash = hash_algorithm(image)
-
-    # The heap must be a max-heap, because heappushpop() will pop the lowest value
-    # Therefore when all of this are done, it will be the least differ from base.
-    h: list[Result] = []
-    for hash in storage.iter_with_progress(progress_callback):
-        c = Result(current_hash, hash)
-        if len(h) < top_n:
-            heapq.heappush(h, c)
-        else:
-            heapq.heappushpop(h, c)
-
-    # Result is reversed because of max heap
-    return reversed([heapq.heappop(h) for i in range(len(h))])
+    # With `refine`, the search is a cascade: the stored phash picks
+    # CASCADE_FACTOR times as many candidates as asked for, which are then
+    # ranked by the finer hash. max_distance applies to the first stage.
+    # With `variants`, the variants of the query are searched as well.
+    if variants is not None:
+        [results] = search_many(
+            [image],
+            storage,
+            hash_algorithm,
+            top_n,
+            progress_callback,
+            max_distance,
+            refine,
+            profiler,
+            table,
+            variants,
+        )
+        return results
+
+    profiler = profiler or Profiler()
+    with profiler.stage("query_hash"):
+        current_hash = hash_algorithm(image)
+    candidates = top_n * CASCADE_FACTOR if refine is not None else top_n
+    [(offsets, distances)] = nearest(
+        storage,
+        pack_hash(current_hash)[np.newaxis],
+        candidates,
+        max_distance,
+        progress_callback,
+        profiler,
+        table,
+    )
+    return _results(
+        image, current_hash, storage, offsets, distances, top_n, refine, profiler
+    )
+
+
+def search_many(
+    images: list[Image],
+    storage: HashStorage,
+    hash_algorithm: Callable[[Image], ImageHash] = phash_image,
+    top_n: int = 50,
+    progress_callback: Callable[[float, float], Any] | None = None,
+    max_distance: int | None = None,
+    refine: HashKind | None = None,
+    profiler: Profiler | None = None,
+    table: HashTable | None = None,
+    variants: VariantOptions | None = None,
+) -> list[list[Result]]:
+    # Searches every image with a single pass over the storage. Returns the
+    # results of each image in order, the same as search_similar would.
+    profiler = profiler or Profiler()
+    if variants is not None:
+        return _search_variants(
+            images,
+            storage,
+            hash_algorithm,
+            top_n,
+            progress_callback,
+            max_distance,
+            refine,
+            profiler,
+            table,
+            variants,
+        )
+
+    with profiler.stage("query_hash", len(images)):
+        current_hashes = [hash_algorithm(image) for image in images]
+    queries = pack_hashes(np.stack([h.hash for h in current_hashes]))
+    candidates = top_n * CASCADE_FACTOR if refine is not None else top_n
+    found = nearest(
+        storage, queries, candidates, max_distance, progress_callback, profiler, table
+    )
+
+    return [
+        _results(
+            image,
+            current_hash,
+            storage,
+            offsets,
+            distances,
+            top_n,
+            refine,
+            profiler,
+        )
+        for image, current_hash, (offsets, distances) in zip(
+            images, current_hashes, found
+        )
+    ]
+
+
+def _search_variants(
+    images: list[Image],
+    storage: HashStorage,
+    hash_algorithm: Callable[[Image], ImageHash],
+    top_n: int,
+    progress_callback: Callable[[float, float], Any] | None,
+    max_distance: int | None,
+    refine: HashKind | None,
+    profiler: Profiler,
+    table: HashTable | None,
+    options: VariantOptions,
+) -> list[list[Result]]:
+    # The variants of all images are queries of the same pass over the
+    # storage, the records they found are then merged per image
+    with profiler.stage("query_variants", len(images)):
+        variants = [query_variants(image, options) for image in images]
+    with profiler.stage("query_hash", sum(len(v) for v in variants)):
+        hashes = [[hash_algorithm(v.image) for v in image] for image in variants]
+    queries = pack_hashes(np.stack([h.hash for image in hashes for h in image]))
+    candidates = top_n * CASCADE_FACTOR if refine is not None else top_n
+    found = nearest(
+        storage, queries, candidates, max_distance, progress_callback, profiler, table
+    )
+
+    results = []
+    start = 0
+    for image_variants, image_hashes in zip(variants, hashes):
+        end = start + len(image_variants)
+        results.append(
+            _merge_variants(
+                image_variants,
+                image_hashes,
+                storage,
+                found[start:end],
+                top_n,
+                refine,
+                profiler,
+            )
+        )
+        start = end
+    return results
+
+
+def _merge_variants(
+    variants: list[Variant],
+    hashes: list[ImageHash],
+    storage: HashStorage,
+    found: list[tuple[np.ndarray, np.ndarray]],
+    top_n: int,
+    refine: HashKind | None,
+    profiler: Profiler,
+) -> list[Result]:
+    # A record found by several variants counts with its closest one. Records
+    # of the same frame, e.g. of a re-indexed video in a legacy database, are
+    # returned once.
+    with profiler.stage("merge_variants", sum(len(o) for o, _ in found)):
+        offsets = np.concatenate([o for o, _ in found]).astype(np.int64)
+        distances = np.concatenate([d for _, d in found]).astype(np.int64)
+        sources = np.concatenate(
+            [np.full(len(o), i, dtype=np.int64) for i, (o, _) in enumerate(found)]
+        )
+        order = np.lexsort((sources, offsets, distances))
+        _, first = np.unique(offsets[order], return_index=True)
+        order = order[np.sort(first)]
+        offsets, distances, sources = offsets[order], distances[order], sources[order]
+
+    scores = None
+    if refine is not None:
+        with profiler.stage("refine", len(offsets)):
+            scores = distances / hashes[0].hash.size
+            for i in np.unique(sources):
+                matched = sources == i
+                query = pack_hash(refine.compute(variants[i].image))
+                stored, present = storage.extra_hashes(refine, offsets[matched])
+                variant_scores = scores[matched]
+                variant_scores[present] = (
+                    hamming_distances(stored[present], query) / refine.bits
+                )
+                scores[matched] = variant_scores
+            order = np.argsort(scores, kind="stable")
+            offsets, sources, scores = offsets[order], sources[order], scores[order]
+
+    results: list[Result] = []
+    seen: set[tuple[str, float]] = set()
+    for i, offset in enumerate(offsets):
+        if len(results) >= top_n:
+            break
+        [record] = _read_records(storage, [offset], profiler)
+        key = (str(record.path), record.time)
+        if key in seen:
+            continue
+        seen.add(key)
+        source = int(sources[i])
+        results.append(
+            Result(
+                hashes[source],
+                record,
+                None if scores is None else 1.0 - float(scores[i]),
+                variants[source].name,
+            )
+        )
+    return results
+
+
+@dataclass
+class SearchSnapshot:
+    # The best matches among the first `scanned` of `total` records
+    results: list[Result]
+    scanned: int
+    total: int
+    done: bool
+
+
+def iter_search(
+    image: Image,
+    storage: HashStorage,
+    hash_algorithm: Callable[[Image], ImageHash] = phash_image,
+    top_n: int = 50,
+    max_distance: int | None = None,
+    refine: HashKind | None = None,
+    cancelled: Callable[[], bool] | None = None,
+    stop_after_exact: int | None = None,
+    interval: float = SNAPSHOT_INTERVAL,
+    profiler: Profiler | None = None,
+    table: HashTable | None = None,
+) -> Iterator[SearchSnapshot]:
+    # Streams the best matches found so far: a snapshot at most every
+    # `interval` seconds while they change, then a final one with done set.
+    # Nothing more is yielded once `cancelled` returns true. The scan stops
+    # early when `stop_after_exact` matches at distance 0 were found. The
+    # final results are the same as search_similar's for a full scan.
+    profiler = profiler or Profiler()
+    with profiler.stage("query_hash"):
+        current_hash = hash_algorithm(image)
+    query = pack_hash(current_hash)
+    candidates = top_n * CASCADE_FACTOR if refine is not None else top_n
+
+    def snapshot(offsets: np.ndarray, distances: np.ndarray, scanned: int, done: bool):
+        results = _results(
+            image,
+            current_hash,
+            storage,
+            offsets,
+            distances,
+            top_n,
+            refine,
+            profiler,
+        )
+        return SearchSnapshot(results, scanned, total, done)
+
+    found = None
+    if storage.index is not None:
+        with profiler.stage("index"):
+            found = storage.index.search(query, candidates, max_distance)
+    if found is not None:
+        total = len(found[0])
+        yield snapshot(*found, total, True)
+        return
+
+    if table is None:
+        table = _hash_table(storage, None, profiler)
+    total = len(table)
+    shift = max(total, 1).bit_length()
+
+    def split(keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        return table.offsets[keys & ((1 << shift) - 1)], keys >> shift
+
+    best = np.empty((1, 0), dtype=np.int64)
+    scanned = 0
+    changed = False
+    last = time.monotonic()
+    while scanned < total:
+        if cancelled and cancelled():
+            return
+
+        hashes = table.hashes[scanned : scanned + STREAM_CHUNK]
+        with profiler.stage("distance", len(hashes), hashes.nbytes):
+            distances = np.bitwise_count(hashes ^ query).sum(axis=1, dtype=np.int64)
+        with profiler.stage("select", len(hashes)):
+            keys = (distances << shift) | np.arange(scanned, scanned + len(hashes))
+            if max_distance is not None:
+                keys = keys[distances <= max_distance]
+            merged = _merge_top_n(
+                np.concatenate([best, keys[np.newaxis]], axis=1), candidates
+            )
+        changed = changed or not np.array_equal(merged, best)
+        best = merged
+        scanned += len(hashes)
+        profiler.count("records_scanned", len(hashes))
+
+        if stop_after_exact and np.count_nonzero(best[0] >> shift == 0) >= min(
+            stop_after_exact, candidates
+        ):
+            break
+        if changed and scanned < total and time.monotonic() - last >= interval:
+            yield snapshot(*split(best[0]), scanned, False)
+            changed = False
+            last = time.monotonic()
+
+    if cancelled and cancelled():
+        return
+    yield snapshot(*split(best[0]), scanned, True)
@@ -0,0 +1,324 @@
+import base64
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+from dataclasses import dataclass
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from os import PathLike
+from pathlib import Path
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import Any
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from imagehash import phash
+from PIL import Image as PILImage
+from PIL import UnidentifiedImageError
+
+from video_search.hash import hamming_distances, pack_hash
+from video_search.index import sync_index
+from video_search.search import Result, top_n_indices
+from video_search.shards import Catalog, ShardedStorage, is_catalog
+from video_search.storage import (
+    HashStorage,
+    HashTable,
+    ManifestEntry,
+    open_storage,
+    video_manifest,
+)
+
+# Latencies of this many recent queries are kept for the stats endpoint
+LATENCY_WINDOW = 10000
+
+
+@dataclass(frozen=True)
+class FileState:
+    # Of the database, or summed over the shards of a catalog
+    inode: int
+    size: int
+    mtime: int
+
+
+class SearchService:
+    # Keeps a database open with all of its hashes in memory. Hashing the query
+    # and scanning the hash table run concurrently, reloading, index lookups and
+    # reading records back from the storage are serialized.
+    def __init__(self, db_path: PathLike):
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        self._stack = ExitStack()
+        self._storage: HashStorage | None = None
+        self._table: HashTable | None = None
+        self._videos: dict[str, ManifestEntry] = {}
+        self._state: FileState | None = None
+        # The catalog the database is, loaded again only when its file changed
+        self._db_stat: tuple[int, int, int] | None = None
+        self._catalog: Catalog | None = None
+        self._latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._started = time.time()
+        self.queries = 0
+        self.reloads = 0
+        with self._lock:
+            self._reload()
+
+    def close(self):
+        with self._lock:
+            self._stack.close()
+
+    def _open(self):
+        self._stack.close()
+        self._stack = ExitStack()
+        self._storage = self._stack.enter_context(
+            open_storage(self.db_path, read_only=True)
+        )
+        self._videos = dict(video_manifest(self._storage))
+        self._table = self._storage.hash_table()
+
+    def _file_state(self) -> FileState:
+        # Runs before every query, only stats the files unless one changed
+        stat = os.stat(self.db_path)
+        db_stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if db_stat != self._db_stat:
+            self._db_stat = db_stat
+            self._catalog = None
+            if is_catalog(self.db_path):
+                self._catalog = Catalog.load(self.db_path)
+        catalog = self._catalog
+        if catalog is None:
+            return FileState(*db_stat)
+
+        # Records are appended to the shards, the catalog itself only changes
+        # when a shard is added
+        size = 0
+        mtime = stat.st_mtime_ns
+        for shard in range(len(catalog.shards)):
+            try:
+                shard_stat = os.stat(catalog.shard_path(shard))
+            except FileNotFoundError:
+                continue
+            size += shard_stat.st_size
+            mtime = max(mtime, shard_stat.st_mtime_ns)
+        return FileState(stat.st_ino, size, mtime)
+
+    def _reload(self):
+        state = self._file_state()
+        previous = self._state
+        if previous is not None and (state.size, state.mtime) == (
+            previous.size,
+            previous.mtime,
+        ):
+            return
+
+        self._state = state
+        self.reloads += 1
+        if (
+            self._storage is None
+            or previous is None
+            or state.inode != previous.inode
+            or state.size < previous.size
+            or isinstance(self._storage, ShardedStorage)
+        ):
+            # The database was replaced or rewritten, e.g. by migrate. Any
+            # shard of a catalog may have been, so those are opened again.
+            self._open()
+            return
+
+        # Records were appended by another process. Only those after the last
+        # one in the table are read, the records of videos re-indexed or
+        # removed since are dropped from it. The index learns of both here.
+        storage = self._storage
+        table = self._table
+        assert table is not None
+        videos = dict(video_manifest(storage))
+        tail = storage.hash_table(after=int(table.offsets[-1]) if len(table) else -1)
+        if not len(table):
+            table = tail
+        elif len(tail):
+            table = HashTable(
+                np.concatenate([table.hashes, tail.hashes]),
+                np.concatenate([table.offsets, tail.offsets]),
+            )
+        dead = [
+            (old.first, old.last)
+            for path, old in self._videos.items()
+            if old.first >= 0 and videos.get(path) != old
+        ]
+        if dead:
+            alive = np.ones(len(table), dtype=bool)
+            for first, last in dead:
+                alive &= (table.offsets < first) | (table.offsets > last)
+            table = HashTable(table.hashes[alive], table.offsets[alive])
+        self._table = table
+        self._videos = videos
+        if storage.index is not None:
+            sync_index(storage)
+
+    def search(
+        self, image_data: bytes, top_n: int = 50, max_distance: int | None = None
+    ) -> list[Result]:
+        start = time.perf_counter()
+        current_hash = phash(PILImage.open(BytesIO(image_data)))
+        query = pack_hash(current_hash)
+
+        while True:
+            with self._lock:
+                self._reload()
+                storage = self._storage
+                table = self._table
+                assert storage is not None and table is not None
+
+                found = None
+                if storage.index is not None:
+                    found = storage.index.search(query, top_n, max_distance)
+
+            if found is not None:
+                offsets = found[0]
+            else:
+                distances = hamming_distances(table.hashes, query)
+                best = top_n_indices(distances, top_n)
+                if max_distance is not None:
+                    best = best[distances[best] <= max_distance]
+                offsets = table.offsets[best]
+
+            with self._lock:
+                # Offsets are only valid for the storage they were found in
+                if storage is not self._storage:
+                    continue
+                results = [
+                    Result(current_hash, storage.read_record(int(offset)))
+                    for offset in offsets
+                ]
+                self.queries += 1
+                self._latencies.append(time.perf_counter() - start)
+            return results
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            records = len(self._table) if self._table is not None else 0
+            db_size = self._state.size if self._state is not None else 0
+
+        def percentile(p: float) -> float | None:
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+
+        return {
+            "queries": self.queries,
+            "records": records,
+            "db_size": db_size,
+            "reloads": self.reloads,
+            "uptime": time.time() - self._started,
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+        }
+
+
+def result_json(result: Result, thumbnails: bool = False) -> dict[str, Any]:
+    data: dict[str, Any] = {
+        "path": str(result.match.path),
+        "time": result.match.time,
+        "similarity": float(result.similarity),
+    }
+    if thumbnails:
+        thumbnail = bytes(result.match.frame_data)
+        if not thumbnail:
+            with BytesIO() as im:
+                result.match.load_image().save(im, format="PNG")
+                thumbnail = im.getvalue()
+        data["thumbnail"] = base64.b64encode(thumbnail).decode("ascii")
+    return data
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    # POST /search with the image as body, optional query parameters top_n,
+    # max_distance, threshold and thumbnails=1. GET /stats for counters.
+    server: "SearchHTTPServer | SearchUnixServer"
+
+    def _send_json(self, data: Any, status: HTTPStatus = HTTPStatus.OK):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/stats":
+            self._send_json({"error": "Not found"}, HTTPStatus.NOT_FOUND)
+            return
+        self._send_json(self.server.service.stats())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/search":
+            self._send_json({"error": "Not found"}, HTTPStatus.NOT_FOUND)
+            return
+
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            top_n = int(params.get("top_n", 50))
+            max_distance = (
+                int(params["max_distance"]) if "max_distance" in params else None
+            )
+            threshold = float(params.get("threshold", 0.0))
+        except ValueError as e:
+            self._send_json({"error": str(e)}, HTTPStatus.BAD_REQUEST)
+            return
+        thumbnails = params.get("thumbnails", "0") not in ("0", "false", "")
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            self._send_json({"error": "Invalid Content-Length"}, HTTPStatus.BAD_REQUEST)
+            return
+        try:
+            results = self.server.service.search(
+                self.rfile.read(length), top_n, max_distance
+            )
+        except UnidentifiedImageError:
+            self._send_json({"error": "Not an image"}, HTTPStatus.BAD_REQUEST)
+            return
+        except OSError as e:
+            # Truncated or corrupt image data
+            self._send_json({"error": f"Invalid image: {e}"}, HTTPStatus.BAD_REQUEST)
+            return
+
+        self._send_json(
+            {
+                "results": [
+                    result_json(result, thumbnails)
+                    for result in results
+                    if result.similarity >= threshold
+                ]
+            }
+        )
+
+    def address_string(self) -> str:
+        # Unix sockets have no client address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format: str, *args: Any):
+        pass
+
+
+class SearchHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], service: SearchService):
+        super().__init__(address, SearchHandler)
+        self.service = service
+
+
+class SearchUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: PathLike, service: SearchService):
+        Path(path).unlink(missing_ok=True)
+        super().__init__(str(path), SearchHandler)
+        self.service = service
@@ -0,0 +1,374 @@
+import json
+import os
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from enum import Enum
+from os import PathLike
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from imagehash import ImageHash
+
+from video_search.hash import HashKind
+from video_search.profiling import Profiler
+from video_search.storage import (
+    HashStorage,
+    HashTable,
+    LazyVideoFrameHash,
+    ManifestEntry,
+    VideoFrames,
+    WriteOptions,
+)
+
+CATALOG_FORMAT = "video-search-catalog"
+CATALOG_SUFFIX = ".catalog"
+# Record offsets of a sharded storage carry the shard number in the top bits
+SHARD_SHIFT = 40
+DEFAULT_SHARD_SIZE = 4 << 30
+
+
+class ShardSplit(str, Enum):
+    # A new shard is started when the last one reached the shard size, or for
+    # every directory videos are indexed from
+    SIZE = "size"
+    DIRECTORY = "directory"
+
+
+@dataclass
+class Catalog:
+    path: Path
+    split: ShardSplit = ShardSplit.SIZE
+    shard_size: int = DEFAULT_SHARD_SIZE
+    # Shard files, relative to the catalog
+    shards: list[str] = field(default_factory=list)
+    directories: dict[str, int] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, path: PathLike) -> "Catalog":
+        with open(path) as f:
+            data = json.load(f)
+        return cls(
+            Path(path),
+            ShardSplit(data["split"]),
+            int(data["shard_size"]),
+            list(data["shards"]),
+            {k: int(v) for k, v in data.get("directories", {}).items()},
+        )
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "format": CATALOG_FORMAT,
+                    "split": self.split.value,
+                    "shard_size": self.shard_size,
+                    "shards": self.shards,
+                    "directories": self.directories,
+                },
+                f,
+                indent=2,
+            )
+        os.replace(tmp, self.path)
+
+    def shard_path(self, shard: int) -> Path:
+        return self.path.parent / self.shards[shard]
+
+    def add_shard(self, path: PathLike | None = None) -> int:
+        if path is None:
+            name = f"{self.path.stem}-{len(self.shards):04d}.db"
+        else:
+            name = os.path.relpath(Path(path).resolve(), self.path.parent.resolve())
+        self.shards.append(name)
+        self.save()
+        return len(self.shards) - 1
+
+
+def is_catalog(path: PathLike) -> bool:
+    path = Path(path)
+    if not path.exists():
+        return path.suffix == CATALOG_SUFFIX
+
+    with open(path, "rb") as f:
+        if f.read(1) != b"{":
+            return False
+    try:
+        with open(path) as f:
+            return json.load(f).get("format") == CATALOG_FORMAT
+    except (ValueError, UnicodeDecodeError):
+        return False
+
+
+class ShardedStorage(HashStorage):
+    # A catalog of databases that is read and written as one. Every video is
+    # written to a single shard, re-indexing a video writes to the shard that
+    # already has it. Searches run on all shards in parallel.
+    def __init__(
+        self,
+        catalog: Catalog,
+        jobs: int | None = None,
+        write_options: WriteOptions | None = None,
+        read_only: bool = False,
+    ):
+        self.catalog = catalog
+        self.write_options = write_options or WriteOptions()
+        self.read_only = read_only
+        self._jobs = jobs or os.cpu_count() or 1
+        self._stack = ExitStack()
+        self._storages: dict[int, HashStorage] = {}
+        self._video_shards: dict[str, int] | None = None
+        self._writing: dict[str, int] = {}
+        self._executor: ThreadPoolExecutor | None = None
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._stack.close()
+
+    def shard(self, shard: int) -> HashStorage:
+        from video_search.storage import open_storage
+
+        if shard not in self._storages:
+            self._storages[shard] = self._stack.enter_context(
+                open_storage(
+                    self.catalog.shard_path(shard), self.write_options, self.read_only
+                )
+            )
+        return self._storages[shard]
+
+    def _shards(self) -> range:
+        return range(len(self.catalog.shards))
+
+    def __iter__(self):
+        return self.iter_with_progress()
+
+    def iter_with_progress(
+        self, progress_callback: Callable[[float, float], Any] | None = None
+    ):
+        total = float(len(self.catalog.shards))
+        for shard in self._shards():
+            yield from self.shard(shard)
+            if progress_callback:
+                progress_callback(float(shard + 1), total)
+
+        if progress_callback:
+            progress_callback(total, total)
+
+    def _shard_of(self) -> dict[str, int]:
+        if self._video_shards is None:
+            self._video_shards = {
+                path: shard
+                for shard in self._shards()
+                for path in self.shard(shard).videos()
+            }
+        return self._video_shards
+
+    def _shard_for(self, path: str) -> int:
+        if path in self._writing:
+            return self._writing[path]
+
+        if path in self._shard_of():
+            shard = self._shard_of()[path]
+        elif self.catalog.split == ShardSplit.DIRECTORY:
+            directory = str(Path(path).parent)
+            if directory not in self.catalog.directories:
+                self.catalog.directories[directory] = len(self.catalog.shards)
+                self.catalog.add_shard()
+            shard = self.catalog.directories[directory]
+        else:
+            shard = len(self.catalog.shards) - 1
+            if shard < 0 or self._shard_size(shard) >= self.catalog.shard_size:
+                shard = self.catalog.add_shard()
+
+        self._writing[path] = shard
+        return shard
+
+    def _shard_size(self, shard: int) -> int:
+        self.shard(shard).flush()
+        return os.path.getsize(self.catalog.shard_path(shard))
+
+    def append_record(
+        self,
+        frame_data: bytes,
+        hash: ImageHash,
+        path: PathLike[str],
+        time: float,
+        extra: dict[HashKind, ImageHash] | None = None,
+    ):
+        shard = self._shard_for(str(path))
+        self.shard(shard).append_record(frame_data, hash, path, time, extra)
+
+    def commit_video(self, entry: ManifestEntry):
+        shard = self._shard_for(entry.path)
+        del self._writing[entry.path]
+        self.shard(shard).commit_video(entry)
+        self._shard_of()[entry.path] = shard
+
+    def remove_video(self, path: str):
+        if path in self._shard_of():
+            self.shard(self._shard_of()[path]).remove_video(path)
+
+    def flush(self):
+        for storage in self._storages.values():
+            storage.flush()
+
+    def videos(self) -> dict[str, ManifestEntry]:
+        videos: dict[str, ManifestEntry] = {}
+        for shard in self._shards():
+            videos.update(self.shard(shard).videos())
+        return videos
+
+    def video_frames(self, path: str) -> VideoFrames:
+        if path not in self._shard_of():
+            return VideoFrames.empty()
+        shard = self._shard_of()[path]
+        frames = self.shard(shard).video_frames(path)
+        frames.offsets = frames.offsets | (shard << SHARD_SHIFT)
+        return frames
+
+    def hash_table(
+        self,
+        progress_callback: Callable[[float, float], Any] | None = None,
+        after: int = -1,
+    ) -> HashTable:
+        total = float(len(self.catalog.shards))
+        hashes: list[np.ndarray] = []
+        offsets: list[np.ndarray] = []
+        for shard in self._shards():
+            shard_after = -1
+            if after >= 0:
+                if shard < after >> SHARD_SHIFT:
+                    continue
+                if shard == after >> SHARD_SHIFT:
+                    shard_after = after & ((1 << SHARD_SHIFT) - 1)
+
+            table = self.shard(shard).hash_table(after=shard_after)
+            if len(table):
+                if hashes and table.hashes.shape[1] != hashes[0].shape[1]:
+                    raise ValueError("Database contains hashes of different sizes")
+                hashes.append(table.hashes)
+                offsets.append(table.offsets | (shard << SHARD_SHIFT))
+            if progress_callback:
+                progress_callback(float(shard + 1), total)
+
+        if progress_callback:
+            progress_callback(total, total)
+
+        if not hashes:
+            return HashTable(np.empty((0, 1), np.uint64), np.empty(0, np.int64))
+        return HashTable(np.concatenate(hashes), np.concatenate(offsets))
+
+    def read_record(self, offset: int) -> LazyVideoFrameHash:
+        return self.shard(offset >> SHARD_SHIFT).read_record(
+            offset & ((1 << SHARD_SHIFT) - 1)
+        )
+
+    def extra_hashes(
+        self, kind: HashKind, offsets: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        hashes, present = super().extra_hashes(kind, offsets)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        shards = offsets >> SHARD_SHIFT
+        for shard in np.unique(shards):
+            selected = shards == shard
+            hashes[selected], present[selected] = self.shard(int(shard)).extra_hashes(
+                kind, offsets[selected] & ((1 << SHARD_SHIFT) - 1)
+            )
+        return hashes, present
+
+    def nearest(
+        self,
+        queries: np.ndarray,
+        top_n: int,
+        max_distance: int | None = None,
+        progress_callback: Callable[[float, float], Any] | None = None,
+        profiler: Profiler | None = None,
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        # Every shard finds its own top-N, which are then merged. Ties are
+        # broken by shard and record order. The shards stay open, they are
+        # searched on threads as computing the distances releases the GIL.
+        from video_search.search import nearest
+
+        profiler = profiler or Profiler()
+        self.flush()
+        total = float(len(self.catalog.shards))
+        storages = [self.shard(shard) for shard in self._shards()]
+        found: list[list[tuple[np.ndarray, np.ndarray]]] = []
+        if self._jobs <= 1 or total <= 1:
+            for shard, storage in enumerate(storages):
+                found.append(
+                    nearest(storage, queries, top_n, max_distance, None, profiler)
+                )
+                if progress_callback:
+                    progress_callback(float(shard + 1), total)
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self._jobs, thread_name_prefix="shards"
+                )
+            profilers = [Profiler(profiler.trace) for _ in storages]
+            futures = [
+                self._executor.submit(
+                    nearest,
+                    storage,
+                    queries,
+                    top_n,
+                    max_distance,
+                    None,
+                    shard_profiler,
+                )
+                for storage, shard_profiler in zip(storages, profilers, strict=True)
+            ]
+            for shard, future in enumerate(futures):
+                found.append(future.result())
+                profiler.merge(profilers[shard])
+                if progress_callback:
+                    progress_callback(float(shard + 1), total)
+
+        if progress_callback:
+            progress_callback(total, total)
+
+        merged: list[tuple[np.ndarray, np.ndarray]] = []
+        for i in range(len(queries)):
+            offsets = np.concatenate(
+                [np.empty(0, dtype=np.int64)]
+                + [
+                    np.asarray(shard_found[i][0], dtype=np.int64)
+                    | (shard << SHARD_SHIFT)
+                    for shard, shard_found in enumerate(found)
+                ]
+            )
+            distances = np.concatenate(
+                [np.empty(0, dtype=np.int64)]
+                + [
+                    np.asarray(shard_found[i][1], dtype=np.int64)
+                    for shard_found in found
+                ]
+            )
+            best = np.lexsort((offsets, distances))[:top_n]
+            merged.append((offsets[best], distances[best]))
+        return merged
+
+
+@contextmanager
+def open_catalog(
+    path: PathLike,
+    jobs: int | None = None,
+    write_options: WriteOptions | None = None,
+    read_only: bool = False,
+):
+    catalog = Catalog(Path(path))
+    if Path(path).exists():
+        catalog = Catalog.load(path)
+    else:
+        catalog.save()
+
+    storage = ShardedStorage(catalog, jobs, write_options, read_only)
+    try:
+        yield storage
+    finally:
+        storage.flush()
+        storage.close()
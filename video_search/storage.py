@@ -1,32 +1,100 @@
+import os
 import struct
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterator
 from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import Enum, IntEnum
 from io import BytesIO
 from os import PathLike
 from pathlib import Path
-from typing import Any, BinaryIO, Callable
+from typing import TYPE_CHECKING, Any, BinaryIO
 
 import numpy as np
 from imagehash import ImageHash
 from PIL import Image as PILImage
 from PIL.Image import Image
 
-from video_search.hash import VideoFrameHash
+from video_search.hash import (
+    HashKind,
+    VideoFrameHash,
+    encode_record,
+    pack_hash,
+    pack_hashes,
+)
+
+if TYPE_CHECKING:
+    from video_search.index import MultiIndexHash
+
+PROGRESS_INTERVAL = 4096
+# Minimum seconds between two calls of a throttled progress callback
+PROGRESS_SECONDS = 0.1
+
+Buffer = bytes | memoryview | np.ndarray
+
+
+def throttle(
+    callback: Callable[[float, float], Any], interval: float = PROGRESS_SECONDS
+) -> Callable[[float, float], Any]:
+    # Passes on at most one call per `interval` seconds, and always the final
+    # one where current reaches total
+    last = -interval
+
+    def throttled(current: float, total: float):
+        nonlocal last
+        now = time.monotonic()
+        if current >= total or now - last >= interval:
+            last = now
+            callback(current, total)
+
+    return throttled
 
 
 class LazyVideoFrameHash:
-    _frame_data: bytes
+    # The thumbnail is not read with the record, only its position in a buffer
+    # (usually the storage's memory map) is kept until the image is loaded.
+    _source: Buffer
+    _frame_offset: int
+    _frame_length: int
 
     frame: Image | None
     hash: ImageHash
     path: PathLike[str]
     time: float
 
+    @classmethod
+    def from_buffer(
+        cls,
+        source: Buffer,
+        frame_offset: int,
+        frame_length: int,
+        hash: ImageHash,
+        path: PathLike[str],
+        time: float,
+    ) -> "LazyVideoFrameHash":
+        instance = cls.__new__(cls)
+        instance.frame = None
+        instance._source = source
+        instance._frame_offset = frame_offset
+        instance._frame_length = frame_length
+        instance.hash = hash
+        instance.path = path
+        instance.time = time
+        return instance
+
+    @classmethod
+    def from_parts(
+        cls, frame_data: bytes, hash: ImageHash, path: PathLike[str], time: float
+    ) -> "LazyVideoFrameHash":
+        return cls.from_buffer(frame_data, 0, len(frame_data), hash, path, time)
+
     @classmethod
     def from_bytes(cls, data: bytes) -> "LazyVideoFrameHash":
         buf = BytesIO(data)
 
         (frame_len,) = struct.unpack("<I", buf.read(4))
-        frame_data = buf.read(frame_len)
+        buf.seek(frame_len, 1)
 
         (hash_len,) = struct.unpack("<I", buf.read(4))
         hash_array = np.load(BytesIO(buf.read(hash_len)), allow_pickle=False)
@@ -36,38 +104,222 @@ class LazyVideoFrameHash:
 
         (time,) = struct.unpack("<d", buf.read(8))
 
-        instance = cls.__new__(cls)
-        instance.frame = None
-        instance._frame_data = frame_data
-        instance.hash = ImageHash(hash_array)
-        instance.path = Path(path)
-        instance.time = time
-        return instance
+        return cls.from_buffer(
+            data, 4, frame_len, ImageHash(hash_array), Path(path), time
+        )
+
+    @property
+    def frame_data(self) -> memoryview:
+        start = self._frame_offset
+        return memoryview(self._source)[start : start + self._frame_length]
 
     def load_image(self):
         if self.frame is None:
-            self.frame = PILImage.open(BytesIO(self._frame_data))
+            if self._frame_length:
+                self.frame = PILImage.open(BytesIO(self.frame_data))
+            else:
+                # Stored without a thumbnail, decode it from the video instead
+                from video_search.thumbnails import default_cache
+
+                self.frame = default_cache.load(Path(self.path), self.time)
         return self.frame
 
 
-class HashStorage:
-    def __init__(self, file: BinaryIO):
+@dataclass
+class HashTable:
+    hashes: np.ndarray
+    offsets: np.ndarray
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+@dataclass
+class VideoFrames:
+    # The live records of one video in the order they were written, which is
+    # the order of their timestamps
+    offsets: np.ndarray
+    times: np.ndarray
+    hashes: np.ndarray
+
+    @classmethod
+    def empty(cls) -> "VideoFrames":
+        return cls(
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.float64),
+            np.empty((0, 1), dtype=np.uint64),
+        )
+
+
+class VideoStatus(IntEnum):
+    INCOMPLETE = 0
+    COMPLETE = 1
+    # Tombstone, none of the video's records are live
+    REMOVED = 2
+
+
+@dataclass
+class ManifestEntry:
+    path: str
+    size: int
+    mtime: float
+    duration: float
+    frames: int
+    status: VideoStatus
+    # Offsets of the first and last record of the video, -1 without records
+    first: int = -1
+    last: int = -1
+
+    @classmethod
+    def for_file(
+        cls, path: PathLike[str], duration: float, frames: int, status: VideoStatus
+    ) -> "ManifestEntry":
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return cls(str(path), -1, -1.0, duration, frames, status)
+        return cls(str(path), stat.st_size, stat.st_mtime, duration, frames, status)
+
+    def is_current(self, stat: os.stat_result) -> bool:
+        if self.status != VideoStatus.COMPLETE:
+            return False
+        # Entries without file information come from databases that had no
+        # manifest, those are trusted as they are.
+        if self.size < 0:
+            return True
+        return self.size == stat.st_size and self.mtime == stat.st_mtime
+
+
+def _npy_data_start(data: bytes) -> int:
+    if data[6] == 1:
+        (header_len,) = struct.unpack_from("<H", data, 8)
+        return 10 + header_len
+    (header_len,) = struct.unpack_from("<I", data, 8)
+    return 12 + header_len
+
+
+class SyncPolicy(str, Enum):
+    NEVER = "never"
+    # fsync once all records of a video are written
+    VIDEO = "video"
+    # fsync after every batch of records
+    BATCH = "batch"
+
+
+@dataclass
+class WriteOptions:
+    # Records are buffered and written this many at a time
+    batch_size: int = 1024
+    sync: SyncPolicy = SyncPolicy.VIDEO
+
+
+class HashStorage(ABC):
+    index: "MultiIndexHash | None" = None
+    write_options: WriteOptions
+
+    @abstractmethod
+    def __iter__(self) -> Iterator[LazyVideoFrameHash]: ...
+
+    @abstractmethod
+    def iter_with_progress(
+        self, progress_callback: Callable[[float, float], Any] | None = None
+    ) -> Iterator[LazyVideoFrameHash]: ...
+
+    def append_hash(self, hash: VideoFrameHash):
+        self.append_record(
+            hash.frame_bytes(), hash.hash, hash.path, hash.time, hash.extra
+        )
+
+    @abstractmethod
+    def append_record(
+        self,
+        frame_data: bytes,
+        hash: ImageHash,
+        path: PathLike[str],
+        time: float,
+        extra: dict[HashKind, ImageHash] | None = None,
+    ): ...
+
+    def extra_hashes(
+        self, kind: HashKind, offsets: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # Returns the packed `kind` hashes of the records at `offsets` and a
+        # mask of the records that have one.
+        words = -(-kind.bits // 64)
+        return (
+            np.zeros((len(offsets), words), dtype=np.uint64),
+            np.zeros(len(offsets), dtype=bool),
+        )
+
+    @abstractmethod
+    def hash_table(
+        self,
+        progress_callback: Callable[[float, float], Any] | None = None,
+        after: int = -1,
+    ) -> HashTable: ...
+
+    @abstractmethod
+    def read_record(self, offset: int) -> LazyVideoFrameHash: ...
+
+    @abstractmethod
+    def videos(self) -> dict[str, ManifestEntry]: ...
+
+    @abstractmethod
+    def video_frames(self, path: str) -> VideoFrames: ...
+
+    def commit_video(self, entry: ManifestEntry):
+        self.flush()
+
+    def remove_video(self, path: str):
+        # The video's records are skipped from now on, compaction drops them
+        self.commit_video(ManifestEntry(path, -1, -1.0, 0.0, 0, VideoStatus.REMOVED))
+
+    def flush(self):
+        pass
+
+    def _written(self, hashes: np.ndarray, offsets: np.ndarray):
+        if self.index is not None:
+            self.index.add(hashes, offsets)
+
+
+class LegacyHashStorage(HashStorage):
+    def __init__(self, file: BinaryIO, write_options: WriteOptions | None = None):
         self._file = file
+        self.write_options = write_options or WriteOptions()
+        self._map: np.memmap | None = None
+        self._buffer = bytearray()
+        self._buffered = 0
+        # End of the last complete record, known once this process writes
+        self._end: int | None = None
+
+    def _mapped(self, end: int) -> np.memmap:
+        # The map is only recreated once a record past its end is read
+        if self._map is None or len(self._map) < end:
+            # np.memmap moves the file position to the end of the file
+            position = self._file.tell()
+            self._file.flush()
+            self._map = np.memmap(self._file, dtype=np.uint8, mode="r")
+            self._file.seek(position)
+        return self._map
 
     def __iter__(self):
+        self.flush()
         self._file.seek(0)
         while True:
             try:
                 yield self.read_one()
-            except:
+            except EOFError:
                 return
 
     def iter_with_progress(
         self, progress_callback: Callable[[float, float], Any] | None = None
     ):
+        self.flush()
         self._file.seek(0, 2)
         total = float(self._file.tell())
         self._file.seek(0)
+        if progress_callback:
+            progress_callback = throttle(progress_callback)
         for item in self:
             if progress_callback:
                 progress_callback(float(self._file.tell()), total)
@@ -76,17 +328,268 @@ class HashStorage:
         if progress_callback:
             progress_callback(total, total)
 
-    def append_hash(self, hash: VideoFrameHash):
-        data = hash.to_bytes()
-        self._file.write(struct.pack("<I", len(data)))
-        self._file.write(data)
+    def append_record(
+        self,
+        frame_data: bytes,
+        hash: ImageHash,
+        path: PathLike[str],
+        time: float,
+        extra: dict[HashKind, ImageHash] | None = None,
+    ):
+        if extra:
+            raise ValueError(
+                "Additional hashes need a database in the current format, "
+                "migrate it first"
+            )
+
+        if self._end is None:
+            self._end = self._truncate_torn_tail()
+
+        data = encode_record(frame_data, hash, path, time)
+        offset = self._end + len(self._buffer)
+        self._buffer += struct.pack("<I", len(data))
+        self._buffer += data
+        self._buffered += 1
+        self._written(pack_hash(hash)[np.newaxis], np.array([offset]))
+        if self._buffered >= self.write_options.batch_size:
+            self.flush()
+
+    def _truncate_torn_tail(self) -> int:
+        # Walks the record lengths to the end of the last complete record and
+        # cuts off anything after it, which an interrupted writer left behind.
+        self._file.seek(0, 2)
+        total = self._file.tell()
+        offset = 0
+        while offset + 4 <= total:
+            self._file.seek(offset)
+            (record_len,) = struct.unpack("<I", self._file.read(4))
+            if offset + 4 + record_len > total:
+                break
+            offset += 4 + record_len
+
+        if offset < total:
+            self._file.truncate(offset)
+        return offset
+
+    def flush(self):
+        if not self._buffer:
+            return
+
+        assert self._end is not None
+        self._file.write(self._buffer)
+        self._file.flush()
+        if self.write_options.sync == SyncPolicy.BATCH:
+            os.fsync(self._file.fileno())
+        self._end += len(self._buffer)
+        self._buffer = bytearray()
+        self._buffered = 0
+
+    def commit_video(self, entry: ManifestEntry):
+        self.flush()
+        if self._end is not None and self.write_options.sync != SyncPolicy.NEVER:
+            os.fsync(self._file.fileno())
+
+    def _scan(
+        self,
+        progress_callback: Callable[[float, float], Any] | None = None,
+        after: int = -1,
+    ) -> Iterator[tuple[int, bytes, str, float]]:
+        # Yields (offset, .npy hash data, path, time) of each record, skipping
+        # over the thumbnails.
+        self.flush()
+        self._file.seek(0, 2)
+        total = self._file.tell()
+
+        offset = 0
+        if after >= 0:
+            self._file.seek(after)
+            (record_len,) = struct.unpack("<I", self._file.read(4))
+            offset = after + 4 + record_len
+
+        count = 0
+        while offset + 8 <= total:
+            self._file.seek(offset)
+            record_len, frame_len = struct.unpack("<II", self._file.read(8))
+            end = offset + 4 + record_len
+            if end > total:
+                break
+
+            self._file.seek(frame_len, 1)
+            (hash_len,) = struct.unpack("<I", self._file.read(4))
+            data = self._file.read(hash_len)
+            (path_len,) = struct.unpack("<I", self._file.read(4))
+            path = self._file.read(path_len).decode("utf-8")
+            (time,) = struct.unpack("<d", self._file.read(8))
+            yield offset, data, path, time
+            offset = end
+
+            count += 1
+            if progress_callback and count % PROGRESS_INTERVAL == 0:
+                progress_callback(float(offset), float(total))
+
+        if progress_callback:
+            progress_callback(float(total), float(total))
+
+    def hash_table(
+        self,
+        progress_callback: Callable[[float, float], Any] | None = None,
+        after: int = -1,
+    ) -> HashTable:
+        # The .npy header is the same for every record, so it is parsed once
+        # and the raw boolean payloads are concatenated.
+        offsets: list[int] = []
+        bits = bytearray()
+        header: bytes | None = None
+        hash_array: np.ndarray | None = None
+        for offset, data, _, _ in self._scan(progress_callback, after):
+            start = _npy_data_start(data)
+            if header is None:
+                header = data[:start]
+                hash_array = np.load(BytesIO(data), allow_pickle=False)
+            elif data[:start] != header:
+                raise ValueError("Database contains hashes of different sizes")
+
+            bits += data[start:]
+            offsets.append(offset)
+
+        if hash_array is None:
+            return HashTable(np.empty((0, 1), np.uint64), np.empty(0, np.int64))
+
+        matrix = np.frombuffer(bytes(bits), dtype=hash_array.dtype)
+        return HashTable(
+            pack_hashes(matrix.reshape(len(offsets), *hash_array.shape)),
+            np.array(offsets, dtype=np.int64),
+        )
+
+    def videos(self) -> dict[str, ManifestEntry]:
+        # There is no manifest in this format, every video that has records
+        # is reported as complete and is never re-indexed.
+        videos: dict[str, ManifestEntry] = {}
+        for offset, _, path, _ in self._scan():
+            if path in videos:
+                videos[path].frames += 1
+                videos[path].last = offset
+            else:
+                videos[path] = ManifestEntry(
+                    path, -1, -1.0, 0.0, 1, VideoStatus.COMPLETE, offset, offset
+                )
+        return videos
+
+    def video_frames(self, path: str) -> VideoFrames:
+        offsets: list[int] = []
+        times: list[float] = []
+        hashes: list[np.ndarray] = []
+        for offset, data, record_path, record_time in self._scan():
+            if record_path == path:
+                offsets.append(offset)
+                times.append(record_time)
+                hashes.append(np.load(BytesIO(data), allow_pickle=False))
+
+        if not offsets:
+            return VideoFrames.empty()
+        return VideoFrames(
+            np.array(offsets, dtype=np.int64),
+            np.array(times, dtype=np.float64),
+            pack_hashes(np.stack(hashes)),
+        )
+
+    def remove_video(self, path: str):
+        raise ValueError(
+            "Videos can only be removed from a database in the current format, "
+            "migrate it first"
+        )
+
+    def read_record(self, offset: int) -> LazyVideoFrameHash:
+        self.flush()
+        self._file.seek(offset)
+        return self.read_one()
 
     def read_one(self):
+        # Raises EOFError at the end of the file and at a torn last record
+        start = self._file.tell()
+        header = self._file.read(8)
+        if len(header) < 8:
+            raise EOFError
+        record_len, frame_len = struct.unpack("<II", header)
+        end = start + 4 + record_len
+        self._file.seek(0, 2)
+        if end > self._file.tell():
+            raise EOFError
+        self._file.seek(start + 8 + frame_len)
+
         (hash_len,) = struct.unpack("<I", self._file.read(4))
-        return LazyVideoFrameHash.from_bytes(self._file.read(hash_len))
+        hash_array = np.load(BytesIO(self._file.read(hash_len)), allow_pickle=False)
+
+        (path_len,) = struct.unpack("<I", self._file.read(4))
+        path = self._file.read(path_len).decode("utf-8")
+
+        (time,) = struct.unpack("<d", self._file.read(8))
+
+        if self._file.tell() != end:
+            raise ValueError(f"Corrupt record at offset {start}")
+        return LazyVideoFrameHash.from_buffer(
+            self._mapped(end),
+            start + 8,
+            frame_len,
+            ImageHash(hash_array),
+            Path(path),
+            time,
+        )
+
+
+def video_manifest(storage: HashStorage) -> dict[str, ManifestEntry]:
+    # Legacy databases have no manifest and reading their videos is a full
+    # scan, their records are never superseded
+    if isinstance(storage, LegacyHashStorage):
+        return {}
+    return storage.videos()
+
+
+def detect_format(file: BinaryIO) -> int:
+    from video_search.columnar import MAGIC
+
+    file.seek(0)
+    magic = file.read(len(MAGIC))
+    if magic == MAGIC or not magic:
+        return 2
+    return 1
 
 
 @contextmanager
-def open_storage(path: PathLike):
+def open_storage(
+    path: PathLike, write_options: WriteOptions | None = None, read_only: bool = False
+):
+    # A read-only storage keeps its index up to date in memory but never saves
+    # it, other processes may be writing the database
+    from video_search.columnar import ColumnarHashStorage
+    from video_search.index import attach_index, fingerprint, index_path, sync_index
+    from video_search.shards import is_catalog, open_catalog
+
+    if is_catalog(path):
+        with open_catalog(
+            path, write_options=write_options, read_only=read_only
+        ) as sharded:
+            yield sharded
+        return
+
     with open(path, "ab+") as f:
-        yield HashStorage(f)
+        # New databases are created in the columnar format, existing legacy
+        # databases stay readable and writable until they are migrated.
+        if detect_format(f) == 2:
+            storage = ColumnarHashStorage(f, write_options)
+        else:
+            storage = LegacyHashStorage(f, write_options)
+
+        f.seek(0, 2)
+        attach_index(storage, path, f.tell())
+        try:
+            yield storage
+        finally:
+            storage.flush()
+            if storage.index is not None and storage.index.dirty and not read_only:
+                # Other processes may have written or removed videos meanwhile,
+                # the saved index has to know of them as well
+                sync_index(storage)
+                f.seek(0, 2)
+                size = f.tell()
+                storage.index.save(index_path(path), size, fingerprint(path, size))
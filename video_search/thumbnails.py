@@ -0,0 +1,68 @@
+import hashlib
+import os
+from pathlib import Path
+
+from PIL import Image as PILImage
+from PIL.Image import Image
+
+from video_search.video import extract_frame
+
+CACHE_DIR = Path(
+    os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"), "video-search"
+)
+CACHE_SIZE = 256 * 1024 * 1024
+
+
+class ThumbnailCache:
+    # Frames decoded on demand are kept as small PNG files. The file mtime is
+    # bumped on every hit and the least recently used files are deleted once
+    # the directory grows past max_bytes.
+    def __init__(self, directory: Path = CACHE_DIR, max_bytes: int = CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _key(self, video: Path, time: float) -> Path:
+        try:
+            stat = video.stat()
+            version = f"{stat.st_size}:{stat.st_mtime}"
+        except FileNotFoundError:
+            version = ""
+        digest = hashlib.sha1(f"{video}\0{time!r}\0{version}".encode())
+        return self.directory / f"{digest.hexdigest()}.png"
+
+    def load(self, video: Path, time: float) -> Image:
+        path = self._key(video, time)
+        try:
+            image = PILImage.open(path)
+            image.load()
+            os.utime(path)
+            return image
+        except FileNotFoundError:
+            pass
+
+        image = extract_frame(video, time)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        image.save(tmp, format="PNG")
+        os.replace(tmp, path)
+        self.evict()
+        return image
+
+    def evict(self):
+        entries = [
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith(".png")
+        ]
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+default_cache = ThumbnailCache()
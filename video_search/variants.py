@@ -0,0 +1,119 @@
+from dataclasses import dataclass
+from enum import Enum
+
+import numpy as np
+from PIL import ImageOps
+from PIL.Image import Image
+
+# Brightness up to which a row or column counts as part of a black bar, and
+# the share of its pixels that have to be that dark, which leaves room for
+# compression noise and logos
+LETTERBOX_THRESHOLD = 24
+LETTERBOX_COVERAGE = 0.98
+# Bars thinner than this share of the image are left alone, and at least
+# this much of the image has to remain
+LETTERBOX_MIN_BAR = 0.02
+LETTERBOX_MIN_CONTENT = 0.3
+# Centered crops by the share of width and height they keep, and the share
+# cut off the top or the bottom, where overlays like player controls or
+# subtitles are
+CENTER_CROPS = (0.9, 0.8)
+EDGE_CROP = 0.15
+
+
+class VariantMode(str, Enum):
+    NONE = "none"
+    # The query without its black bars, in addition to the query itself
+    LETTERBOX = "letterbox"
+    # ... and crops of it, and all of those mirrored
+    ALL = "all"
+
+
+@dataclass
+class VariantOptions:
+    mode: VariantMode = VariantMode.ALL
+    center_crops: tuple[float, ...] = CENTER_CROPS
+    edge_crop: float = EDGE_CROP
+
+
+@dataclass
+class Variant:
+    name: str
+    image: Image
+
+
+def _bar(dark: np.ndarray) -> int:
+    # Number of leading dark rows
+    return len(dark) if dark.all() else int(np.argmin(dark))
+
+
+def letterbox(image: Image) -> tuple[int, int, int, int] | None:
+    # The box of `image` inside its black bars, None without any
+    gray = np.asarray(image.convert("L"))
+    dark = gray <= LETTERBOX_THRESHOLD
+    rows = dark.mean(axis=1) >= LETTERBOX_COVERAGE
+    columns = dark.mean(axis=0) >= LETTERBOX_COVERAGE
+    height, width = gray.shape
+
+    top, bottom = _bar(rows), _bar(rows[::-1])
+    left, right = _bar(columns), _bar(columns[::-1])
+    # Thin bars are more likely a dark edge of the picture
+    if max(top, bottom) < LETTERBOX_MIN_BAR * height:
+        top = bottom = 0
+    if max(left, right) < LETTERBOX_MIN_BAR * width:
+        left = right = 0
+    if not (top or bottom or left or right):
+        return None
+    if (
+        height - top - bottom < LETTERBOX_MIN_CONTENT * height
+        or width - left - right < LETTERBOX_MIN_CONTENT * width
+    ):
+        # Mostly dark, e.g. a night scene
+        return None
+    return left, top, width - right, height - bottom
+
+
+def _crop(image: Image, left: float, top: float, right: float, bottom: float):
+    width, height = image.size
+    return image.crop(
+        (
+            round(left * width),
+            round(top * height),
+            round(right * width),
+            round(bottom * height),
+        )
+    )
+
+
+def query_variants(image: Image, options: VariantOptions | None) -> list[Variant]:
+    # The query image first, then the variants of it that are searched as
+    # well, with names to tell which one matched
+    variants = [Variant("original", image)]
+    if options is None or options.mode == VariantMode.NONE:
+        return variants
+
+    base = image
+    box = letterbox(image)
+    if box is not None:
+        base = image.crop(box)
+        variants.append(Variant("letterbox", base))
+    if options.mode == VariantMode.LETTERBOX:
+        return variants
+
+    for keep in options.center_crops:
+        margin = (1 - keep) / 2
+        variants.append(
+            Variant(
+                f"crop {keep:.0%}",
+                _crop(base, margin, margin, 1 - margin, 1 - margin),
+            )
+        )
+    if options.edge_crop:
+        variants.append(
+            Variant("crop bottom", _crop(base, 0, 0, 1, 1 - options.edge_crop))
+        )
+        variants.append(Variant("crop top", _crop(base, 0, options.edge_crop, 1, 1)))
+    variants.extend(
+        [Variant(f"{v.name} mirrored", ImageOps.mirror(v.image)) for v in variants]
+    )
+    return variants
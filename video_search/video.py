@@ -1,13 +1,39 @@
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
 from os import PathLike
-from typing import Any, Callable
+from typing import Any
 
 import av
+import numpy as np
+from av.container import InputContainer
+from av.video.frame import VideoFrame
+from av.video.reformatter import Interpolation
+from av.video.stream import VideoStream
 from imagehash import ImageHash, phash
 from PIL.Image import Image
-from video_search.hash import VideoFrameHash
-from av.video.reformatter import Interpolation
+
+from video_search.decode import DecodeMode, DecodeOptions
+from video_search.hash import (
+    HashKind,
+    VideoFrameHash,
+    hamming_distances,
+    pack_hashes,
+    phash_pixels,
+)
+from video_search.pipeline import FramePool
+from video_search.profiling import Profiler
 
 THRESHOLD = 0.2
+# phash scales frames down to 32x32 before the DCT. Decoded frames are held
+# until their batch is hashed, so the batch is kept small.
+HASH_INPUT_SIZE = 32
+HASH_BATCH = 16
+# Batches are smaller on a pool, where every worker holds some of them
+PIPELINE_BATCH = 4
+# When sampling, targets closer than this are reached by decoding forward
+# instead of seeking, as a seek has to decode from the previous keyframe anyway.
+SEEK_DISTANCE = 2.0
 
 
 def calculate_thumbnail_size(
@@ -27,44 +53,243 @@ def calculate_thumbnail_size(
     return (new_w, new_h)
 
 
+def _sampled_frames(
+    vid: InputContainer, stream: VideoStream, rate: float
+) -> Iterator[VideoFrame]:
+    assert stream.time_base is not None
+    interval = 1.0 / rate
+    target = 0.0
+    frames = vid.decode(stream)
+    while True:
+        frame = next(frames, None)
+        if frame is None or frame.time is None:
+            return
+        if frame.time < target:
+            continue
+
+        yield frame
+        target = (frame.time // interval + 1) * interval
+        if target - frame.time > SEEK_DISTANCE:
+            vid.seek(int(target / stream.time_base), stream=stream, backward=True)
+            frames = vid.decode(stream)
+
+
+def iter_frames(vid: InputContainer, options: DecodeOptions) -> Iterator[VideoFrame]:
+    stream = vid.streams.video[0]
+    if options.threads:
+        stream.thread_type = "AUTO"
+
+    if options.mode == DecodeMode.KEYFRAMES:
+        stream.codec_context.skip_frame = "NONKEY"
+        return vid.decode(stream)
+    if options.mode == DecodeMode.SAMPLE:
+        return _sampled_frames(vid, stream, options.sample_rate)
+    return vid.decode(stream)
+
+
+def _batches(frames: Iterator[VideoFrame], size: int) -> Iterator[list[VideoFrame]]:
+    batch: list[VideoFrame] = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _thumbnail(frame: VideoFrame, interpolation: Interpolation) -> Image:
+    thumbnail_size = calculate_thumbnail_size(
+        (frame.width, frame.height),
+        (128, 128),
+    )
+    return frame.to_image(
+        width=thumbnail_size[0],
+        height=thumbnail_size[1],
+        interpolation=interpolation,
+    )
+
+
 def hash_video(
     video: PathLike,
     hash_algorithm: Callable[[Image], ImageHash] = phash,
     progress_callback: Callable[[float, float], Any] | None = None,
+    options: DecodeOptions | None = None,
+    extra_hashes: tuple[HashKind, ...] = (),
+    profiler: Profiler | None = None,
+    pool: FramePool | None = None,
 ):
+    options = options or DecodeOptions()
+    profiler = profiler or Profiler()
+    pool = pool or FramePool()
+    interpolation = Interpolation[options.interpolation]
     vid = av.open(video, mode="r")
 
-    previous_hash = None
+    # With the default phash, frames are scaled to grayscale hash input by the
+    # reformatter and hashed in batches. Thumbnails are only built for the
+    # frames that are kept.
+    batched = hash_algorithm is phash
     duration_micro = vid.duration or 0
     real_duration: float = duration_micro / 1_000_000  # type: ignore
-    for frame in vid.decode(video=0):
-        thumbnail_size = calculate_thumbnail_size(
-            (frame.width, frame.height),
-            (128, 128),
-        )
 
-        im: Image = frame.to_image(
-            width=thumbnail_size[0],
-            height=thumbnail_size[1],
-            interpolation=Interpolation.LANCZOS,
-        )
-        current = hash_algorithm(im)
-        frame_hash = VideoFrameHash(im, current, video, frame.time)
+    # On a pool, frames are decoded on a thread of their own while the workers
+    # hash batches and build thumbnails. Whether a frame is kept depends on
+    # the last kept one, which is decided here in order. Every thread times
+    # its work in a profiler of its own, merged into `profiler` here.
+    def task_profiler() -> Profiler:
+        return Profiler(profiler.trace) if pool.parallel else profiler
 
-        if not previous_hash:
-            if progress_callback:
-                progress_callback(frame.time, real_duration)
-            yield frame_hash
-            previous_hash = current
-            continue
+    decode_profiler = task_profiler()
+    decoded = decode_profiler.timed("decode", iter_frames(vid, options))
+    batch_size = 1
+    if batched:
+        batch_size = PIPELINE_BATCH if pool.parallel else HASH_BATCH
+    batches = pool.produce(_batches(decoded, batch_size))
+
+    def hash_batch(frames: list[VideoFrame]):
+        task = task_profiler()
+        images: list[Image | None]
+        if batched:
+            with task.stage("scale", len(frames)):
+                pixels = np.stack(
+                    [
+                        frame.reformat(
+                            width=HASH_INPUT_SIZE,
+                            height=HASH_INPUT_SIZE,
+                            format="gray",
+                            interpolation=interpolation,
+                        ).to_ndarray()
+                        for frame in frames
+                    ]
+                )
+            with task.stage("hash", len(frames)):
+                hashes = [ImageHash(bits) for bits in phash_pixels(pixels)]
+            images = [None] * len(frames)
+        else:
+            with task.stage("thumbnail", len(frames)):
+                images = [_thumbnail(frame, interpolation) for frame in frames]
+            with task.stage("hash", len(frames)):
+                hashes = [hash_algorithm(im) for im in images]
+        return frames, hashes, images, task
+
+    def kept_frames():
+        previous_hash = None
+        for frames, hashes, images, task in pool.map(hash_batch, batches):
+            if task is not profiler:
+                profiler.merge(task)
+            profiler.count("frames_decoded", len(frames))
+            for frame, current, im in zip(frames, hashes, images):
+                if previous_hash and (current - previous_hash) / 64 <= THRESHOLD:
+                    continue
+                profiler.count("frames_kept")
+                yield frame, current, im
+                previous_hash = current
+
+    def finish(kept: tuple[VideoFrame, ImageHash, Image | None]):
+        frame, current, im = kept
+        task = task_profiler()
+        if im is None:
+            with task.stage("thumbnail"):
+                im = _thumbnail(frame, interpolation)
+        # Additional hashes are computed from the thumbnail of kept frames
+        extra = {}
+        if extra_hashes:
+            with task.stage("extra_hash"):
+                extra = {kind: kind.compute(im) for kind in extra_hashes}
+        return VideoFrameHash(im, current, video, frame.time, extra), task
 
-        pct = (current - previous_hash) / 64
-        if pct > THRESHOLD:
-            yield frame_hash
+    kept = kept_frames()
+    finished = pool.map(finish, kept)
+    try:
+        for h, task in finished:
+            if task is not profiler:
+                profiler.merge(task)
+            yield h
             if progress_callback:
-                progress_callback(frame.time, real_duration)
-            previous_hash = current
+                progress_callback(h.time, real_duration)
+
+        if progress_callback:
+            progress_callback(real_duration, real_duration)
+    finally:
+        # The decoding thread is stopped before its container is closed
+        for stage in (finished, kept, batches):
+            stage.close()
+        if decode_profiler is not profiler:
+            profiler.merge(decode_profiler)
+        vid.close()
+
+
+def extract_frame(video: PathLike, time: float) -> Image:
+    # Decodes the thumbnail of the frame shown at `time`, for records that were
+    # stored without one.
+    with av.open(video, mode="r") as vid:
+        stream = vid.streams.video[0]
+        assert stream.time_base is not None
+        vid.seek(int(time / stream.time_base), stream=stream, backward=True)
+
+        previous = None
+        for frame in vid.decode(stream):
+            if frame.time is not None and frame.time >= time - 1e-6:
+                return _thumbnail(frame, Interpolation.LANCZOS)
+            previous = frame
 
-    if progress_callback:
-        progress_callback(real_duration, real_duration)
-    vid.close()
+        if previous is None:
+            raise ValueError(f"No frame at {time}s in {video}")
+        return _thumbnail(previous, Interpolation.LANCZOS)
+
+
+@dataclass
+class DecodeReport:
+    options: DecodeOptions
+    seconds: float
+    frames_kept: int
+    # Frames of the source video covered per second of wall time
+    frames_per_second: float
+    recall: float
+
+
+def compare_decode_modes(
+    video: PathLike, candidates: list[DecodeOptions]
+) -> list[DecodeReport]:
+    # The first report is the exhaustive mode every candidate is compared to.
+    # Recall is the fraction of scenes kept by the exhaustive mode that have a
+    # frame within THRESHOLD in the candidate's output.
+    with av.open(video, mode="r") as vid:
+        stream = vid.streams.video[0]
+        video_frames = stream.frames or 0
+        if not video_frames and stream.average_rate and vid.duration:
+            video_frames = round(float(stream.average_rate) * vid.duration / 1e6)
+
+    def run(options: DecodeOptions):
+        start = time.perf_counter()
+        hashes = [h.hash.hash for h in hash_video(video, options=options)]
+        seconds = time.perf_counter() - start
+        if not hashes:
+            return seconds, np.empty((0, 1), dtype=np.uint64)
+        return seconds, pack_hashes(np.array(hashes))
+
+    baseline_options = DecodeOptions()
+    baseline_seconds, baseline = run(baseline_options)
+    reports = [
+        DecodeReport(
+            baseline_options,
+            baseline_seconds,
+            len(baseline),
+            video_frames / baseline_seconds,
+            1.0,
+        )
+    ]
+    for options in candidates:
+        seconds, hashes = run(options)
+        recall = 0.0
+        if len(hashes) and len(baseline):
+            # One row of distances at a time, a full matrix of thousands of
+            # scenes per mode would not fit in memory
+            nearest = np.array(
+                [hamming_distances(hashes, row).min() for row in baseline]
+            )
+            recall = float((nearest <= THRESHOLD * 64).mean())
+        reports.append(
+            DecodeReport(options, seconds, len(hashes), video_frames / seconds, recall)
+        )
+    return reports
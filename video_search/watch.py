@@ -0,0 +1,616 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from video_search.decode import DecodeOptions
+from video_search.dedupe import DedupeOptions
+from video_search.hash import HashKind, ThumbnailOptions
+from video_search.profiling import Profiler
+from video_search.storage import HashStorage, VideoStatus
+
+if TYPE_CHECKING:
+    from video_search.indexer import ProcessPool
+
+DEFAULT_EXTENSIONS = (".mp4", ".webm")
+# Directories listed at once, listing is waiting on the filesystem
+SCAN_THREADS = 8
+# Seconds a changed file has to keep its size and modification time before it
+# is indexed, and seconds between scans when changes are found by polling
+SETTLE_SECONDS = 5.0
+POLL_INTERVAL = 10.0
+# Changed files waiting to settle. Past that they are dropped and the
+# directories are scanned again once things calm down.
+MAX_PENDING = 10000
+# Settled videos waiting to be indexed, past that the same
+MAX_QUEUED = 10000
+# Seconds to wait for changes while nothing is queued
+TICK = 0.5
+
+
+def normalize_extensions(extensions: Iterable[str]) -> tuple[str, ...]:
+    return tuple(
+        sorted(
+            {e.lower() if e.startswith(".") else "." + e.lower() for e in extensions}
+        )
+    )
+
+
+def _list(
+    directory: Path, extensions: tuple[str, ...]
+) -> tuple[list[tuple[Path, os.stat_result]], list[Path]]:
+    files = []
+    directories = []
+    try:
+        entries = list(os.scandir(directory))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return files, directories
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                path = Path(entry.path)
+                # Symlinked directories are walked by their real path, like
+                # the videos in them are stored
+                directories.append(path.resolve() if entry.is_symlink() else path)
+            elif os.path.splitext(entry.name)[1].lower() in extensions:
+                path = Path(entry.path)
+                stat = entry.stat()
+                files.append((path.resolve() if entry.is_symlink() else path, stat))
+        except OSError:
+            # Removed while listing, or a dangling symlink
+            continue
+    return files, directories
+
+
+def scan_videos(
+    directories: list[Path],
+    extensions: Iterable[str] = DEFAULT_EXTENSIONS,
+    recurse: bool = False,
+    threads: int = SCAN_THREADS,
+    directory_callback: Callable[[Path], Any] | None = None,
+) -> dict[Path, os.stat_result]:
+    # Videos under `directories` by their resolved path, listed with scandir on
+    # a few threads at once. `directory_callback` is called with every
+    # directory before it is listed.
+    extensions = normalize_extensions(extensions)
+    found: dict[Path, os.stat_result] = {}
+    seen: set[Path] = set()
+
+    with ThreadPoolExecutor(threads) as executor:
+        pending: set[Future] = set()
+
+        def submit(directory: Path):
+            if directory in seen:
+                return
+            seen.add(directory)
+            if directory_callback:
+                directory_callback(directory)
+            pending.add(executor.submit(_list, directory, extensions))
+
+        for directory in directories:
+            submit(directory.resolve())
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                files, subdirectories = future.result()
+                found.update(files)
+                if recurse:
+                    for subdirectory in subdirectories:
+                        submit(subdirectory)
+    return dict(sorted(found.items()))
+
+
+def _is_under(path: Path, directory: Path) -> bool:
+    return path == directory or path.is_relative_to(directory)
+
+
+@dataclass
+class Changes:
+    changed: set[Path] = field(default_factory=set)
+    deleted: set[Path] = field(default_factory=set)
+    # Changes may have been missed, the directories have to be scanned again
+    rescan: bool = False
+
+
+class PollingWatcher:
+    # Finds changes by scanning the directories every `interval` seconds and
+    # comparing sizes and modification times with the previous scan
+    backend = "polling"
+
+    def __init__(
+        self,
+        directories: list[Path],
+        extensions: tuple[str, ...],
+        recurse: bool,
+        interval: float = POLL_INTERVAL,
+    ):
+        self.directories = directories
+        self.extensions = extensions
+        self.recurse = recurse
+        self.interval = interval
+        self._files: dict[Path, tuple[int, int]] = {}
+        self._due = time.monotonic() + interval
+
+    def watch_directory(self, directory: Path):
+        pass
+
+    def scanned(self, files: dict[Path, os.stat_result]):
+        self._files = {p: (s.st_size, s.st_mtime_ns) for p, s in files.items()}
+        self._due = time.monotonic() + self.interval
+
+    def poll(self, timeout: float) -> Changes:
+        wait_for = self._due - time.monotonic()
+        if wait_for > 0:
+            time.sleep(min(wait_for, timeout))
+            return Changes()
+
+        files = scan_videos(self.directories, self.extensions, self.recurse)
+        current = {p: (s.st_size, s.st_mtime_ns) for p, s in files.items()}
+        changes = Changes(
+            {p for p, state in current.items() if self._files.get(p) != state},
+            set(self._files) - set(current),
+        )
+        self._files = current
+        self._due = time.monotonic() + self.interval
+        return changes
+
+    def close(self):
+        pass
+
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+_EVENT = struct.Struct("iIII")
+_WATCH_MASK = (
+    IN_MODIFY
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+
+
+class InotifyWatcher:
+    # Changes reported by the kernel. Every directory has its own watch, the
+    # ones created later are watched and scanned as they appear. When the
+    # kernel's event queue overflows a rescan is asked for.
+    backend = "inotify"
+
+    def __init__(
+        self, directories: list[Path], extensions: tuple[str, ...], recurse: bool
+    ):
+        # Raises OSError where inotify is not available
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.directories = directories
+        self.extensions = extensions
+        self.recurse = recurse
+        self._lock = threading.Lock()
+        self._watches: dict[int, Path] = {}
+
+    def watch_directory(self, directory: Path):
+        # Called from the scanning threads
+        wd = self._add_watch(self._fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(
+                    error,
+                    "Out of inotify watches, raise fs.inotify.max_user_watches "
+                    "or use polling",
+                )
+            # Removed meanwhile or not readable
+            return
+        with self._lock:
+            self._watches[wd] = directory
+
+    def scanned(self, files: dict[Path, os.stat_result]):
+        pass
+
+    def _forget(self, directory: Path):
+        with self._lock:
+            for wd, path in list(self._watches.items()):
+                if _is_under(path, directory):
+                    del self._watches[wd]
+                    self._rm_watch(self._fd, wd)
+
+    def poll(self, timeout: float) -> Changes:
+        changes = Changes()
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return changes
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changes
+
+        position = 0
+        while position < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, position)
+            name = data[position + _EVENT.size : position + _EVENT.size + length]
+            position += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                changes.rescan = True
+                continue
+            if mask & IN_IGNORED:
+                with self._lock:
+                    self._watches.pop(wd, None)
+                continue
+            with self._lock:
+                directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if directory in self.directories:
+                    # A watched root went away, find out what is left
+                    changes.rescan = True
+                continue
+
+            path = directory / os.fsdecode(name.rstrip(b"\0"))
+            if mask & IN_ISDIR:
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._forget(path)
+                    changes.deleted.add(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO) and self.recurse:
+                    # Files may have been written before the watch was added
+                    changes.changed.update(
+                        scan_videos(
+                            [path],
+                            self.extensions,
+                            True,
+                            directory_callback=self.watch_directory,
+                        )
+                    )
+            elif path.suffix.lower() in self.extensions:
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    changes.deleted.add(path)
+                else:
+                    changes.changed.add(path)
+        return changes
+
+    def close(self):
+        os.close(self._fd)
+
+
+def open_watcher(
+    directories: list[Path],
+    extensions: tuple[str, ...],
+    recurse: bool,
+    polling: bool = False,
+    interval: float = POLL_INTERVAL,
+) -> InotifyWatcher | PollingWatcher:
+    if not polling:
+        try:
+            return InotifyWatcher(directories, extensions, recurse)
+        except OSError:
+            pass
+    return PollingWatcher(directories, extensions, recurse, interval)
+
+
+class Debouncer:
+    # Changed files, until their size and modification time stayed the same
+    # for `settle` seconds, i.e. whatever writes them is done
+    def __init__(self, settle: float = SETTLE_SECONDS, max_pending: int = MAX_PENDING):
+        self.settle = settle
+        self.max_pending = max_pending
+        # Files were dropped because too many were pending
+        self.overflowed = False
+        self._pending: dict[Path, tuple[int, int, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, path: Path, stat: os.stat_result | None = None):
+        try:
+            stat = stat or path.stat()
+        except OSError:
+            return
+        state = (stat.st_size, stat.st_mtime_ns)
+        previous = self._pending.get(path)
+        if previous is not None and previous[:2] == state:
+            return
+        if previous is None and len(self._pending) >= self.max_pending:
+            self._pending.clear()
+            self.overflowed = True
+            return
+        self._pending[path] = (*state, time.monotonic())
+
+    def discard(self, directory: Path):
+        # The path and, for a directory, everything under it
+        for path in [p for p in self._pending if _is_under(p, directory)]:
+            del self._pending[path]
+
+    def ready(self) -> list[Path]:
+        now = time.monotonic()
+        ready = []
+        for path, (size, mtime, since) in list(self._pending.items()):
+            try:
+                stat = path.stat()
+            except OSError:
+                del self._pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                self._pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - since >= self.settle:
+                del self._pending[path]
+                ready.append(path)
+        return sorted(ready)
+
+
+@dataclass
+class WatchStatus:
+    backend: str
+    # Files waiting to settle and ones waiting to be indexed
+    pending: int = 0
+    queued: int = 0
+    indexed: int = 0
+    removed: int = 0
+    failed: int = 0
+    # The video being indexed
+    current: Path | None = None
+
+
+class Watch:
+    # Keeps a database in sync with directories of videos: they are scanned
+    # once, then new and changed videos are indexed once they settle, deleted
+    # ones are removed. Runs until `stopped` returns true.
+    def __init__(
+        self,
+        directories: list[Path],
+        storage: HashStorage,
+        extensions: Iterable[str] = DEFAULT_EXTENSIONS,
+        recurse: bool = False,
+        settle: float = SETTLE_SECONDS,
+        polling: bool = False,
+        poll_interval: float = POLL_INTERVAL,
+        jobs: int = 1,
+        frame_workers: int = 1,
+        status_callback: Callable[[WatchStatus], Any] | None = None,
+        progress_callback: Callable[[Path, float, float], Any] | None = None,
+        error_callback: Callable[[Path, Exception], Any] | None = None,
+        stopped: Callable[[], bool] | None = None,
+        options: DecodeOptions | None = None,
+        thumbnails: ThumbnailOptions | None = None,
+        extra_hashes: tuple[HashKind, ...] = (),
+        profiler: Profiler | None = None,
+        dedupe: DedupeOptions | None = None,
+    ):
+        self.directories = [d.resolve() for d in directories]
+        self.storage = storage
+        self.extensions = normalize_extensions(extensions)
+        self.recurse = recurse
+        self.jobs = jobs
+        self.status_callback = status_callback
+        self.progress_callback = progress_callback
+        self.error_callback = error_callback
+        self.stopped = stopped or (lambda: False)
+        self.index_options: dict[str, Any] = {
+            "options": options,
+            "thumbnails": thumbnails,
+            "extra_hashes": extra_hashes,
+            "profiler": profiler,
+            "dedupe": dedupe,
+            "workers": frame_workers,
+        }
+        self.watcher = open_watcher(
+            self.directories, self.extensions, recurse, polling, poll_interval
+        )
+        self.debouncer = Debouncer(settle)
+        self.status = WatchStatus(self.watcher.backend)
+        # Settled videos in the order they are indexed, a video that is
+        # queued again keeps its place
+        self._queued: dict[Path, None] = {}
+        self._overflowed = False
+        # Started with the first batch that needs them, kept until the end
+        self._processes: ProcessPool | None = None
+        # Sizes and modification times of videos that could not be indexed,
+        # they are tried again once they change
+        self._failed: dict[Path, tuple[int, int]] = {}
+
+    def run(self):
+        try:
+            self.rescan()
+            while not self.stopped():
+                changes = self.watcher.poll(0 if self._queued else TICK)
+                for path in changes.deleted:
+                    self._deleted(path)
+                for path in changes.changed:
+                    self.debouncer.add(path)
+                if (
+                    changes.rescan
+                    or (self.debouncer.overflowed and not len(self.debouncer))
+                    or (self._overflowed and not self._queued)
+                ):
+                    self.rescan()
+                for path in self.debouncer.ready():
+                    self._queue(path)
+                self._report()
+                if self._queued:
+                    self._index_next()
+        finally:
+            self.watcher.close()
+            self._close_processes()
+
+    def rescan(self):
+        from video_search.indexer import videos_to_index
+
+        self.debouncer.overflowed = False
+        self._overflowed = False
+        files = scan_videos(
+            self.directories,
+            self.extensions,
+            self.recurse,
+            directory_callback=self.watcher.watch_directory,
+        )
+        self.watcher.scanned(files)
+
+        for path, entry in self.storage.videos().items():
+            path = Path(path)
+            if (
+                entry.status != VideoStatus.REMOVED
+                and path not in files
+                and path.suffix.lower() in self.extensions
+                and any(self._watches(path, d) for d in self.directories)
+            ):
+                self._deleted(path)
+
+        # Recently written videos may still be growing
+        now = time.time()
+        for path in videos_to_index(list(files), self.storage, files):
+            if now - files[path].st_mtime < self.debouncer.settle:
+                self.debouncer.add(path, files[path])
+            else:
+                self._queue(path, files[path])
+        self._report()
+
+    def _watches(self, path: Path, directory: Path) -> bool:
+        if self.recurse:
+            return path.is_relative_to(directory)
+        return path.parent == directory
+
+    def _queue(self, path: Path, stat: os.stat_result | None = None):
+        try:
+            stat = stat or path.stat()
+        except OSError:
+            return
+        if self._failed.get(path) == (stat.st_size, stat.st_mtime_ns):
+            return
+        self._failed.pop(path, None)
+        if path not in self._queued and len(self._queued) >= MAX_QUEUED:
+            self._overflowed = True
+            return
+        self._queued[path] = None
+
+    def _deleted(self, path: Path):
+        self.debouncer.discard(path)
+        for queued in [p for p in self._queued if _is_under(p, path)]:
+            del self._queued[queued]
+        if path.exists():
+            # Replaced meanwhile, it is indexed again instead
+            return
+        for video, entry in self.storage.videos().items():
+            if entry.status != VideoStatus.REMOVED and _is_under(Path(video), path):
+                try:
+                    self.storage.remove_video(video)
+                except ValueError as e:
+                    self._error(Path(video), e)
+                    continue
+                self.status.removed += 1
+
+    def _index_next(self):
+        from video_search.indexer import (
+            VIDEO_ERRORS,
+            ProcessPool,
+            index_videos,
+            videos_to_index,
+        )
+
+        batch = []
+        stats = {}
+        for path in list(self._queued)[: max(self.jobs, 1)]:
+            del self._queued[path]
+            try:
+                stats[path] = path.stat()
+            except OSError:
+                continue
+            batch.append(path)
+        batch = videos_to_index(batch, self.storage, stats)
+        if not batch:
+            return
+
+        def cb(path: Path, start: float, end: float):
+            self.status.current = path
+            if self.progress_callback:
+                self.progress_callback(path, start, end)
+
+        def done(path: Path):
+            self.status.indexed += 1
+
+        if self.jobs > 1 and self._processes is None:
+            self._processes = ProcessPool(self.jobs)
+        try:
+            index_videos(
+                batch,
+                self.storage,
+                jobs=self.jobs,
+                progress_callback=cb,
+                file_callback=done,
+                processes=self._processes,
+                **self.index_options,
+            )
+        except VIDEO_ERRORS:
+            # A worker process may have died with it, the next batch starts
+            # new ones
+            self._close_processes()
+            # Which video failed is only known when indexing them one by one
+            for path in videos_to_index(batch, self.storage, stats):
+                try:
+                    index_videos(
+                        [path],
+                        self.storage,
+                        progress_callback=cb,
+                        file_callback=done,
+                        **self.index_options,
+                    )
+                except VIDEO_ERRORS as e:
+                    self._failed[path] = (stats[path].st_size, stats[path].st_mtime_ns)
+                    self.status.failed += 1
+                    self._error(path, e)
+        finally:
+            self.status.current = None
+            self._report()
+
+    def _close_processes(self):
+        if self._processes is not None:
+            self._processes.close()
+            self._processes = None
+
+    def _error(self, path: Path, error: Exception):
+        if self.error_callback:
+            self.error_callback(path, error)
+
+    def _report(self):
+        self.status.pending = len(self.debouncer)
+        self.status.queued = len(self._queued)
+        if self.status_callback:
+            self.status_callback(self.status)